@@ -0,0 +1,859 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Program for micro-benchmarks
+
+Use as (for example):
+    python benchmark.py data [--data_dir=$DATA_DIR --input_dim=44 \
+                              --target_dim=1] [--packed]
+
+- data    : frames/sec of DataIter minibatch assembly, per-column loop
+            (before) vs. whole-batch gather (after), for several batch &
+            step sizes
+- formats : frames/sec, bytes on disk, and accuracy of DataIter for each
+            on-disk format (converted from float32 data)
+- steps   : frames/sec of training with separate fwd/bwd & update calls
+            (before) vs. fused train step vs. multi_step (k minibatches per
+            call) for small nets (random data; needs Theano, THEANO_FLAGS
+            as in train.py)
+- parallel: frames/sec of data parallel training (parallel.py) for 1, 2, 4,
+            ... processes up to the number of cores, with a batch of 16 per
+            process (weak scaling; efficiency relative to 1 process) and
+            with a fixed batch_size split over processes as by train.py's
+            --workers (strong scaling; speedup over 1 process) (needs
+            Theano; run with THEANO_FLAGS=device=cpu and OMP_NUM_THREADS=1)
+- ps      : frames/sec and staleness histogram of asynchronous training with
+            a parameter server (parallel.py) and 1, 2, 4, ... worker
+            processes on localhost (needs Theano & ZeroMQ; flags as above)
+- unroll  : compile time (fwd/bwd & update, bypassing the function cache)
+            vs. frames/sec of training for th.scan (k=1), unroll_factor k,
+            and full unroll_scan, with window_size 128 & step_size 64
+            (needs Theano)
+- checkpoint: peak memory (growth of resident set size while training,
+            Linux) vs. frames/sec of training without and with
+            checkpoint_layers k (recompute groups of k layers in backprop)
+            for a deep net with long BPTT windows, and step time relative to
+            no checkpointing (each group is recomputed once, so it should
+            stay within ~1.5x; needs Theano; CPU)
+- micro   : equivalence & peak memory of options['micro_batches'] = n for
+            n = 1, 2, 4; trains a few steps from the same parameters & data
+            with grad_norm_clip on, and reports max differences of loss,
+            parameters & prev_states from n = 1, and peak memory (as for
+            checkpoint) (needs Theano; CPU)
+- wavefront: frames/sec of training with layer-by-layer scans (before) vs.
+            options['wavefront'] (one scan over the (time, layer) wavefront)
+            for a deep narrow net at small batch sizes, and max difference
+            of losses between the two for the same parameters (needs Theano)
+- latency : startup time (load & compile) and per-step latency (median &
+            99th percentile of Ensemble.run_one_step) of the Theano engine
+            (before) vs. the NumPy engine (engine.py) at batch sizes 1 & 16,
+            and max difference of their outputs, for lstm/gru nets with all
+            unit options on and perturbed parameters (needs Theano); fails
+            (exit status 1) if the difference exceeds 1e-5
+- workers : smoke check of train.py's data parallel mode; launches
+            'train.py --workers=2' (THEANO_FLAGS=device=cpu) on the dataset
+            and checks that it gets through setup & worker startup and keeps
+            training for --seconds before stopping it (needs Theano;
+            --input_dim/--target_dim must match options in train.py)
+- Without --data_dir, a synthetic dataset is made in a temporary directory
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from data import build_id_idx, pack_list, convert_list, DataIter, \
+                 SeqFormat, FORMATS, write_matrix
+
+class LoopDataIter(DataIter):
+    """
+    DataIter with the former per-column window assembly (for reference)
+    """
+    def _read(self, batch_idx):
+        DataIter._read(self, batch_idx)
+        if self._packed:
+            o = self._offs[batch_idx]
+            n = self._lens[batch_idx]
+            self._inputs [batch_idx] = self._pack_input [o : o + n]
+            self._targets[batch_idx] = self._pack_target[o : o + n]
+    
+    def discard_unfinished(self):
+        for b in range(self._batch_size):
+            if self._t_idxs[b] > 0:
+                self._t_idxs[b] = self._inputs[b].shape[0]
+
+    def __next__(self):
+        def shift(arr, d): arr[: -d] = arr[d :]
+
+        if not hasattr(self, '_inputs') or self._inputs[0] is None:
+            self._inputs  = self._batch_size * [np.zeros((0, 1))]
+            self._targets = self._batch_size * [np.zeros((0, 1))]
+
+        shift(self._input_tbi , self._step_size)
+        shift(self._target_tbi, self._step_size)
+        shift(self._time_tb   , self._step_size)
+        shift(self._id_idx_tb , self._step_size)
+
+        for b in range(self._batch_size):
+            cur = self._window_size - self._step_size
+
+            while cur < self._window_size:
+                while self._t_idxs[b] >= self._inputs[b].shape[0]:
+                    self._read(b)
+                
+                inc = min(self._window_size - cur,
+                          self._inputs[b].shape[0] - self._t_idxs[b])
+                rng_b = range(cur, cur + inc)
+                rng_f = range(self._t_idxs[b], self._t_idxs[b] + inc)
+
+                self._input_tbi [rng_b, b, :] = self._inputs [b][rng_f, :]
+                self._target_tbi[rng_b, b, :] = self._targets[b][rng_f, :]
+                self._time_tb   [rng_b, b]    = np.array(rng_f) \
+                                                  .astype('float32')
+                self._id_idx_tb [rng_b, b]    = self._id_idxs[b]
+
+                cur += inc
+                self._t_idxs[b] += inc
+        
+        return self._input_tbi, self._target_tbi, \
+               self._time_tb, self._id_idx_tb
+
+def make_synthetic(data_dir, input_dim, target_dim, n_seqs = 256,
+                   min_len = 200, max_len = 4000):
+    """
+    Write random sequences and train.list/dev.list (same list) to data_dir
+    """
+    seqs = []
+    for i in range(n_seqs):
+        seq = 'synth/%d/id%d' % (i, i % 16)
+        os.makedirs(data_dir + '/synth/' + str(i))
+        n = np.random.randint(min_len, max_len)
+        np.random.randn(n, input_dim ).astype('<f4') \
+          .tofile(data_dir + '/' + seq + '.input' )
+        np.random.randn(n, target_dim).astype('<f4') \
+          .tofile(data_dir + '/' + seq + '.target')
+        seqs.append(seq)
+    for name in ['train', 'dev']:
+        with open(data_dir + '/' + name + '.list', 'w') as f:
+            f.write('\n'.join(seqs) + '\n')
+
+def bench_data(args):
+    list_file = args.data_dir + '/train.list'
+    if args.packed:
+        pack_list(list_file, args.input_dim, args.target_dim)
+    id_idx = build_id_idx(list_file)
+
+    print('batch_size window_size step_size  before (frames/s)'
+          '  after (frames/s)  speedup')
+    for batch_size in [16, 128, 512]:
+        for window_size, step_size in [(128, 64), (128, 128), (32, 16)]:
+            fps = []
+            for cls in [LoopDataIter, DataIter]:
+                np.random.seed(0)
+                data_iter = cls(list_file, window_size, step_size, batch_size,
+                                args.input_dim, args.target_dim, id_idx,
+                                packed = args.packed)
+                for _ in range(4): # warm up (file cache, first reads)
+                    next(data_iter)
+                
+                n_iters = 0
+                start = time.time()
+                while time.time() - start < args.seconds:
+                    next(data_iter)
+                    n_iters += 1
+                fps.append(n_iters * step_size * batch_size
+                           / (time.time() - start))
+            
+            print(str(batch_size).rjust(10) + str(window_size).rjust(12)
+                  + str(step_size).rjust(10) + ('%.3g' % fps[0]).rjust(19)
+                  + ('%.3g' % fps[1]).rjust(18)
+                  + ('%.1fx' % (fps[1] / fps[0])).rjust(9))
+
+def bench_formats(args):
+    list_file = args.data_dir + '/train.list'
+    id_idx = build_id_idx(list_file)
+    window_size, step_size, batch_size = 128, 64, 128
+
+    print('    format  packed  frames/s  bytes/frame  max error (input)')
+    for name in FORMATS:
+        if name != 'float32':
+            convert_list(list_file, args.input_dim, args.target_dim, name)
+        for packed in [False, True]:
+            if packed:
+                pack_list(list_file, args.input_dim, args.target_dim, name)
+            
+            np.random.seed(0)
+            data_iter = DataIter(list_file, window_size, step_size, batch_size,
+                                 args.input_dim, args.target_dim, id_idx,
+                                 packed = packed, seq_format = name)
+            np.random.seed(0)
+            ref_iter  = DataIter(list_file, window_size, step_size, batch_size,
+                                 args.input_dim, args.target_dim, id_idx)
+            max_err = max(np.max(np.abs(next(data_iter)[0]
+                                        - next(ref_iter )[0]))
+                          for _ in range(8))
+            
+            n_iters = 0
+            start = time.time()
+            while time.time() - start < args.seconds:
+                next(data_iter)
+                n_iters += 1
+            fps = n_iters * step_size * batch_size / (time.time() - start)
+            
+            bytes_per_frame = SeqFormat(list_file, name).itemsize() \
+                              * (args.input_dim + args.target_dim)
+            print(name.rjust(10) + str(packed).rjust(8)
+                  + ('%.3g' % fps).rjust(10) + str(bytes_per_frame).rjust(13)
+                  + ('%.3g' % max_err).rjust(19))
+
+def bench_options(input_dim, target_dim, net_width, net_depth,
+                  batch_size = 16, window_size = 128, step_size = 64):
+    """
+    Options as in train.py (with given sizes) for benchmarks of Net
+    """
+    from collections import OrderedDict
+    options = OrderedDict()
+    options['input_dim']          = input_dim
+    options['target_dim']         = target_dim
+    options['unit_type']          = 'lstm'
+    options['lstm_peephole']      = True
+    options['loss_type']          = 'l2'
+    options['net_width']          = net_width
+    options['net_depth']          = net_depth
+    options['batch_size']         = batch_size
+    options['window_size']        = window_size
+    options['step_size']          = step_size
+    options['init_scale']         = 0.02
+    options['init_use_ortho']     = False
+    options['weight_norm']        = False
+    options['layer_norm']         = False
+    options['residual_gate']      = True
+    options['learn_init_states']  = True
+    options['learn_id_embedding'] = False
+    options['learn_clock_params'] = False
+    options['update_type']        = 'nesterov'
+    options['update_mu']          = 0.9
+    options['force_type']         = 'adadelta'
+    options['force_ms_decay']     = 0.99
+    options['unroll_scan']        = False
+    options['id_count']           = 1
+    return options
+
+def random_minibatch(options, k = None):
+    """
+    Random (input, target, time, id_idx) of window_size x batch_size
+    (with leading dimension k if given)
+    """
+    lead = (k,) if k is not None else ()
+    T, B = options['window_size'], options['batch_size']
+    return (np.random.randn(*(lead + (T, B, options['input_dim']))) \
+              .astype('float32'),
+            np.random.randn(*(lead + (T, B, options['target_dim']))) \
+              .astype('float32'),
+            np.tile(np.arange(T, dtype = 'float32')[:, None], lead + (1, B)),
+            np.zeros(lead + (T, B), dtype = 'int32'))
+
+def bench_steps(args):
+    from net import Net # needs Theano (not needed by other benchmarks)
+
+    def timed(f, frames_per_call):
+        f() # warm up
+        n_calls = 0
+        start = time.time()
+        while time.time() - start < args.seconds:
+            f()
+            n_calls += 1
+        return n_calls * frames_per_call / (time.time() - start)
+
+    lr = np.float32(1e-5)
+    print('width depth  before (frames/s)  fused (frames/s)'
+          + ''.join(('  k=%d (frames/s)' % k) for k in [4, 16]))
+    for net_width, net_depth in [(32, 1), (64, 2), (128, 2), (256, 4)]:
+        options = bench_options(args.input_dim, args.target_dim,
+                                net_width, net_depth)
+        step_size = options['step_size']
+        frames = step_size * options['batch_size']
+        workspace = tempfile.mkdtemp()
+        try:
+            net = Net(options, workspace)
+            f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+            f_update  = net.compile_f_update_v_params()
+            f_step    = net.compile_f_train_step (release_grads = False)
+            f_steps   = net.compile_f_train_steps(release_grads = False)
+
+            mb = random_minibatch(options)
+            def separate():
+                loss = f_fwd_bwd(*(mb + (step_size,)))
+                np.asscalar(loss[0])
+                f_update(lr)
+            fps = [timed(separate, frames),
+                   timed(lambda: f_step(*(mb + (step_size, lr))), frames)]
+            for k in [4, 16]:
+                mbs = random_minibatch(options, k)
+                fps.append(timed(lambda: f_steps(*(mbs + (step_size, lr))),
+                                 k * frames))
+        finally:
+            shutil.rmtree(workspace)
+
+        print(str(net_width).rjust(5) + str(net_depth).rjust(6)
+              + ('%.3g' % fps[0]).rjust(19) + ('%.3g' % fps[1]).rjust(18)
+              + ''.join(('%.3g' % f).rjust(16) for f in fps[2 :]))
+
+def bench_parallel(args):
+    from net import Net
+    from parallel import DataParallel, train_steps
+
+    def make_data_iter(options, n_procs, rank):
+        return DataIter(list_file   = args.data_dir + '/train.list',
+                        window_size = options['window_size'],
+                        step_size   = options['step_size'],
+                        batch_size  = options['batch_size'] // n_procs,
+                        input_dim   = options['input_dim'],
+                        target_dim  = options['target_dim'],
+                        id_idx      = build_id_idx(args.data_dir
+                                                   + '/train.list'),
+                        shard       = (rank, n_procs))
+
+    lr = np.float32(1e-5)
+    n_steps = 8
+
+    def measure(n_procs, batch_size):
+        options = bench_options(args.input_dim, args.target_dim, 128, 2,
+                                batch_size = batch_size)
+        frames = n_steps * options['step_size'] * options['batch_size']
+        workspace = tempfile.mkdtemp()
+        dp = None
+        try:
+            net = Net(options, workspace, None, None, n_procs)
+            if n_procs > 1:
+                dp = DataParallel(n_procs,
+                                  lambda rank: Net(options, workspace, None,
+                                                   None, n_procs,
+                                                   workspace = False),
+                                  lambda rank: make_data_iter(options,
+                                                              n_procs, rank),
+                                  net.n_weights())
+            data_iter = make_data_iter(options, n_procs, 0)
+            f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+            f_update  = net.compile_f_update_v_params()
+            net.compile_f_initialize_optimizer()()
+
+            def train():
+                if dp is None:
+                    train_steps(0, net, data_iter, f_fwd_bwd, f_update,
+                                None, lr, n_steps, options['step_size'],
+                                False)
+                else:
+                    dp.train(net, data_iter, f_fwd_bwd, f_update, lr,
+                             n_steps, options['step_size'], False)
+            if dp is not None:
+                dp.wait_ready()
+                dp.set_params(net.get_params())
+                dp.initialize_optimizer()
+            train() # warm up
+            n_calls = 0
+            start = time.time()
+            while time.time() - start < args.seconds:
+                train()
+                n_calls += 1
+            return n_calls * frames / (time.time() - start)
+        finally:
+            if dp is not None:
+                dp.close()
+            shutil.rmtree(workspace)
+
+    counts = [1]
+    while counts[-1] * 2 <= mp.cpu_count():
+        counts.append(counts[-1] * 2)
+    total = 16 * counts[-1]
+
+    # weak: 16 columns per process (batch_size grows with processes)
+    # strong: batch_size fixed at total, split over processes (as --workers)
+    print('          weak (16 per process)   strong (batch_size %d)' % total)
+    print('procs  frames/s  efficiency      frames/s  speedup')
+    for n_procs in counts:
+        fps_weak   = measure(n_procs, 16 * n_procs)
+        fps_strong = measure(n_procs, total)
+        if n_procs == 1:
+            fps_weak_1, fps_strong_1 = fps_weak, fps_strong
+        print(str(n_procs).rjust(5) + ('%.3g' % fps_weak).rjust(10)
+              + ('%.2f' % (fps_weak / (n_procs * fps_weak_1))).rjust(12)
+              + ('%.3g' % fps_strong).rjust(14)
+              + ('%.2f' % (fps_strong / fps_strong_1)).rjust(9))
+
+def bench_ps(args):
+    from net import Net
+    from parallel import ParamServer, ps_work
+
+    address = 'tcp://127.0.0.1:%d' % args.port
+    lr = np.float32(1e-5)
+    n_steps = 64
+    print('workers  throughput & staleness histogram (staleness:count)')
+    counts = [1]
+    while counts[-1] * 2 < mp.cpu_count(): # (one core for server)
+        counts.append(counts[-1] * 2)
+    for n_workers in counts:
+        options = bench_options(args.input_dim, args.target_dim, 128, 2)
+        workspace = tempfile.mkdtemp()
+
+        def work(rank):
+            net = Net(options, workspace, workspace = False)
+            data_iter = DataIter \
+                (list_file   = args.data_dir + '/train.list',
+                 window_size = options['window_size'],
+                 step_size   = options['step_size'],
+                 batch_size  = options['batch_size'],
+                 input_dim   = options['input_dim'],
+                 target_dim  = options['target_dim'],
+                 id_idx      = build_id_idx(args.data_dir + '/train.list'),
+                 shard       = (rank, n_workers))
+            ps_work(address, net, data_iter,
+                    net.compile_f_fwd_bwd_propagate(), options['step_size'])
+
+        # workers are forked before compiling in this process
+        procs = [mp.Process(target = work, args = (rank,))
+                 for rank in range(n_workers)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        try:
+            net = Net(options, workspace)
+            f_update = net.compile_f_update_v_params()
+            net.compile_f_initialize_optimizer()()
+            ps = ParamServer(address, net, f_update, n_workers,
+                             args.max_staleness)
+
+            ps.serve(lr, n_workers) # warm up (waits for workers to compile)
+            ps.reset_stats()
+            start = time.time()
+            while time.time() - start < args.seconds:
+                ps.serve(lr, n_steps, False)
+            ps.stop()
+            for proc in procs:
+                proc.join()
+        finally:
+            shutil.rmtree(workspace)
+
+        print(str(n_workers).rjust(7) + '  ' + ps.summary())
+
+def bench_unroll(args):
+    import sys
+    import net as net_module
+    from net import Net
+    from utils import FunctionCache
+
+    lr = np.float32(1e-5)
+    print('width depth  unroll  compile (s)  frames/s')
+    for net_width, net_depth in [(64, 2), (256, 2)]:
+        for k in [1, 2, 4, 8, 16, 32, 'full']:
+            options = bench_options(args.input_dim, args.target_dim,
+                                    net_width, net_depth,
+                                    window_size = 128, step_size = 64)
+            if k == 'full':
+                options['unroll_scan'] = True
+                sys.setrecursionlimit(max(sys.getrecursionlimit(),
+                                          32 * options['window_size']))
+            else:
+                options['unroll_factor'] = k
+            step_size = options['step_size']
+            frames = step_size * options['batch_size']
+
+            workspace = tempfile.mkdtemp()
+            cache_dir = tempfile.mkdtemp()
+            saved_cache = net_module.function_cache
+            net_module.function_cache = FunctionCache(cache_dir) # fresh
+            try:
+                start = time.time()
+                net = Net(options, workspace)
+                f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+                f_update  = net.compile_f_update_v_params()
+                compile_time = time.time() - start
+
+                mb = random_minibatch(options)
+                def train():
+                    f_fwd_bwd(*(mb + (step_size,)))
+                    f_update(lr)
+                train() # warm up
+                n_calls = 0
+                start = time.time()
+                while time.time() - start < args.seconds:
+                    train()
+                    n_calls += 1
+                fps = n_calls * frames / (time.time() - start)
+            finally:
+                net_module.function_cache = saved_cache
+                shutil.rmtree(workspace)
+                shutil.rmtree(cache_dir)
+
+            print(str(net_width).rjust(5) + str(net_depth).rjust(6)
+                  + str(k).rjust(8) + ('%.1f' % compile_time).rjust(13)
+                  + ('%.3g' % fps).rjust(10))
+
+def _proc_status_mb(field):
+    """
+    Given field (e.g., 'VmRSS') of /proc/self/status in MB (Linux)
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024. # kB
+    raise KeyError(field)
+
+def bench_checkpoint(args):
+    from net import Net
+    from parallel import fork_map
+
+    lr = np.float32(1e-5)
+
+    def run(k): # (in a forked process, so that peaks do not add up)
+        options = bench_options(args.input_dim, args.target_dim, 256, 8,
+                                window_size = 256, step_size = 128)
+        if k is not None:
+            options['checkpoint_layers'] = k
+        step_size = options['step_size']
+        frames = step_size * options['batch_size']
+        workspace = tempfile.mkdtemp()
+        try:
+            net = Net(options, workspace)
+            f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+            f_update  = net.compile_f_update_v_params()
+
+            mb = random_minibatch(options)
+            def train():
+                f_fwd_bwd(*(mb + (step_size,)))
+                f_update(lr)
+
+            base = _proc_status_mb('VmRSS')
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5') # reset peak (VmHWM) to current RSS
+            train() # warm up
+            n_calls = 0
+            start = time.time()
+            while time.time() - start < args.seconds:
+                train()
+                n_calls += 1
+            fps = n_calls * frames / (time.time() - start)
+            return _proc_status_mb('VmHWM') - base, fps
+        finally:
+            shutil.rmtree(workspace)
+
+    print('checkpoint_layers  peak memory (MB)  frames/s  step time')
+    for k in [None, 1, 2, 4]:
+        peak, fps = fork_map(run, [k])[0]
+        if k is None:
+            fps_off = fps
+        print(str(k if k is not None else 'off').rjust(17)
+              + ('%.1f' % peak).rjust(18) + ('%.3g' % fps).rjust(10)
+              + ('%.2fx' % (fps_off / fps)).rjust(11))
+
+def bench_micro(args):
+    from net import Net
+    from parallel import fork_map
+
+    lr = np.float32(1e-3)
+    n_steps = 4
+
+    def run(n_micro): # (in a forked process, so that peaks do not add up)
+        options = bench_options(args.input_dim, args.target_dim, 256, 4,
+                                batch_size = 64, window_size = 256,
+                                step_size = 128)
+        options['grad_norm_clip'] = 0.01 # small enough to clip every step
+        if n_micro > 1:
+            options['micro_batches'] = n_micro
+        step_size = options['step_size']
+        m = options['batch_size'] // n_micro
+        workspace = tempfile.mkdtemp()
+        try:
+            np.random.seed(0) # same initial parameters for all n_micro
+            net = Net(options, workspace)
+            f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+            f_update  = net.compile_f_update_v_params()
+            net.compile_f_initialize_optimizer()()
+
+            np.random.seed(1) # same data (consecutive windows)
+            mbs = []
+            for k in range(n_steps):
+                mb = random_minibatch(options)
+                mbs.append(mb[: 2] + (mb[2] + k * step_size,) + mb[3 :])
+
+            base = _proc_status_mb('VmRSS')
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5') # reset peak (VmHWM) to current RSS
+            losses = []
+            for mb in mbs:
+                if n_micro == 1:
+                    losses.append(f_fwd_bwd(*(mb + (step_size,)))[1])
+                else: # columns of micro-batch j (as in train.py)
+                    losses.append(np.concatenate
+                        ([f_fwd_bwd(*([x[:, j * m : (j + 1) * m] for x in mb]
+                                      + [step_size, j]))[1]
+                          for j in range(n_micro)]))
+                f_update(lr)
+            peak = _proc_status_mb('VmHWM') - base
+            return (peak, np.array(losses), list(net.get_params().values()),
+                    net.get_prev_states()[0])
+        finally:
+            shutil.rmtree(workspace)
+
+    max_diff = lambda xs, ys: max(float(np.max(np.abs(x - y)))
+                                  for x, y in zip(xs, ys))
+    print('micro_batches  peak memory (MB)  max diff: loss_b  params'
+          '  prev_states')
+    ref = None
+    for n_micro in [1, 2, 4]:
+        peak, losses, params, prev_states = fork_map(run, [n_micro])[0]
+        if ref is None:
+            ref = losses, params, prev_states
+        print(str(n_micro).rjust(13) + ('%.1f' % peak).rjust(18)
+              + ('%.3g' % max_diff([losses], [ref[0]])).rjust(16)
+              + ('%.3g' % max_diff(params, ref[1])).rjust(8)
+              + ('%.3g' % max_diff(prev_states, ref[2])).rjust(13))
+
+def bench_wavefront(args):
+    from net import Net
+
+    lr = np.float32(1e-5)
+    print('batch  frames/s (before)  frames/s (after)  max loss diff')
+    for batch_size in [1, 4, 16]:
+        fpss, losses = [], []
+        params = None
+        for wavefront in [False, True]:
+            options = bench_options(args.input_dim, args.target_dim, 64, 4,
+                                    batch_size = batch_size,
+                                    window_size = 64, step_size = 32)
+            if wavefront:
+                options['wavefront'] = True
+            step_size = options['step_size']
+            frames = step_size * batch_size
+
+            workspace = tempfile.mkdtemp()
+            try:
+                net = Net(options, workspace)
+                if params is None:
+                    params = net.get_params()
+                else:
+                    net.set_params(params)
+                f_fwd_bwd = net.compile_f_fwd_bwd_propagate()
+                f_update  = net.compile_f_update_v_params()
+
+                np.random.seed(0)
+                mbs = [random_minibatch(options) for _ in range(4)]
+                losses.append([np.asscalar(f_fwd_bwd(*(mb + (step_size,)))[0])
+                               for mb in mbs])
+
+                mb = mbs[0]
+                def train():
+                    f_fwd_bwd(*(mb + (step_size,)))
+                    f_update(lr)
+                train() # warm up
+                n_calls = 0
+                start = time.time()
+                while time.time() - start < args.seconds:
+                    train()
+                    n_calls += 1
+                fpss.append(n_calls * frames / (time.time() - start))
+            finally:
+                shutil.rmtree(workspace)
+
+        diff = np.max(np.abs(np.array(losses[0]) - np.array(losses[1])))
+        print(str(batch_size).rjust(5) + ('%.3g' % fpss[0]).rjust(19)
+              + ('%.3g' % fpss[1]).rjust(18) + ('%.3g' % diff).rjust(15))
+
+def bench_latency(args):
+    import sys
+    from net import Net
+    from ensemble import Ensemble
+
+    def make_workspace(unit_type):
+        options = bench_options(args.input_dim, args.target_dim, 64, 2,
+                                window_size = 32, step_size = 16)
+        options['unit_type']          = unit_type
+        options['weight_norm']        = True
+        options['layer_norm']         = True
+        options['learn_id_embedding'] = True
+        options['id_count']           = 4
+        options['id_embedding_dim']   = 8
+        options['learn_clock_params'] = True
+        options['clock_t_exp_lo']     = 1.
+        options['clock_t_exp_hi']     = 6.
+        options['clock_r_on']         = 0.2
+        options['clock_leak_rate']    = 0.001
+        workspace = tempfile.mkdtemp()
+        net = Net(options, workspace)
+        # perturb so that layer norm, init states, etc. are not trivial
+        net.set_params(dict((k, v + 0.1 * np.random.randn(*v.shape)
+                                          .astype('float32'))
+                            for k, v in net.get_params().items()))
+        net.save_to_workspace()
+        net.wait_for_workspace()
+        return workspace
+
+    def run(workspace, batch_size, engine, inputs):
+        start = time.time()
+        ensemble = Ensemble([workspace], batch_size,
+                            [[b % 4 for b in range(batch_size)]],
+                            engine = engine)
+        startup = time.time() - start
+
+        outputs = [ensemble.run_one_step(inp) for inp in inputs]
+        ensemble.reset()
+        latencies = []
+        start = time.time()
+        while time.time() - start < args.seconds:
+            for inp in inputs:
+                t = time.time()
+                ensemble.run_one_step(inp)
+                latencies.append(time.time() - t)
+        return startup, np.array(latencies) * 1e6, np.array(outputs)
+
+    print('unit  batch  engine  startup (s)  median (us)  p99 (us)'
+          '  max output diff')
+    ok = True
+    for unit_type in ['lstm', 'gru']:
+        workspace = make_workspace(unit_type)
+        try:
+            for batch_size in [1, 16]:
+                inputs = [np.random.randn(batch_size * args.input_dim)
+                            .astype('float32') for _ in range(64)]
+                results = [run(workspace, batch_size, engine, inputs)
+                           for engine in ['theano', 'numpy']]
+                diff = np.max(np.abs(results[0][2] - results[1][2]))
+                ok = ok and diff <= 1e-5
+                for engine, (startup, latencies, _) in \
+                        zip(['theano', 'numpy'], results):
+                    print(unit_type.ljust(4) + str(batch_size).rjust(7)
+                          + engine.rjust(8) + ('%.2f' % startup).rjust(13)
+                          + ('%.1f' % np.median(latencies)).rjust(13)
+                          + ('%.1f' % np.percentile(latencies, 99)).rjust(10)
+                          + ('%.3g' % diff).rjust(17)
+                          + ('' if diff <= 1e-5 else ' FAIL'))
+        finally:
+            shutil.rmtree(workspace)
+
+    if not ok:
+        print('NumPy engine outputs differ from Theano by more than 1e-5 :'
+              ' FAILED')
+        sys.exit(1)
+
+def bench_workers(args):
+    import subprocess
+    import sys
+    import threading
+
+    # train.py copies these from data_dir (identity whitening)
+    for name, mat in [('mean', np.zeros(args.input_dim)),
+                      ('whitening', np.eye(args.input_dim))]:
+        file_name = args.data_dir + '/' + name + '.matrix'
+        if not os.path.isfile(file_name):
+            write_matrix(file_name, mat)
+
+    workspace = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['THEANO_FLAGS'] = 'device=cpu,floatX=float32' \
+                          + (',' + env['THEANO_FLAGS']
+                             if 'THEANO_FLAGS' in env else '')
+    proc = subprocess.Popen([sys.executable, '-u', 'train.py',
+                             '--data_dir=' + args.data_dir,
+                             '--save_to=' + workspace, '--workers=2'],
+                            cwd = os.path.dirname(os.path.abspath(__file__)),
+                            env = env, stdout = subprocess.PIPE,
+                            stderr = subprocess.STDOUT,
+                            universal_newlines = True)
+    timer = threading.Timer(args.timeout, proc.kill)
+    timer.start()
+    lines = []
+    started = False
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            lines.append(line)
+            if line.startswith('Waiting for worker processes'): # (done)
+                started = True
+                time.sleep(args.seconds) # training in all processes
+                break
+        ok = started and proc.poll() is None
+    finally:
+        timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        shutil.rmtree(workspace)
+
+    if ok:
+        print('train.py --workers=2 : OK (trained for %.1f sec)'
+              % args.seconds)
+    else:
+        print(''.join(lines[-20 :]), end = '')
+        print('train.py --workers=2 : FAILED')
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type = str,
+                        choices = ['data', 'formats', 'steps',
+                                   'parallel', 'ps', 'unroll',
+                                   'checkpoint', 'micro', 'wavefront',
+                                   'latency', 'workers'])
+    parser.add_argument('--data_dir'  , type = str)
+    parser.add_argument('--input_dim' , type = int, default = 44)
+    parser.add_argument('--target_dim', type = int, default = 1)
+    parser.add_argument('--packed'    , action = 'store_true')
+    parser.add_argument('--seconds'   , type = float, default = 2.)
+    parser.add_argument('--port'      , type = int, default = 5555)
+    parser.add_argument('--max_staleness', type = int, default = 4)
+    parser.add_argument('--timeout'   , type = float, default = 3600.)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.data_dir is None and args.command in ['data', 'formats',
+                                                   'parallel', 'ps',
+                                                   'workers']:
+        tmp_dir = tempfile.mkdtemp()
+        make_synthetic(tmp_dir, args.input_dim, args.target_dim)
+        args.data_dir = tmp_dir
+
+    try:
+        if args.command == 'data':
+            bench_data(args)
+        if args.command == 'formats':
+            bench_formats(args)
+        if args.command == 'steps':
+            bench_steps(args)
+        if args.command == 'parallel':
+            bench_parallel(args)
+        if args.command == 'ps':
+            bench_ps(args)
+        if args.command == 'unroll':
+            bench_unroll(args)
+        if args.command == 'checkpoint':
+            bench_checkpoint(args)
+        if args.command == 'micro':
+            bench_micro(args)
+        if args.command == 'wavefront':
+            bench_wavefront(args)
+        if args.command == 'latency':
+            bench_latency(args)
+        if args.command == 'workers':
+            bench_workers(args)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
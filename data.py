@@ -38,9 +38,31 @@ Iterator class for time slices of shuffled sequence minibatches
   randomly shuffled in 1-th (batch) dimension
 - Call discard_unfinished to use new sequences next iteration
 - Unless stopped explicitly inside the loop, iterates indefinitely
+- If exact_pass, each pass covers every sequence exactly once in list order;
+  batch columns that run dry are padded with time = -1. (to be masked from
+  loss), and StopIteration is raised at the end of each pass (iterating
+  again starts the next pass)
+
+- If packed, sequences are served from memory-mapped views of the files
+  written by pack_list (see prepare.py) instead of individual file reads;
+  data is copied only once, into the minibatch buffers, and the page cache
+  copy of a packed dataset is shared among all training instances
+- Wrap in Prefetcher to assemble minibatches in a background thread
+- If whiten = (mean, whitening) is given, inputs are served as
+      (input - mean) . whitening
+  computed with one matrix product per minibatch (see whitening_matrices)
+- If sample_temp is given, sequences are drawn by a LossSampler (with
+  sample_temp, sample_floor) from running losses reported via record_loss,
+  instead of from random permutations
+- If cache_bytes > 0, sequences read from files are kept in an LRU cache of
+  that many bytes across epochs; if pin_all, the whole set is read once and
+  kept in memory (e.g., for the dev set, which is re-read every epoch)
+- materialize collects all minibatches of one exact pass into memory, for
+  evaluating on the same minibatches every epoch without assembling them
 
 - Time starts at 0. and increases by 1. each time index
 - For recurrent layers with states, time <= 0. signals state reset
+- Time < 0. marks padding (no data) to be excluded from loss
 
 - Upon each iteration, 
     - Previous arrays are shifted by step_size to the left in time dimension
@@ -54,9 +76,14 @@ Iterator class for time slices of shuffled sequence minibatches
 
 from __future__ import absolute_import, division, print_function
 from six import Iterator # allow __next__ in Python 2
+from six.moves import queue
 
 import numpy as np
 from collections import OrderedDict
+import os
+import multiprocessing as mp
+import threading
+import time
 
 def seq_to_id(seq):
     # 'date/id' format
@@ -66,7 +93,12 @@ def build_id_idx(list_file):
     """
     This needs to be saved and used for inference as well
         id_idx['sequence id'] = one-hot encoding index
+    Uses the index written by index_list if it is up to date
     """
+    index = load_index(list_file)
+    if index is not None:
+        return OrderedDict((_id, i) for i, _id in enumerate(index['ids']))
+
     id_idx = OrderedDict()
     with open(list_file) as f:
         for seq in f:
@@ -75,20 +107,502 @@ def build_id_idx(list_file):
                 id_idx[_id] = len(id_idx)
     return id_idx
 
-def read_ti(file_name, dim):
+def read_ti(file_name, dim, dtype = '<f4'):
     """
-    Return value shape [seq_len][dim]
+    Return value shape [seq_len][dim] (in native byte order of dtype)
     """
     # dtype '<f4' is little endian, float, 4 bytes
-    return np.fromfile(file_name, dtype = '<f4') \
-             .reshape((-1, dim)).astype('float32')
+    return np.fromfile(file_name, dtype = dtype) \
+             .reshape((-1, dim)).astype(np.dtype(dtype).type)
+
+def list_base(list_file):
+    # 'dir/train.list' -> 'dir/train'
+    return list_file[: list_file.rfind('.')] if '.' in list_file else list_file
+
+def _seq_lengths(args):
+    # time lengths of a chunk of sequences from file sizes (for index_list)
+    data_root, seqs, input_dim, target_dim = args
+    return [(os.path.getsize(data_root + seq + '.input' ) // (4 * input_dim ),
+             os.path.getsize(data_root + seq + '.target') // (4 * target_dim))
+            for seq in seqs]
+
+def index_list(list_file, input_dim, target_dim, n_procs = None):
+    """
+    Index all sequences in list_file in one streaming pass (over file sizes,
+    in parallel over n_procs processes; None for all cores) and save
+        seqs            str     [n_seqs]    (list entries)
+        lengths         int64   [n_seqs]    (time lengths)
+        ids             str     [n_ids ]    (unique IDs in id_idx order)
+        input_dim, target_dim
+        list_size, list_mtime               (to detect outdated index)
+    to <list_base>.index.npz, to be loaded with load_index
+    Returns the index as a dict
+    """
+    data_root = list_file[: list_file.rfind('/') + 1] # includes /
+    with open(list_file) as f:
+        seqs = [line.strip() for line in f]
+    assert len(seqs) > 0, 'Empty list file'
+
+    n_procs = n_procs if n_procs is not None else mp.cpu_count()
+    chunk = max(1, min(4096, len(seqs) // (8 * n_procs)))
+    chunks = [(data_root, seqs[i : i + chunk], input_dim, target_dim)
+              for i in range(0, len(seqs), chunk)]
+    if n_procs > 1:
+        pool = mp.Pool(n_procs)
+        results = pool.map(_seq_lengths, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = [_seq_lengths(c) for c in chunks]
+
+    lengths = np.zeros(len(seqs), dtype = 'int64')
+    i = 0
+    for result in results:
+        for n_i, n_t in result:
+            assert n_i == n_t, 'Mismatching time lengths in ' + seqs[i]
+            lengths[i] = n_i
+            i += 1
+
+    ids = OrderedDict()
+    for seq in seqs:
+        ids.setdefault(seq_to_id(seq), None)
+
+    st = os.stat(list_file)
+    index = dict(seqs = np.array(seqs), lengths = lengths,
+                 ids = np.array(list(ids)),
+                 input_dim = input_dim, target_dim = target_dim,
+                 list_size = st.st_size, list_mtime = st.st_mtime)
+    np.savez(list_base(list_file) + '.index.npz', **index)
+    return index
+
+def load_index(list_file):
+    """
+    Return the index saved by index_list as a dict, or None if it does not
+    exist or is outdated (list_file changed since indexing)
+    """
+    index_file = list_base(list_file) + '.index.npz'
+    if not os.path.isfile(index_file):
+        return None
+    st = os.stat(list_file)
+    with np.load(index_file) as f:
+        index = dict((k, f[k]) for k in f.files)
+    if int(index['list_size']) != st.st_size or \
+       float(index['list_mtime']) != st.st_mtime:
+        return None
+    return index
+
+# On-disk formats of .input/.target files : (dtype, file name suffix)
+FORMATS = OrderedDict([('float32', ('<f4', ''    )),
+                       ('float16', ('<f2', '.f16')),
+                       ('int16'  , ('<i2', '.q16')),
+                       ('int8'   , ('i1' , '.q8' ))])
+
+class SeqFormat():
+    def __init__(self, list_file, name = 'float32'):
+        """
+        On-disk format of sequences listed in list_file
+            'float32'       little endian float32 (original .input/.target)
+            'float16'       little endian float16 (.input.f16/.target.f16)
+            'int16'/'int8'  per-dimension scaled integers
+                            (.input.q16/.target.q16, .input.q8/.target.q8)
+                            decoded as x = q * scale + bias
+        Files other than float32 are made by convert_list, which also writes
+        the sidecar file <list_base>.<name>.npz describing them
+        """
+        assert name in FORMATS, 'Invalid sequence format ' + name
+        self.name = name
+        self.dtype, self.suffix = FORMATS[name]
+        self.scales = { '.input' : None, '.target' : None }
+        self.biases = { '.input' : None, '.target' : None }
+
+        if name != 'float32':
+            sidecar = np.load(list_base(list_file) + '.' + name + '.npz')
+            assert str(sidecar['name']) == name
+            if bool(sidecar['scaled']):
+                for ext in ['.input', '.target']:
+                    self.scales[ext] = sidecar[ext[1 :] + '_scale']
+                    self.biases[ext] = sidecar[ext[1 :] + '_bias' ]
+
+    def itemsize(self):
+        return np.dtype(self.dtype).itemsize
+
+    def read(self, data, ext, dim):
+        """
+        Return raw (not decoded) [seq_len][dim] of data + ext
+        """
+        return read_ti(data + ext + self.suffix, dim, self.dtype)
+
+    def decode(self, dst, src, ext):
+        """
+        dst (float32) <- src (raw) decoded
+        """
+        dst[...] = src
+        if self.scales[ext] is not None:
+            dst *= self.scales[ext]
+            dst += self.biases[ext]
+
+def convert_list(list_file, input_dim, target_dim, name):
+    """
+    Write all sequences in list_file (float32) in the given format with a
+    sidecar file (see SeqFormat); int formats are scaled per dimension to
+    cover [min, max] of the whole list
+    Returns OrderedDict of accuracy/size stats
+    """
+    assert name != 'float32'
+    dtype, suffix = FORMATS[name]
+    data_root = list_file[: list_file.rfind('/') + 1] # includes /
+    with open(list_file) as f:
+        seqs = [line.strip() for line in f]
+    assert len(seqs) > 0, 'Empty list file'
+    dims = OrderedDict([('.input', input_dim), ('.target', target_dim)])
+
+    scaled = np.dtype(dtype).kind == 'i'
+    scales = OrderedDict()
+    biases = OrderedDict()
+    if scaled: # 1st pass for per-dimension ranges
+        q_max = np.iinfo(np.dtype(dtype)).max
+        for ext, dim in dims.items():
+            lo = np.full(dim,  np.inf, dtype = 'float64')
+            hi = np.full(dim, -np.inf, dtype = 'float64')
+            for seq in seqs:
+                x = read_ti(data_root + seq + ext, dim)
+                if x.shape[0] > 0:
+                    lo = np.minimum(lo, x.min(0))
+                    hi = np.maximum(hi, x.max(0))
+            lo[np.isinf(lo)] = 0.
+            hi[np.isinf(hi)] = 0.
+            scales[ext] = np.where(hi > lo, (hi - lo) / (2. * q_max), 1.) \
+                            .astype('float32')
+            biases[ext] = ((hi + lo) / 2.).astype('float32')
+
+    sq_err  = OrderedDict((ext, 0.) for ext in dims)
+    sq_sum  = OrderedDict((ext, 0.) for ext in dims)
+    max_err = OrderedDict((ext, 0.) for ext in dims)
+    n_vals  = OrderedDict((ext, 0 ) for ext in dims)
+    for seq in seqs:
+        for ext, dim in dims.items():
+            x = read_ti(data_root + seq + ext, dim)
+            if scaled:
+                q = np.clip(np.round((x - biases[ext]) / scales[ext]),
+                            -q_max, q_max).astype(dtype)
+                y = q * scales[ext] + biases[ext]
+            else:
+                q = x.astype(dtype)
+                y = q.astype('float32')
+            q.tofile(data_root + seq + ext + suffix)
+
+            err = (y - x).astype('float64')
+            sq_err [ext] += np.sum(np.square(err))
+            sq_sum [ext] += np.sum(np.square(x.astype('float64')))
+            max_err[ext]  = max(max_err[ext],
+                                np.max(np.abs(err)) if err.size > 0 else 0.)
+            n_vals [ext] += x.size
+
+    np.savez(list_base(list_file) + '.' + name + '.npz',
+             name = name, scaled = scaled,
+             **dict((ext[1 :] + '_' + k, v[ext])
+                    for k, v in [('scale', scales), ('bias', biases)]
+                    for ext in v))
+
+    stats = OrderedDict()
+    for ext in dims:
+        n = max(n_vals[ext], 1)
+        stats[ext[1 :] + ' rms error'] = np.sqrt(sq_err[ext] / n)
+        stats[ext[1 :] + ' max error'] = max_err[ext]
+        stats[ext[1 :] + ' snr (dB)' ] = 10. * np.log10(sq_sum[ext]
+                                                  / max(sq_err[ext], 1e-30))
+    stats['size ratio'] = np.dtype(dtype).itemsize / 4.
+    return stats
+
+def read_matrix(file_name, shape):
+    # little endian float32, same layout as .input/.target files
+    return np.fromfile(file_name, dtype = '<f4').reshape(shape) \
+             .astype('float32')
+
+def write_matrix(file_name, mat):
+    mat.astype('<f4').tofile(file_name)
+
+def _seq_moments(args):
+    # count, mean, scatter of a chunk of sequences (for whitening_matrices)
+    data_root, seqs, input_dim = args
+    n, mean, m2 = 0, np.zeros(input_dim), np.zeros((input_dim, input_dim))
+    for seq in seqs:
+        x = read_ti(data_root + seq + '.input', input_dim).astype('float64')
+        n, mean, m2 = _merge_moments((n, mean, m2), _moments(x))
+    return n, mean, m2
+
+def _moments(x):
+    if x.shape[0] == 0:
+        return 0, np.zeros(x.shape[1]), np.zeros((x.shape[1], x.shape[1]))
+    mean = x.mean(0)
+    d = x - mean
+    return x.shape[0], mean, np.dot(d.T, d)
+
+def _merge_moments(a, b):
+    # pairwise update (Chan et al.), stable for large counts
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + np.outer(delta, delta) * (n_a * n_b / n)
+    return n, mean, m2
+
+def whitening_matrices(list_file, input_dim, n_procs = None, eps = 1e-5):
+    """
+    Compute mean & ZCA whitening matrix of all inputs in list_file in one
+    streaming pass (in parallel over n_procs processes; None for all cores)
+        mean        float32 [input_dim]
+        whitening   float32 [input_dim][input_dim] (symmetric)
+    such that (input - mean) . whitening has identity covariance
+    (eps regularizes near-zero variance directions)
+    """
+    data_root = list_file[: list_file.rfind('/') + 1] # includes /
+    with open(list_file) as f:
+        seqs = [line.strip() for line in f]
+    assert len(seqs) > 0, 'Empty list file'
+
+    n_procs = n_procs if n_procs is not None else mp.cpu_count()
+    chunk = max(1, min(256, len(seqs) // (8 * n_procs)))
+    chunks = [(data_root, seqs[i : i + chunk], input_dim)
+              for i in range(0, len(seqs), chunk)]
+    if n_procs > 1:
+        pool = mp.Pool(n_procs)
+        results = pool.map(_seq_moments, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = [_seq_moments(c) for c in chunks]
+
+    moments = results[0]
+    for result in results[1 :]:
+        moments = _merge_moments(moments, result)
+    n, mean, m2 = moments
+    assert n > 1, 'Not enough frames'
+
+    cov = m2 / (n - 1)
+    e, E = np.linalg.eigh(cov)
+    whitening = np.dot(E / np.sqrt(np.maximum(e, 0.) + eps), E.T)
+    return mean.astype('float32'), whitening.astype('float32')
+
+def pack_names(list_file, seq_format = 'float32'):
+    """
+    Return file names for packed data and its index
+        'dir/train.list' -> 'dir/train.pack', 'dir/train.pack.npz'
+    (or 'dir/train.<seq_format>.pack', ... if not float32)
+    """
+    base = list_base(list_file)
+    if seq_format != 'float32':
+        base += '.' + seq_format
+    return base + '.pack', base + '.pack.npz'
+
+def pack_list(list_file, input_dim, target_dim, seq_format = 'float32'):
+    """
+    Pack all sequences in list_file into one contiguous file of
+        input  block    [n_frames][input_dim ]
+        target block    [n_frames][target_dim]
+    (sequences back-to-back in list order, in on-disk format seq_format)
+    and an index of
+        seqs            str     [n_seqs]    (list entries)
+        offsets         int64   [n_seqs]    (frame offsets in each block)
+        lengths         int64   [n_seqs]    (time lengths)
+        input_dim, target_dim, seq_format
+    Returns total number of frames
+    """
+    fmt = SeqFormat(list_file, seq_format)
+    data_root = list_file[: list_file.rfind('/') + 1] # includes /
+    with open(list_file) as f:
+        seqs = [line.strip() for line in f]
+    assert len(seqs) > 0, 'Empty list file'
+
+    # time lengths from file sizes
+    lengths = np.zeros(len(seqs), dtype = 'int64')
+    for i, seq in enumerate(seqs):
+        n_i = os.path.getsize(data_root + seq + '.input'  + fmt.suffix) \
+              // (fmt.itemsize() * input_dim )
+        n_t = os.path.getsize(data_root + seq + '.target' + fmt.suffix) \
+              // (fmt.itemsize() * target_dim)
+        assert n_i == n_t, 'Mismatching time lengths in ' + seq
+        lengths[i] = n_i
+    offsets = np.concatenate([[0], np.cumsum(lengths)[: -1]]).astype('int64')
+    n_frames = int(lengths.sum())
+
+    data_file, index_file = pack_names(list_file, seq_format)
+    mm = np.memmap(data_file, dtype = fmt.dtype, mode = 'w+',
+                   shape = (n_frames * (input_dim + target_dim),))
+    input_fi  = mm[: n_frames * input_dim].reshape((n_frames, input_dim ))
+    target_fi = mm[n_frames * input_dim :].reshape((n_frames, target_dim))
+
+    for seq, o, n in zip(seqs, offsets, lengths):
+        input_fi [o : o + n] = fmt.read(data_root + seq, '.input' , input_dim )
+        target_fi[o : o + n] = fmt.read(data_root + seq, '.target', target_dim)
+    mm.flush()
+    del input_fi, target_fi, mm
+
+    np.savez(index_file, seqs = np.array(seqs), offsets = offsets,
+             lengths = lengths, input_dim = input_dim, target_dim = target_dim,
+             seq_format = seq_format)
+    return n_frames
+
+def open_pack(list_file, seq_format = 'float32'):
+    """
+    Return read-only memory-mapped views (no data is read until accessed)
+        input_fi, target_fi, index
+    of the files written by pack_list
+    """
+    data_file, index_file = pack_names(list_file, seq_format)
+    index = np.load(index_file)
+    n_frames   = int(index['lengths'].sum())
+    input_dim  = int(index['input_dim'])
+    target_dim = int(index['target_dim'])
+    assert str(index['seq_format']) == seq_format
+
+    mm = np.memmap(data_file, dtype = FORMATS[seq_format][0], mode = 'r')
+    assert mm.shape[0] == n_frames * (input_dim + target_dim), \
+           'Corrupt pack file ' + data_file
+    input_fi  = mm[: n_frames * input_dim].reshape((n_frames, input_dim ))
+    target_fi = mm[n_frames * input_dim :].reshape((n_frames, target_dim))
+    return input_fi, target_fi, index
+
+class SeqCache():
+    def __init__(self, max_bytes = None):
+        """
+        LRU cache of sequences as read from files, in the on-disk format
+        (e.g., float16 or int8 takes 1/2 or 1/4 of float32 bytes; decoded to
+        float32 on each hit as they are copied to lanes)
+            [max_bytes] int         evict least recently used beyond this
+                        NoneType    never evict
+        """
+        self._max_bytes = max_bytes
+        self._n_bytes   = 0
+        self._entries   = OrderedDict() # { key : (input, target) }, LRU first
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return cached (input, target) or None
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self._entries.pop(key) # re-insert as most recently used
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        n_bytes = sum(arr.nbytes for arr in value)
+        if key in self._entries: # replaced
+            self._n_bytes -= sum(arr.nbytes for arr in self._entries.pop(key))
+        if self._max_bytes is not None:
+            if n_bytes > self._max_bytes:
+                return # would evict everything else
+            while self._n_bytes + n_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last = False)
+                self._n_bytes -= sum(arr.nbytes for arr in evicted)
+                self.evictions += 1
+        self._entries[key] = value
+        self._n_bytes += n_bytes
+    
+    def n_bytes(self):
+        return self._n_bytes
+
+    def summary(self):
+        return ('%d hits, %d misses, %d evictions, %.1f MB'
+                % (self.hits, self.misses, self.evictions,
+                   self._n_bytes / 1024. / 1024.))
+
+class LossSampler():
+    def __init__(self, n_seqs, temperature = 1., floor = 0.1, decay = 0.9,
+                 block_size = 1024):
+        """
+        Importance sampler of sequence indices, drawn with probability
+            p_i = (1 - floor) w_i / sum_j w_j + floor / n_seqs
+            w_i = l_i ** (1 / temperature)
+        where l_i is the running (exponential moving) average with decay of
+        per-frame loss of sequence i
+        - temperature -> inf approaches uniform sampling
+        - Sequences not yet seen are given the largest running loss
+        - Draws are made block_size at a time from the probabilities at the
+          time of drawing (each block costs O(n_seqs))
+        """
+        assert temperature > 0. and 0. <= floor <= 1. and 0. <= decay < 1.
+        self._n_seqs      = n_seqs
+        self._temperature = temperature
+        self._floor       = floor
+        self._decay       = decay
+        self._block_size  = block_size
+
+        self._losses = np.zeros(n_seqs) # running losses
+        self._seen   = np.zeros(n_seqs, dtype = 'bool')
+        self._block  = np.zeros(0, dtype = 'int64')
+        self._pos    = 0
+
+    def probabilities(self):
+        losses = self._losses.copy()
+        if not self._seen.any():
+            return np.ones(self._n_seqs) / self._n_seqs
+        losses[~self._seen] = losses[self._seen].max()
+        w = np.maximum(losses, 1e-12) ** (1. / self._temperature)
+        return (1. - self._floor) * w / w.sum() + self._floor / self._n_seqs
+
+    def draw(self):
+        if self._pos >= self._block.shape[0]:
+            self._block = np.random.choice(self._n_seqs, self._block_size,
+                                           p = self.probabilities())
+            self._pos = 0
+        seq_idx = self._block[self._pos]
+        self._pos += 1
+        return seq_idx
+
+    def get_state(self):
+        return dict(losses = self._losses.copy(), seen = self._seen.copy(),
+                    block = self._block, pos = self._pos)
+
+    def set_state(self, state):
+        self._losses[...] = state['losses']
+        self._seen  [...] = state['seen']
+        self._block = state['block']
+        self._pos   = state['pos']
+
+    def update(self, seq_idxs, losses):
+        """
+        Update running losses of sequences seq_idxs with per-frame losses
+        """
+        for i, l in zip(seq_idxs, losses):
+            if self._seen[i]:
+                self._losses[i] = self._decay * self._losses[i] \
+                                  + (1. - self._decay) * l
+            else:
+                self._losses[i] = l
+                self._seen[i] = True
 
 class DataIter(Iterator):
     def __iter__(self):
         return self
 
     def __init__(self, list_file, window_size, step_size,
-                 batch_size, input_dim, target_dim, id_idx):
+                 batch_size, input_dim, target_dim, id_idx,
+                 packed = False, cache_bytes = 0, pin_all = False,
+                 seq_format = 'float32', whiten = None, exact_pass = False,
+                 sample_temp = None, sample_floor = 0.1, shard = None):
+        """
+            [packed]        bool    read from files written by pack_list
+            [seq_format]    str     on-disk format (see SeqFormat)
+            [whiten]        tuple   (mean [input_dim],
+                                     whitening [input_dim][input_dim])
+            [exact_pass]    bool    iterate over exact passes (see above)
+            [sample_temp]   float   temperature of LossSampler
+            [sample_floor]  float   uniform floor of LossSampler
+            [shard]         tuple   (rank, n_shards) to iterate over every
+                                    n_shards-th sequence from rank only
+            [cache_bytes]   int     byte budget of LRU cache (0 to disable)
+            [pin_all]       bool    read all sequences into memory up front
+        """
         self._data_root   = list_file[: list_file.rfind('/') + 1] # includes /
         self._window_size = window_size
         self.set_step_size(step_size)
@@ -107,84 +621,507 @@ class DataIter(Iterator):
         self._id_idx_tb  = np.zeros((window_size, batch_size)) \
                              .astype('int32')
         
-        # buffers for currently open files
-        # new files are read when time index reaches input.shape[0]
-        self._t_idxs  = batch_size * [0] # time index cursors in files
-        self._id_idxs = batch_size * [0] # id_idx values
-        self._inputs  = batch_size * [np.zeros((0, input_dim )) \
-                                        .astype('float32')]
-        self._targets = batch_size * [np.zeros((0, target_dim)) \
-                                        .astype('float32')]
-
-        self._seqs = []
-        with open(list_file) as f:
-            for line in f:
-                self._seqs.append(line.strip())
+        # cursors for currently open sequences (one per batch column)
+        # frame t of the sequence in column b is at _src_*[_offs[b] + t]
+        # for t < _ends[b]; a new sequence is opened when t reaches _lens[b]
+        self._t_idxs  = np.zeros(batch_size, dtype = 'int64') # time cursors
+        self._lens    = np.zeros(batch_size, dtype = 'int64') # time lengths
+        self._ends    = np.zeros(batch_size, dtype = 'int64') # end of source
+        self._offs    = np.zeros(batch_size, dtype = 'int64') # source offsets
+        self._id_idxs = np.zeros(batch_size, dtype = 'int32') # id_idx values
+        self._dry     = np.zeros(batch_size, dtype = 'bool' ) # (exact_pass)
+        self._seq_idxs = -np.ones(batch_size, dtype = 'int64') # seq indices
+        self._exact   = exact_pass
+
+        # input <- input . whitening + bias where bias = -mean . whitening
+        if whiten is not None:
+            mean, whitening = whiten
+            assert mean.shape == (input_dim,) and \
+                   whitening.shape == (input_dim, input_dim)
+            self._whitening = whitening.astype('float32')
+            self._whiten_bias = -np.dot(mean, whitening).astype('float32')
+            self._whiten_buf = np.zeros((window_size * batch_size,
+                                         input_dim)).astype('float32')
+        else:
+            self._whitening = None
+
+        # source indices for gathering, shared by input & target
+        self._src_tb = np.zeros((window_size, batch_size), dtype = 'int64')
+        self._arange = np.arange(window_size)
+
+        index = load_index(list_file)
+        if index is not None:
+            assert int(index['input_dim'] ) == input_dim and \
+                   int(index['target_dim']) == target_dim, \
+                   'Mismatching dimensions in index'
+            self._seqs = [str(seq) for seq in index['seqs']]
+        else:
+            self._seqs = []
+            with open(list_file) as f:
+                for line in f:
+                    self._seqs.append(line.strip())
         self._n_seqs = len(self._seqs)
         assert self._n_seqs > 0, 'Empty list file'
+
+        # sequence indices iterated over (sharded for data parallel)
+        rank, n_shards = shard if shard is not None else (0, 1)
+        assert 0 <= rank < n_shards and rank < self._n_seqs
+        self._shard_idxs = np.arange(rank, self._n_seqs, n_shards)
+
+        assert not (exact_pass and sample_temp is not None)
+        assert not (shard is not None and sample_temp is not None)
+        self.sampler = LossSampler(self._n_seqs, sample_temp, sample_floor) \
+                       if sample_temp is not None else None
+
+        # non-float32 data are decoded to float32 as they are copied from
+        # files to lanes or from packed files to minibatch buffers
+        self._format = SeqFormat(list_file, seq_format)
+        self._src_is_raw = packed and seq_format != 'float32'
+        if self._src_is_raw:
+            self._raw_input_tbi  = np.zeros((window_size, batch_size,
+                                             input_dim ), self._format.dtype)
+            self._raw_target_tbi = np.zeros((window_size, batch_size,
+                                             target_dim), self._format.dtype)
+        else:
+            self._raw_input_tbi  = None
+            self._raw_target_tbi = None
+
+        self._packed = packed
+        if packed:
+            self._pack_input, self._pack_target, pack_index = \
+                open_pack(list_file, seq_format)
+            assert int(pack_index['input_dim'] ) == input_dim and \
+                   int(pack_index['target_dim']) == target_dim, \
+                   'Mismatching dimensions in packed data'
+            assert list(pack_index['seqs']) == self._seqs, \
+                   'Packed data is out of date with list file'
+            self._pack_offsets = pack_index['offsets']
+            self._pack_lengths = pack_index['lengths']
+
+            self._src_input  = self._pack_input
+            self._src_target = self._pack_target
+        else:
+            # sequences read from files are staged into fixed size lanes
+            # (one per batch column) so that all columns share a source
+            self._lane_size = 4 * window_size
+            self._inputs  = batch_size * [None] # currently open sequences
+            self._targets = batch_size * [None]
+
+            self._src_input  = np.zeros((batch_size * self._lane_size,
+                                         input_dim )).astype('float32')
+            self._src_target = np.zeros((batch_size * self._lane_size,
+                                         target_dim)).astype('float32')
+
+        assert not (packed and (cache_bytes > 0 or pin_all)), \
+               'Packed data is cached by the OS (page cache)'
+        if pin_all:
+            self.cache = SeqCache()
+            for seq in self._seqs:
+                self.cache.put(self._data_root + seq, self._load(seq))
+        elif cache_bytes > 0:
+            self.cache = SeqCache(cache_bytes)
+        else:
+            self.cache = None
         
         self._shuffle()
 
     def _shuffle(self):
         self._seq_idx = 0
-        self._seq_order = np.random.permutation(self._n_seqs) # of np.arange(n)
+        self._seq_order = np.random.permutation(self._shard_idxs) \
+                          if not self._exact else self._shard_idxs
 
     def _pop_seq(self):
-        if self._seq_idx >= self._n_seqs:
+        if self.sampler is not None:
+            return self.sampler.draw()
+        if self._seq_idx >= len(self._seq_order):
+            if self._exact:
+                return None # end of pass
             self._shuffle()
-        seq = self._seqs[self._seq_order[self._seq_idx]]
+        seq_idx = self._seq_order[self._seq_idx]
         self._seq_idx += 1
-        return seq
+        return seq_idx
 
-    def _read(self, batch_idx):
-        seq  = self._pop_seq()
+    def _load(self, seq):
         data = self._data_root + seq
+        input_ti  = self._format.read(data, '.input' , self._input_dim )
+        target_ti = self._format.read(data, '.target', self._target_dim)
+        assert input_ti.shape[0] == target_ti.shape[0]
+        return input_ti, target_ti
+
+    def _read(self, batch_idx):
+        """
+        Open next sequence in batch column; return False if none (exact_pass)
+        """
+        seq_idx = self._pop_seq()
+        self._seq_idxs[batch_idx] = seq_idx if seq_idx is not None else -1
+        if seq_idx is None:
+            self._dry [batch_idx] = True
+            self._t_idxs[batch_idx] = 0
+            self._lens  [batch_idx] = 0
+            self._ends  [batch_idx] = 0
+            return False
+        seq     = self._seqs[seq_idx]
 
         self._t_idxs [batch_idx] = 0
         self._id_idxs[batch_idx] = self._id_idx[seq_to_id(seq)]
 
-        self._inputs [batch_idx] = read_ti(data + '.input' , self._input_dim )
-        self._targets[batch_idx] = read_ti(data + '.target', self._target_dim)
-        assert self._inputs[batch_idx].shape[0] \
-               == self._targets[batch_idx].shape[0]
+        if self._packed: # memory-mapped files as source (no copy)
+            self._offs[batch_idx] = self._pack_offsets[seq_idx]
+            self._lens[batch_idx] = self._pack_lengths[seq_idx]
+            self._ends[batch_idx] = self._lens[batch_idx]
+        else:
+            value = self.cache.get(self._data_root + seq) \
+                    if self.cache is not None else None
+            if value is None:
+                value = self._load(seq)
+                if self.cache is not None:
+                    self.cache.put(self._data_root + seq, value)
+            self._inputs[batch_idx], self._targets[batch_idx] = value
+            self._lens[batch_idx] = self._inputs[batch_idx].shape[0]
+            self._ends[batch_idx] = 0 # lane is filled on demand
+        return True
+
+    def _fill_lane(self, batch_idx):
+        """
+        Stage next lane_size frames of the open sequence into the lane
+        """
+        t    = self._t_idxs[batch_idx]
+        n    = min(self._lane_size, self._lens[batch_idx] - t)
+        base = batch_idx * self._lane_size
+
+        self._format.decode(self._src_input [base : base + n],
+                            self._inputs [batch_idx][t : t + n], '.input' )
+        self._format.decode(self._src_target[base : base + n],
+                            self._targets[batch_idx][t : t + n], '.target')
+        self._offs[batch_idx] = base - t
+        self._ends[batch_idx] = t + n
+
+    def _copy(self, dst, src, ext):
+        if self._src_is_raw:
+            self._format.decode(dst, src, ext)
+        else:
+            dst[...] = src
+
+    def _gather(self, dst, src, src_tb, raw, ext):
+        if self._src_is_raw:
+            raw = raw[: src_tb.shape[0]]
+            np.take(src, src_tb, axis = 0, mode = 'clip', out = raw)
+            self._format.decode(dst, raw, ext)
+        else:
+            np.take(src, src_tb, axis = 0, mode = 'clip', out = dst)
+
+    def _fill_column(self, batch_idx, cur):
+        """
+        Fill [cur, window_size) of a batch column segment by segment,
+        opening new sequences (or refilling lanes) at boundaries
+        """
+        b = batch_idx
+        while cur < self._window_size:
+            while self._t_idxs[b] >= self._ends[b]:
+                if self._t_idxs[b] < self._lens[b]:
+                    self._fill_lane(b)
+                elif self._dry[b] or not self._read(b):
+                    self._input_tbi [cur :, b] = 0.
+                    self._target_tbi[cur :, b] = 0.
+                    self._time_tb   [cur :, b] = -1.
+                    self._id_idx_tb [cur :, b] = 0
+                    return
+
+            t   = self._t_idxs[b]
+            inc = min(self._window_size - cur, self._ends[b] - t)
+            o   = self._offs[b] + t
+
+            self._copy(self._input_tbi [cur : cur + inc, b],
+                       self._src_input [o : o + inc], '.input' )
+            self._copy(self._target_tbi[cur : cur + inc, b],
+                       self._src_target[o : o + inc], '.target')
+            self._time_tb   [cur : cur + inc, b] = t + self._arange[: inc]
+            self._id_idx_tb [cur : cur + inc, b] = self._id_idxs[b]
+
+            cur += inc
+            self._t_idxs[b] += inc
 
     def discard_unfinished(self):
-        for b in range(self._batch_size):
-            if self._t_idxs[b] > 0:
-                self._t_idxs[b] = self._inputs[b].shape[0]
+        unfinished = self._t_idxs > 0
+        self._t_idxs[unfinished] = self._lens[unfinished]
 
     def set_step_size(self, step_size):
         assert self._window_size >= step_size
         self._step_size = step_size
 
+    _STATE_ARRAYS = ('_t_idxs', '_lens', '_ends', '_offs', '_id_idxs',
+                     '_dry', '_seq_idxs')
+    _STATE_BUFFERS = ('_input_tbi', '_target_tbi', '_time_tb', '_id_idx_tb')
+
+    def get_state(self, buffers = True):
+        """
+        Return a copy of iteration state (cursors, last minibatch buffers,
+        sequence order, sampler, and np.random's state), such that after
+        set_state the same minibatches follow as would have from here
+        (contents of cache and lanes are not included; they are reloaded)
+        """
+        state = dict((k, getattr(self, k).copy()) for k in self._STATE_ARRAYS)
+        if buffers:
+            state.update((k, getattr(self, k).copy())
+                         for k in self._STATE_BUFFERS)
+        state['seq_idx'     ] = self._seq_idx
+        state['seq_order'   ] = self._seq_order # replaced, never modified
+        state['step_size'   ] = self._step_size
+        state['random_state'] = np.random.get_state()
+        if self.sampler is not None:
+            state['sampler'] = self.sampler.get_state()
+        return state
+
+    def set_state(self, state):
+        for k in self._STATE_ARRAYS + self._STATE_BUFFERS:
+            getattr(self, k)[...] = state[k]
+        self._seq_idx   = state['seq_idx']
+        self._seq_order = state['seq_order']
+        self.set_step_size(state['step_size'])
+        np.random.set_state(state['random_state'])
+        if self.sampler is not None:
+            self.sampler.set_state(state['sampler'])
+
+        if not self._packed: # reopen sequences and refill lanes on demand
+            for b in range(self._batch_size):
+                self._inputs[b] = self._targets[b] = None
+                if self._seq_idxs[b] >= 0 and \
+                   self._t_idxs[b] < self._lens[b]:
+                    seq = self._seqs[self._seq_idxs[b]]
+                    value = self.cache.get(self._data_root + seq) \
+                            if self.cache is not None else None
+                    self._inputs[b], self._targets[b] = \
+                        value if value is not None else self._load(seq)
+                    self._ends[b] = self._t_idxs[b]
+
+    def record_loss(self, loss_b, time_tb = None, seq_idx_b = None):
+        """
+        Report loss per batch column (loss_b from the training propagator)
+        of the last minibatch to the sampler, attributed to the sequence open
+        in each column at the end of the minibatch
+        (time_tb, seq_idx_b default to those of the last minibatch)
+        """
+        if self.sampler is None:
+            return
+        time_tb   = time_tb   if time_tb   is not None else self._time_tb
+        seq_idx_b = seq_idx_b if seq_idx_b is not None else self._seq_idxs
+        n_b = np.count_nonzero(time_tb[-self._step_size :] >= 0., axis = 0)
+        valid = (n_b > 0) & (seq_idx_b >= 0)
+        self.sampler.update(seq_idx_b[valid], loss_b[valid] / n_b[valid])
+
     def __next__(self):
         def shift(arr, d): arr[: -d] = arr[d :]
 
-        shift(self._input_tbi , self._step_size)
-        shift(self._target_tbi, self._step_size)
-        shift(self._time_tb   , self._step_size)
-        shift(self._id_idx_tb , self._step_size)
-
-        for b in range(self._batch_size):
-            cur = self._window_size - self._step_size
-
-            while cur < self._window_size:
-                while self._t_idxs[b] >= self._inputs[b].shape[0]:
-                    self._read(b)
-                
-                inc = min(self._window_size - cur,
-                          self._inputs[b].shape[0] - self._t_idxs[b])
-                rng_b = range(cur, cur + inc)
-                rng_f = range(self._t_idxs[b], self._t_idxs[b] + inc)
-
-                self._input_tbi [rng_b, b, :] = self._inputs [b][rng_f, :]
-                self._target_tbi[rng_b, b, :] = self._targets[b][rng_f, :]
-                self._time_tb   [rng_b, b]    = np.array(rng_f) \
-                                                  .astype('float32')
-                self._id_idx_tb [rng_b, b]    = self._id_idxs[b]
-
-                cur += inc
-                self._t_idxs[b] += inc
+        if self._exact and self._seq_idx >= len(self._seq_order) \
+                       and np.all(self._t_idxs >= self._lens):
+            self._shuffle()
+            self._dry[:] = False
+            raise StopIteration
+
+        step = self._step_size
+        cur  = self._window_size - step
+
+        shift(self._input_tbi , step)
+        shift(self._target_tbi, step)
+        shift(self._time_tb   , step)
+        shift(self._id_idx_tb , step)
+
+        # columns that cross a source boundary within this step are
+        # overwritten afterwards (their gathered values here are irrelevant)
+        crossing = np.flatnonzero(self._ends - self._t_idxs < step)
+
+        # whole batch at once: one gather per tensor
+        src_tb = self._src_tb[: step]
+        np.add((self._offs + self._t_idxs)[None, :],
+               self._arange[: step, None], out = src_tb)
+        self._gather(self._input_tbi [cur :], self._src_input , src_tb,
+                     self._raw_input_tbi , '.input' )
+        self._gather(self._target_tbi[cur :], self._src_target, src_tb,
+                     self._raw_target_tbi, '.target')
+        np.add(self._t_idxs[None, :], self._arange[: step, None],
+               out = self._time_tb[cur :], casting = 'unsafe')
+        self._id_idx_tb[cur :] = self._id_idxs[None, :]
+        self._t_idxs += step
+
+        for b in crossing:
+            self._t_idxs[b] -= step
+            self._fill_column(b, cur)
+
+        if self._whitening is not None: # all new frames at once
+            new_fi = self._input_tbi[cur :].reshape((-1, self._input_dim))
+            buf_fi = self._whiten_buf[: new_fi.shape[0]]
+            np.dot(new_fi, self._whitening, out = buf_fi)
+            buf_fi += self._whiten_bias
+            new_fi[...] = buf_fi
         
         return self._input_tbi, self._target_tbi, \
                self._time_tb, self._id_idx_tb
+
+
+class Prefetcher(Iterator):
+    """
+    Wrapper that assembles the next n_ahead minibatches of a DataIter in a
+    background thread, into a ring of (n_ahead + 1) preallocated buffers
+
+    - Same interface as DataIter (use in place of the wrapped DataIter)
+    - Returned arrays are valid until the next call to __next__ (or to
+      discard_unfinished, set_step_size, set_state)
+    - discard_unfinished (and set_step_size with a new step_size) drops
+      minibatches that were prefetched but not yet returned, and discards
+      sequences unfinished in the wrapped DataIter; as all batch columns
+      start new sequences (time reset), this is equivalent to DataIter's
+      discard_unfinished
+    - wait_time accumulates seconds __next__ spent waiting for a minibatch
+    - StopIteration of the wrapped DataIter (exact_pass) is passed through
+      in order, and iteration continues with the next pass
+    - record_loss and get_state refer to the minibatch last returned by
+      __next__ (discard_unfinished/set_step_size invalidate it)
+    """
+    def __iter__(self):
+        return self
+
+    def __init__(self, data_iter, n_ahead = 2):
+        assert n_ahead > 0
+        self._data_iter = data_iter
+        self._step_size = data_iter._step_size
+
+        self._slots = [tuple(np.zeros_like(arr) for arr in
+                                (data_iter._input_tbi, data_iter._target_tbi,
+                                 data_iter._time_tb  , data_iter._id_idx_tb))
+                       for _ in range(n_ahead + 1)]
+        self._seq_idx_slots = [np.zeros_like(data_iter._seq_idxs)
+                               for _ in range(n_ahead + 1)] # for record_loss
+        self._state_slots = (n_ahead + 1) * [None] # for get_state
+        # get_state while no minibatch is held (initially, after discard,
+        # set_state, or StopIteration)
+        self._pending_state = data_iter.get_state()
+        self._free = queue.Queue() # slot indices ready to be filled
+        self._full = queue.Queue() # (slot index, generation, exception)
+        for i in range(n_ahead + 1):
+            self._free.put(i)
+        self._held = None          # slot index last returned by __next__
+
+        # minibatches assembled before the last discard are of old generation
+        self._lock = threading.Lock() # guards _data_iter & _generation
+        self._generation = 0
+
+        self.wait_time = 0.
+
+        self._thread = threading.Thread(target = self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            i = self._free.get()
+            if i is None:
+                return
+            try:
+                with self._lock: # (state & generation of the same DataIter)
+                    generation = self._generation
+                    try:
+                        mb = next(self._data_iter)
+                    except StopIteration as e: # end of pass (exact_pass)
+                        self._state_slots[i] = self._data_iter.get_state()
+                        self._full.put((i, generation, e))
+                        continue
+                    for dst, src in zip(self._slots[i], mb):
+                        dst[...] = src
+                    self._seq_idx_slots[i][...] = self._data_iter._seq_idxs
+                    self._state_slots[i] = \
+                        self._data_iter.get_state(buffers = False)
+            except Exception as e: # re-raised in __next__
+                self._full.put((i, None, e))
+                return
+            self._full.put((i, generation, None))
+
+    def _release(self):
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+
+    def discard_unfinished(self):
+        with self._lock:
+            self._generation += 1
+            self._data_iter.discard_unfinished()
+            self._pending_state = self._data_iter.get_state()
+        self._release()
+
+    def set_step_size(self, step_size):
+        if step_size == self._step_size:
+            return
+        with self._lock:
+            self._generation += 1
+            self._data_iter.discard_unfinished()
+            self._data_iter.set_step_size(step_size)
+            self._step_size = step_size
+            self._pending_state = self._data_iter.get_state()
+        self._release()
+
+    def record_loss(self, loss_b):
+        if self._held is None:
+            return
+        with self._lock:
+            self._data_iter.record_loss(loss_b, self._slots[self._held][2],
+                                        self._seq_idx_slots[self._held])
+
+    def get_state(self):
+        """
+        Same as DataIter.get_state, as of the minibatch last returned
+        """
+        if self._held is None:
+            return self._pending_state
+        state = dict(self._state_slots[self._held])
+        state.update(zip(DataIter._STATE_BUFFERS,
+                         (arr.copy() for arr in self._slots[self._held])))
+        return state
+
+    def set_state(self, state):
+        with self._lock:
+            self._generation += 1
+            self._data_iter.set_state(state)
+            self._step_size = state['step_size']
+            self._pending_state = state
+        self._release()
+
+    def close(self):
+        """
+        Stop the background thread (Prefetcher is unusable afterwards)
+        """
+        self._free.put(None)
+        self._thread.join()
+
+    def __next__(self):
+        self._release()
+
+        start = time.time()
+        while True:
+            i, generation, e = self._full.get()
+            if generation is None: # error in background thread
+                raise e
+            if generation != self._generation:
+                self._free.put(i) # stale, recycle
+                continue
+            if e is not None: # StopIteration
+                self._pending_state = self._state_slots[i]
+                self._free.put(i)
+                self.wait_time += time.time() - start
+                raise e
+            break
+        self.wait_time += time.time() - start
+
+        self._held = i
+        return self._slots[i]
+
+def materialize(data_iter):
+    """
+    Return all minibatches of one pass of data_iter (with exact_pass and
+    step_size = window_size, so that minibatches do not overlap) as a list of
+    (input_tbi, target_tbi, time_tb, id_idx_tb) copies; minibatches without
+    data (time < 0. throughout) are left out
+    """
+    batches = []
+    for arrs in data_iter:
+        if np.any(arrs[2] >= 0.):
+            batches.append(tuple(arr.copy() for arr in arrs))
+    return batches
@@ -0,0 +1,382 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Pure NumPy engine for fwd propagating a trained net (no Theano needed)
+- Loads options.pkl & params.npz of a workspace, folding weight norm into
+  weights at load, and computes the same steps as Net's inference graph
+  (outputs agree with it up to float32 rounding)
+- Products and states live in buffers preallocated for batch_size, and
+  element-wise math is done in place on them, so that a step at small
+  batch sizes costs little more than its BLAS calls
+- NumpyNet mimics the parts of Net that Ensemble uses (dimensions,
+  compile_f_fwd_propagate)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import six.moves.cPickle as pk
+
+def _sigmoid_(x): # in place
+    np.negative(x, out = x)
+    np.exp(x, out = x)
+    x += 1.
+    np.reciprocal(x, out = x)
+
+def _layer_norm_(x_bi, s_i, b_i): # in place, as layers.layer_norm
+    x_bi -= x_bi.mean(1, keepdims = True)
+    x_bi /= np.sqrt((x_bi * x_bi).mean(1, keepdims = True) + 1e-5)
+    x_bi *= s_i
+    x_bi += b_i
+
+def _res_gate_(out_bi, h_bi, below_bi, g_i): # out = g h + (1 - g) below
+    np.subtract(h_bi, below_bi, out = out_bi)
+    out_bi *= g_i
+    out_bi += below_bi
+
+
+class _Layer():
+    def __init__(self, name, params, options, batch_size, n_in, n_emb):
+        """
+        Fetch (and fold) parameters of layer name from params & allocate
+        buffers for an input of n_in dims plus n_emb dims of ID embedding
+        """
+        self._param = lambda s: params[name + '_' + s]
+        self._has   = lambda s: (name + '_' + s) in params
+        self.n_in   = n_in
+        self.n_emb  = n_emb
+
+        self.W = self._folded('W', 'wn_Wg')
+        self.b = self._param('b')
+        self.n_out = self.W.shape[1] // self.n_gates
+
+        self.g = 1. / (1. + np.exp(-self._param('rg_k'))) \
+                 if self._has('rg_k') else None
+        self.cat = np.zeros((batch_size, n_in + n_emb), dtype = 'float32') \
+                   if n_emb > 0 else None
+        self.x   = np.zeros((batch_size, self.W.shape[1]), dtype = 'float32')
+        self.out = np.zeros((batch_size, self.n_out), dtype = 'float32')
+
+    def _folded(self, name, g_name):
+        W = self._param(name)
+        if self._has(g_name): # weight norm (as layers.weight_norm)
+            W = self._param(g_name) * W \
+                / np.sqrt((W * W).sum(0, keepdims = True))
+        return np.ascontiguousarray(W, dtype = 'float32')
+
+    def _input(self, below_bj, emb_bk):
+        # x = [below, emb] W + b
+        if emb_bk is not None:
+            self.cat[:, : self.n_in] = below_bj
+            self.cat[:, self.n_in :] = emb_bk
+            below_bj = self.cat
+        np.dot(below_bj, self.W, out = self.x)
+        self.x += self.b
+        return below_bj
+
+    def _output(self, h_bi, below_bj):
+        if self.g is None:
+            return h_bi
+        _res_gate_(self.out, h_bi, below_bj, self.g)
+        return self.out
+
+    def reset(self):
+        pass
+
+
+class _FC(_Layer):
+    """
+    FCLayer with identity activation (as FC_output & FC_id_embedder)
+    """
+    n_gates = 1
+
+    def step(self, below_bj, emb_bk, time_b):
+        below_bj = self._input(below_bj, emb_bk)
+        return self._output(self.x, below_bj)
+
+
+class _Recurrent(_Layer):
+    def __init__(self, name, params, options, batch_size, n_in, n_emb):
+        _Layer.__init__(self, name, params, options, batch_size, n_in, n_emb)
+        I = self.n_out
+        self.U = self._folded('U', 'wn_Ug')
+        self.h = np.zeros((batch_size, I), dtype = 'float32')
+        self.t = np.zeros((batch_size, I), dtype = 'float32') # temporary
+
+        init = self._param('init') if self._has('init') \
+               else np.zeros(self.state_dim * I, dtype = 'float32')
+        self.init = [init[k * I : (k + 1) * I] for k in range(self.state_dim)]
+
+        ln = lambda n, stride: \
+                 (self._param('ln_s')[n * stride : (n + 1) * stride],
+                  self._param('ln_b')[n * stride : (n + 1) * stride])
+        self.ln = [ln(n, stride) for n, stride in self.ln_slices(I)] \
+                  if self._has('ln_s') else None
+
+        if self._has('clk_t'):
+            self.clk_t = self._param('clk_t')
+            self.clk_s = self._param('clk_s')
+            self.r_on  = options['clock_r_on']
+            self.alpha = options['clock_leak_rate']
+            self.mask  = np.zeros((batch_size, I), dtype = 'float32')
+        else:
+            self.mask  = None
+
+    def _states(self):
+        return [self.h]
+
+    def reset(self):
+        # as v_prev_states of a new Net
+        for state in self._states():
+            state.fill(0.)
+
+    def _begin(self, time_b):
+        # states carried from time index - 1, or init states if time_b <= 0.
+        rows = time_b <= 0.
+        if rows.any():
+            for state, init in zip(self._states(), self.init):
+                state[rows] = init
+
+        if self.mask is not None: # as Layer.setup_clock_graph
+            m = self.mask
+            np.subtract(time_b[:, None], self.clk_s, out = m)
+            np.mod(m, self.clk_t, out = m)
+            m /= self.clk_t
+            on = m < self.r_on
+            up = m < self.r_on / 2.
+            m[~on] *= self.alpha
+            m[on & ~up] = 2. - 2. * m[on & ~up] / self.r_on
+            m[up] *= 2. / self.r_on
+
+    def _masked_(self, new_bi, prev_bi): # new = m new + (1 - m) prev
+        if self.mask is not None:
+            new_bi -= prev_bi
+            new_bi *= self.mask
+            new_bi += prev_bi
+
+
+class _LSTM(_Recurrent):
+    n_gates   = 4
+    state_dim = 2
+
+    def __init__(self, name, params, options, batch_size, n_in, n_emb):
+        _Recurrent.__init__(self, name, params, options, batch_size, n_in,
+                            n_emb)
+        I = self.n_out
+        self.c = np.zeros((batch_size, I), dtype = 'float32')
+        self.r = np.zeros((batch_size, 4 * I), dtype = 'float32') # h U
+        p = self._param('p') if self._has('p') else None
+        self.p = [p[k * I : (k + 1) * I] for k in range(3)] \
+                 if p is not None else None
+
+    @staticmethod
+    def ln_slices(I): # (n, stride) as in LSTMLayer.setup_graph
+        return [(0, 4 * I), (1, 4 * I), (8, I)]
+
+    def _states(self):
+        return [self.h, self.c]
+
+    def step(self, below_bj, emb_bk, time_b):
+        I = self.n_out
+        below_bj = self._input(below_bj, emb_bk)
+        self._begin(time_b)
+        h, c, t = self.h, self.c, self.t
+
+        np.dot(h, self.U, out = self.r)
+        if self.ln is not None:
+            _layer_norm_(self.x, *self.ln[0])
+            _layer_norm_(self.r, *self.ln[1])
+        self.x += self.r
+        i, f, g, o = [self.x[:, k * I : (k + 1) * I] for k in range(4)]
+
+        if self.p is not None:
+            np.multiply(self.p[0], c, out = t)
+            i += t
+            np.multiply(self.p[1], c, out = t)
+            f += t
+        _sigmoid_(i)
+        _sigmoid_(f)
+        np.tanh(g, out = g)
+
+        # new c (in i)
+        i *= g
+        f *= c
+        i += f
+        self._masked_(i, c)
+        c[...] = i
+
+        if self.p is not None:
+            np.multiply(self.p[2], c, out = t)
+            o += t
+        _sigmoid_(o)
+
+        # new h (in t)
+        t[...] = c
+        if self.ln is not None:
+            _layer_norm_(t, *self.ln[2])
+        np.tanh(t, out = t)
+        t *= o
+        self._masked_(t, h)
+        h[...] = t
+
+        return self._output(h, below_bj)
+
+
+class _GRU(_Recurrent):
+    n_gates   = 3
+    state_dim = 1
+
+    def __init__(self, name, params, options, batch_size, n_in, n_emb):
+        _Recurrent.__init__(self, name, params, options, batch_size, n_in,
+                            n_emb)
+        I = self.n_out
+        self.U_ru = np.ascontiguousarray(self.U[:, : 2 * I])
+        self.U_c  = np.ascontiguousarray(self.U[:, 2 * I :])
+        self.r_ru = np.zeros((batch_size, 2 * I), dtype = 'float32') # h U
+        self.r_c  = np.zeros((batch_size, I), dtype = 'float32')
+
+    @staticmethod
+    def ln_slices(I): # (n, stride) as in GRULayer.setup_graph
+        return [(0, 2 * I), (1, 2 * I), (4, I), (5, I)]
+
+    def step(self, below_bj, emb_bk, time_b):
+        I = self.n_out
+        below_bj = self._input(below_bj, emb_bk)
+        self._begin(time_b)
+        h = self.h
+
+        ru, c = self.x[:, : 2 * I], self.x[:, 2 * I :]
+        np.dot(h, self.U_ru, out = self.r_ru)
+        if self.ln is not None:
+            _layer_norm_(ru, *self.ln[0])
+            _layer_norm_(self.r_ru, *self.ln[1])
+        ru += self.r_ru
+        _sigmoid_(ru)
+        r, u = ru[:, : I], ru[:, I :]
+
+        np.dot(h, self.U_c, out = self.r_c)
+        if self.ln is not None:
+            _layer_norm_(c, *self.ln[2])
+            _layer_norm_(self.r_c, *self.ln[3])
+        self.r_c *= r
+        c += self.r_c
+        np.tanh(c, out = c)
+
+        # new h = (1 - u) h + u c (in c)
+        c -= h
+        c *= u
+        c += h
+        self._masked_(c, h)
+        h[...] = c
+
+        return self._output(h, below_bj)
+
+
+class NumpyNet():
+    def __init__(self, workspace, batch_size):
+        """
+        Load a trained net from workspace for fwd propagation of batch_size
+        streams (same results as Net(options, None, workspace) with
+        options['batch_size'] = batch_size)
+        """
+        with open(workspace + '/options.pkl', 'rb') as f:
+            self._options = pk.load(f)
+        options = self._options
+        assert options['unit_type'] in ['lstm', 'gru']
+
+        params = np.load(workspace + '/params.npz') # NpzFile object
+        params = dict((k, params[k].astype('float32')) for k in params.files)
+        self._batch_size = batch_size
+
+        args = lambda n_in, n_emb: (params, options, batch_size, n_in, n_emb)
+
+        # optional ID embedder
+        if not options['learn_id_embedding']:
+            self._id_embedder = None
+            add = 0
+        else:
+            self._id_embedder = _FC('FC_id_embedder',
+                                    *args(options['id_count'], 0))
+            self._one_hot = np.zeros((batch_size, options['id_count']),
+                                     dtype = 'float32') \
+                            if self._id_embedder.g is not None else None
+            add = options['id_embedding_dim']
+
+        # main recurrent layers & final FC layer
+        unit = '_' + options['unit_type'].upper()
+        self._layers = []
+        for i in range(options['net_depth']):
+            n_in = options['net_width'] if i > 0 else options['input_dim']
+            self._layers.append(eval(unit)(unit[1 :] + '_' + str(i),
+                                           *args(n_in, add)))
+        self._layers.append(_FC('FC_output', *args(options['net_width'],
+                                                   add)))
+
+    def dimensions(self):
+        return self._options['input_dim'], self._options['target_dim']
+
+    def reset(self):
+        """
+        Zero states (as a new Net; init states are used from time 0 anyway)
+        """
+        for layer in self._layers:
+            layer.reset()
+
+    def step(self, input_bi, time_b, id_idx_b):
+        """
+        One time step for all streams
+            input_bi    np.ndarray  [batch_size][input_dim]  (float32)
+            time_b      np.ndarray  [batch_size]             (float32)
+            id_idx_b    np.ndarray  [batch_size]             (int32)
+        Returns:
+            output_bi   np.ndarray  [batch_size][target_dim] (buffer of the
+                                                              last layer)
+        """
+        if self._id_embedder is None:
+            emb_bk = None
+        else:
+            below = None
+            if self._one_hot is not None:
+                self._one_hot.fill(0.)
+                self._one_hot[np.arange(self._batch_size), id_idx_b] = 1.
+                below = self._one_hot
+            e = self._id_embedder
+            np.take(e.W, id_idx_b, axis = 0, out = e.x) # one_hot W
+            e.x += e.b
+            emb_bk = e._output(e.x, below)
+
+        out = input_bi
+        for layer in self._layers:
+            out = layer.step(out, emb_bk, time_b)
+        return out
+
+    def compile_f_fwd_propagate(self):
+        """
+        Return a callable object of the same signature as
+        Net.compile_f_fwd_propagate for inference
+            f(input_tbi, time_tb, id_idx_tb) -> [output_tbi]
+        """
+        def f(input_tbi, time_tb, id_idx_tb):
+            input_tbi = np.asarray(input_tbi, dtype = 'float32')
+            time_tb   = np.asarray(time_tb  , dtype = 'float32')
+            id_idx_tb = np.asarray(id_idx_tb, dtype = 'int32')
+            output_tbi = np.zeros(input_tbi.shape[: 2]
+                                  + (self._options['target_dim'],),
+                                  dtype = 'float32')
+            for t in range(input_tbi.shape[0]):
+                output_tbi[t] = self.step(input_tbi[t], time_tb[t],
+                                          id_idx_tb[t])
+            return [output_tbi]
+        return f
@@ -18,21 +18,23 @@ Class for fwd propagating pre-trained nets in ensemble, one step at a time
   necessarily on the same data (i.e., possibly different whitening matrix
   and/or different id_idx orders)
 - Hence, receive and return data for all nets separately 
+- With engine = 'numpy', nets run on NumpyNet (engine.py) instead of Net,
+  which needs neither Theano nor compilation
 """
 
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
-from net import Net
 from collections import OrderedDict
 
 class Ensemble():
-    def __init__(self, workspaces, batch_size, indices):
+    def __init__(self, workspaces, batch_size, indices, engine = 'theano'):
         """
         Load pre-trained nets from files and prepare for fwd propagation
             workspaces  list    [workspace_0     , ..., workspace_(N-1)     ]
             batch_size  int     > 0
             indices     list    [batch_idx_list_0, ..., batch_idx_list_(N-1)]
+            engine      str     'theano' (Net) / 'numpy' (NumpyNet)
         where
             batch_idx_list = [id_idx_0, ..., id_idx_(B-1)]
         is batch-dimension id_idx order in vec_in for run_one_step
@@ -56,8 +58,16 @@ class Ensemble():
         self._nets = []
         self._props = [] # fwd propagators
 
+        if engine == 'theano':
+            from net import Net
+            load = lambda workspace: Net(options, None, workspace)
+        else:
+            assert engine == 'numpy'
+            from engine import NumpyNet
+            load = lambda workspace: NumpyNet(workspace, batch_size)
+
         for workspace in workspaces:
-            self._nets.append(Net(options, None, workspace))
+            self._nets.append(load(workspace))
             self._props.append(self._nets[-1].compile_f_fwd_propagate())
 
             if len(self._nets) == 1:
@@ -20,9 +20,11 @@ from __future__ import absolute_import, division, print_function
 from six import with_metaclass
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import numpy as np
 import theano as th
 import theano.tensor as tt
+from theano.gradient import DisconnectedType
 from utils import unif_weight
 
 def cut0(x, n, stride):
@@ -44,6 +46,121 @@ def ln_lambda(s_k, b_k, n, stride):
                    s_i = cut0(s_k, n, stride),
                    b_i = cut0(b_k, n, stride): layer_norm(x_bi, s_i, b_i))
 
+def scan_steps(step, sequences, prev_states, non_seqs, n_steps, name,
+               unroll_scan = False, unroll_factor = 1):
+    """
+    Apply step(*(seq[t] for seq in sequences) + states + non_seqs) -> new
+    state(s) for t = 0 ~ n_steps - 1, starting from prev_states, and return
+    list of states stacked in time [n_steps][...]
+    - th.scan over n_steps by default
+    - unroll_scan unrolls all n_steps in the graph (no th.scan)
+    - unroll_factor k > 1 unrolls k steps in each of n_steps / k iterations
+      of th.scan (most of the speedup of unroll_scan at a fraction of its
+      compile time; falls back to k = 1 if k does not divide n_steps, e.g.,
+      an inference graph with step_size 1 built from unrolled training
+      options)
+    """
+    n_seqs   = len(sequences)
+    n_states = len(prev_states)
+
+    def call(seq_ts, states):
+        out = step(*(seq_ts + states + non_seqs))
+        return list(out) if isinstance(out, (list, tuple)) else [out]
+
+    if unroll_scan:
+        statess = [list(prev_states)]
+        for t in range(n_steps):
+            statess.append(call([seq[t] for seq in sequences], statess[-1]))
+        return [tt.stack([states[i] for states in statess[1 :]], axis = 0)
+                for i in range(n_states)]
+
+    if unroll_factor <= 1 or n_steps % unroll_factor != 0:
+        outs, _ = th.scan(step,
+                          sequences     = sequences,
+                          outputs_info  = prev_states,
+                          non_sequences = non_seqs,
+                          n_steps       = n_steps,
+                          name          = name,
+                          strict        = True)
+        return outs if isinstance(outs, list) else [outs]
+
+    # sequences and states in blocks of k steps [n_steps / k][k][...]
+    # (the last state of a block is the state carried to the next one)
+    k = unroll_factor
+    to_blocks   = lambda x: x.reshape([n_steps // k, k]
+                                      + [x.shape[i] for i in range(1, x.ndim)],
+                                      ndim = x.ndim + 1)
+    from_blocks = lambda x: x.reshape([n_steps]
+                                      + [x.shape[i] for i in range(2, x.ndim)],
+                                      ndim = x.ndim - 1)
+
+    def block(*args):
+        seq_ks = args[: n_seqs]
+        states = [s_k[-1] for s_k in args[n_seqs : n_seqs + n_states]]
+        outs = [[] for _ in range(n_states)]
+        for j in range(k):
+            states = call([seq_k[j] for seq_k in seq_ks], states)
+            for out, state in zip(outs, states):
+                out.append(state)
+        return [tt.stack(out, axis = 0) for out in outs]
+
+    outs, _ = th.scan(block,
+                      sequences     = [to_blocks(seq) for seq in sequences],
+                      outputs_info  = [tt.repeat(tt.shape_padleft(state), k,
+                                                 axis = 0)
+                                       for state in prev_states],
+                      non_sequences = non_seqs,
+                      n_steps       = n_steps // k,
+                      name          = name,
+                      strict        = True)
+    outs = outs if isinstance(outs, list) else [outs]
+    return [from_blocks(out) for out in outs]
+
+class RecomputedOp(th.OpFromGraph):
+    def __init__(self, i_ports, o_ports):
+        """
+        th.OpFromGraph(i_ports, o_ports) whose gradient recomputes the graph
+        once, in a single op that returns gradients for all inputs
+        - i_ports must include all shared variables of the graph (replaced by
+          ports), so that their gradients are computed in the same op (the
+          default gradient of th.OpFromGraph builds a separate op for each
+          input, including implicit shared variables, and each of them
+          recomputes the whole graph)
+        - Only outputs at the boundary are kept for backprop; everything
+          inside the graph is freed after the forward pass and recomputed
+          in backprop
+        """
+        th.OpFromGraph.__init__(self, i_ports, o_ports)
+        self._i_ports = i_ports
+        self._o_ports = o_ports
+        self._is_float = [port.dtype.startswith('float') for port in i_ports]
+
+    def connection_pattern(self, node):
+        return [[f] * len(self._o_ports) for f in self._is_float]
+
+    def L_op(self, inputs, outputs, output_grads): # (newer Theano)
+        return self.grad(inputs, output_grads)
+
+    def grad(self, inputs, output_grads):
+        # outputs not connected to the cost (e.g., prev_state updates) are
+        # left out of backprop
+        connected = [not isinstance(g.type, DisconnectedType)
+                     for g in output_grads]
+        o_ports = [o for o, c in zip(self._o_ports, connected) if c]
+        g_ports = [o.type() for o in o_ports]
+        wrt = [i for i, f in zip(self._i_ports, self._is_float) if f]
+        grads = th.grad(cost = None, wrt = wrt,
+                        known_grads = OrderedDict(zip(o_ports, g_ports)),
+                        disconnected_inputs = 'ignore',
+                        return_disconnected = 'zero')
+        op = th.OpFromGraph(self._i_ports + g_ports, grads,
+                            on_unused_input = 'ignore')
+        outs = op(*(list(inputs) + [g for g, c in zip(output_grads, connected)
+                                    if c]))
+        outs = iter(outs if isinstance(outs, list) else [outs])
+        return [next(outs) if f else DisconnectedType()()
+                for f in self._is_float]
+
 class Layer(with_metaclass(ABCMeta)):
     def __init__(self, name):
         self.name = name # NOTE: each layer should be given a unique name
@@ -177,6 +294,8 @@ class LSTMLayer(Layer):
         self.use_clock       = options['learn_clock_params']
         self.use_res_gate    = options['residual_gate'] and n_in == n_out
         self.unroll_scan     = options['unroll_scan']
+        self.unroll_factor   = options['unroll_factor'] \
+                               if 'unroll_factor' in options else 1
 
         # input to (i, f, c, o) [n_in][4 * n_out]
         params[self.pfx('W')] = np.concatenate \
@@ -266,25 +385,16 @@ class LSTMLayer(Layer):
 
             return h_bi, c_bi
 
-        if not self.unroll_scan:
-            ((h_tbi, c_tbi), _) = th.scan(step,
-                      sequences     = [x_tb4i, s_time_tb, mask_tbi],
-                      outputs_info  = [cut1(v_prev_state_bk, 0, n_out),
-                                       cut1(v_prev_state_bk, 1, n_out)],
-                      non_sequences = non_seqs,
-                      n_steps       = self.n_steps,
-                      name          = self.pfx('scan'),
-                      strict        = True)
-        else:
-            h_list = [cut1(v_prev_state_bk, 0, n_out)]
-            c_list = [cut1(v_prev_state_bk, 1, n_out)]
-            for t in range(self.n_steps):
-                h_bi, c_bi = step(x_tb4i[t], s_time_tb[t], mask_tbi[t],
-                                  h_list[-1], c_list[-1], *non_seqs)
-                h_list.append(h_bi)
-                c_list.append(c_bi)
-            h_tbi = tt.stack(h_list[1 :], axis = 0)
-            c_tbi = tt.stack(c_list[1 :], axis = 0)
+        h_tbi, c_tbi = scan_steps \
+            (step,
+             sequences     = [x_tb4i, s_time_tb, mask_tbi],
+             prev_states   = [cut1(v_prev_state_bk, 0, n_out),
+                              cut1(v_prev_state_bk, 1, n_out)],
+             non_seqs      = non_seqs,
+             n_steps       = self.n_steps,
+             name          = self.pfx('scan'),
+             unroll_scan   = self.unroll_scan,
+             unroll_factor = self.unroll_factor)
 
         if not self.use_res_gate:
             out_tbi = h_tbi
@@ -306,6 +416,8 @@ class GRULayer(Layer):
         self.use_clock       = options['learn_clock_params']
         self.use_res_gate    = options['residual_gate'] and n_in == n_out
         self.unroll_scan     = options['unroll_scan']
+        self.unroll_factor   = options['unroll_factor'] \
+                               if 'unroll_factor' in options else 1
 
         # input to (r, u, c) [n_in][3 * n_out]
         params[self.pfx('W')] = np.concatenate \
@@ -382,20 +494,15 @@ class GRULayer(Layer):
 
             return h_bi
 
-        if not self.unroll_scan:
-            h_tbi, _ = th.scan(step,
-                               sequences     = [x_tb3i, s_time_tb, mask_tbi],
-                               outputs_info  = v_prev_state_bk,
-                               non_sequences = non_seqs,
-                               n_steps       = self.n_steps,
-                               name          = self.pfx('scan'),
-                               strict        = True)
-        else:
-            h_list = [v_prev_state_bk]
-            for t in range(self.n_steps):
-                h_list.append(step(x_tb3i[t], s_time_tb[t], mask_tbi[t],
-                                   h_list[-1], *non_seqs))
-            h_tbi = tt.stack(h_list[1 :], axis = 0)
+        h_tbi, = scan_steps \
+            (step,
+             sequences     = [x_tb3i, s_time_tb, mask_tbi],
+             prev_states   = [v_prev_state_bk],
+             non_seqs      = non_seqs,
+             n_steps       = self.n_steps,
+             name          = self.pfx('scan'),
+             unroll_scan   = self.unroll_scan,
+             unroll_factor = self.unroll_factor)
 
         if not self.use_res_gate:
             out_tbi = h_tbi
@@ -404,3 +511,206 @@ class GRULayer(Layer):
             out_tbi = g_i * h_tbi + (1. - g_i) * s_below_tbj
 
         return out_tbi, (v_prev_state_bk, h_tbi[s_next_prev_idx])
+
+
+def setup_wavefront_graph(layers, s_below_tbj, s_emb_tbk, s_time_tb,
+                          s_next_prev_idx, v_params, v_prev_states_bk,
+                          v_init_states_k):
+    """
+    Connect a stack of LSTMLayer's or GRULayer's (same type & n_out) with one
+    scan over the (time, layer) wavefront: in iteration s, layer l computes
+    time index s - l for all layers at once (batched over layers), so that
+    iterations are D times larger and there are only n_steps + D - 1 of them
+    instead of D * n_steps
+        s_below_tbj       input to layers[0] (without ID embedding)
+        s_emb_tbk         ID embedding concatenated to each layer's input
+                          (NoneType if not used)
+        v_prev_states_bk  list of v_prev_state_bk of layers
+        v_init_states_k   list of v_init_state_k of layers (or NoneType's)
+    Returns output of the top layer and list of prev_state_update's, equal
+    to those of connecting layers one by one with setup_graph (up to float
+    rounding, as products with weights are split by rows)
+    """
+    D = len(layers)
+    lstm = isinstance(layers[0], LSTMLayer)
+    assert lstm or isinstance(layers[0], GRULayer)
+    assert all(type(l) is type(layers[0]) and l.n_out == layers[0].n_out
+               for l in layers)
+    top     = layers[0]
+    T       = top.n_steps
+    I       = top.n_out
+    S       = T + D - 1 # number of iterations
+    v_param = lambda l, name: v_params[l.pfx(name)]
+
+    def skew(x_t, l): # [T][...] -> [S][...] starting at l (zeros elsewhere)
+        pad = lambda n: tt.zeros([n] + [x_t.shape[i]
+                                        for i in range(1, x_t.ndim)],
+                                 dtype = x_t.dtype)
+        parts = ([pad(l)] if l > 0 else []) + [x_t] \
+                + ([pad(D - 1 - l)] if l < D - 1 else [])
+        return tt.concatenate(parts, axis = 0) if len(parts) > 1 else x_t
+
+    def skew_stack(xs): # D x [T][...] -> [S][D][...]
+        return tt.stack([skew(x, l) for l, x in enumerate(xs)], axis = 1)
+
+    # input weights (weight norm folded), split into rows for the layer
+    # below (& the ID embedding)
+    Ws = [weight_norm(v_param(l, 'W'), v_param(l, 'wn_Wg'))
+          if top.use_weight_norm else v_param(l, 'W') for l in layers]
+    Us = [weight_norm(v_param(l, 'U'), v_param(l, 'wn_Ug'))
+          if top.use_weight_norm else v_param(l, 'U') for l in layers]
+
+    cat = lambda s_tbj: s_tbj if s_emb_tbk is None else \
+                        tt.concatenate([s_tbj, s_emb_tbk], axis = 2)
+    x0_tbgi = tt.dot(cat(s_below_tbj), Ws[0]) + v_param(layers[0], 'b')
+    if s_emb_tbk is None:
+        xe_sdbgi = None
+        b_dgi    = tt.stack([v_param(l, 'b') for l in layers[1 :]]) \
+                   if D > 1 else None
+    else:
+        xe_sdbgi = skew_stack([tt.zeros_like(x0_tbgi)]
+                              + [tt.dot(s_emb_tbk, W[I :]) + v_param(l, 'b')
+                                 for l, W in zip(layers[1 :], Ws[1 :])]) \
+                   [:, 1 :]
+        b_dgi    = None
+    W_digi = tt.stack([W[: I] for W in Ws[1 :]]) if D > 1 else None
+    U_digi = tt.stack(Us)
+
+    # initial states, residual gates (1 for layers without), clock masks,
+    # time and validity of each (iteration, layer)
+    zeros_i = tt.zeros((I,), dtype = 'float32')
+    init_h_di = tt.stack([cut0(v, 0, I) if v is not None else zeros_i
+                          for v in v_init_states_k])
+    init_c_di = tt.stack([cut0(v, 1, I) if v is not None else zeros_i
+                          for v in v_init_states_k]) if lstm else None
+    use_res = any(l.use_res_gate for l in layers)
+    g_di = tt.stack([tt.nnet.sigmoid(v_param(l, 'rg_k')) if l.use_res_gate
+                     else tt.ones((I,), dtype = 'float32') for l in layers])
+    p_d3i = tt.stack([v_param(l, 'p') if l.use_peephole
+                      else tt.zeros((3 * I,), dtype = 'float32')
+                      for l in layers]) if lstm else None
+    ln_s_dk = tt.stack([v_param(l, 'ln_s') for l in layers]) \
+              if top.use_layer_norm else None
+    ln_b_dk = tt.stack([v_param(l, 'ln_b') for l in layers]) \
+              if top.use_layer_norm else None
+
+    time_sdb  = skew_stack([s_time_tb] * D)
+    valid_sdb = skew_stack([tt.ones_like(s_time_tb)] * D)
+    mask_sdbi = skew_stack([l.setup_clock_graph(s_time_tb, v_param(l, 'clk_t'),
+                                                v_param(l, 'clk_s'))
+                            for l in layers]) if top.use_clock else None
+
+    x0_sbgi = skew(x0_tbgi, 0)
+    in0_sbi = skew(cat(s_below_tbj), 0) if layers[0].use_res_gate else None
+
+    def ln(x_dbk, n, stride): # batched over layers (see ln_lambda)
+        if not top.use_layer_norm:
+            return x_dbk
+        s_dk = ln_s_dk[:, n * stride : (n + 1) * stride]
+        b_dk = ln_b_dk[:, n * stride : (n + 1) * stride]
+        y_dbk = (x_dbk - x_dbk.mean(2)[:, :, None]) \
+                / tt.sqrt(x_dbk.var(2)[:, :, None] + 1e-5)
+        return s_dk[:, None, :] * y_dbk + b_dk[:, None, :]
+
+    gate = lambda x, n, stride = I: x[:, :, n * stride : (n + 1) * stride]
+
+    sequences = [x0_sbgi, time_sdb, valid_sdb] \
+                + ([xe_sdbgi] if xe_sdbgi is not None else []) \
+                + ([mask_sdbi] if mask_sdbi is not None else []) \
+                + ([in0_sbi] if in0_sbi is not None else [])
+    non_seqs = [v for v in [W_digi, U_digi, b_dgi, init_h_di, init_c_di,
+                            g_di, p_d3i, ln_s_dk, ln_b_dk] if v is not None]
+
+    def step(*args):
+        args = list(args)
+        x0_bgi, time_db, valid_db = args[: 3]
+        del args[: 3]
+        xe_dbgi = args.pop(0) if xe_sdbgi  is not None else None
+        mask_dbi = args.pop(0) if mask_sdbi is not None else None
+        in0_bi  = args.pop(0) if in0_sbi   is not None else None
+        prev_h_dbi = args.pop(0)
+        prev_c_dbi = args.pop(0) if lstm else None
+        prev_out_dbi = args.pop(0)
+
+        # inputs: layer 0 from below, others from outputs of layers below
+        # in the previous iteration (at the same time index)
+        x_dbgi = x0_bgi[None]
+        if D > 1:
+            x_rest = tt.batched_dot(prev_out_dbi[: -1], W_digi) \
+                     + (xe_dbgi if xe_dbgi is not None else b_dgi[:, None, :])
+            x_dbgi = tt.concatenate([x_dbgi, x_rest], axis = 0)
+
+        reset = time_db[:, :, None] > 0.
+        h_dbi = tt.switch(reset, prev_h_dbi, init_h_di[:, None, :])
+        if lstm:
+            c_dbi = tt.switch(reset, prev_c_dbi, init_c_di[:, None, :])
+            preact = ln(x_dbgi, 0, 4 * I) \
+                     + ln(tt.batched_dot(h_dbi, U_digi), 1, 4 * I)
+            p = lambda n: p_d3i[:, None, n * I : (n + 1) * I]
+            i_dbi = tt.nnet.sigmoid(gate(preact, 0) + p(0) * c_dbi)
+            f_dbi = tt.nnet.sigmoid(gate(preact, 1) + p(1) * c_dbi)
+            new_c = i_dbi * tt.tanh(gate(preact, 2)) + f_dbi * c_dbi
+            if mask_dbi is not None:
+                new_c = mask_dbi * new_c + (1. - mask_dbi) * c_dbi
+            o_dbi = tt.nnet.sigmoid(gate(preact, 3) + p(2) * new_c)
+            new_h = o_dbi * tt.tanh(ln(new_c, 8, I))
+        else:
+            preact = ln(gate(x_dbgi, 0, 2 * I), 0, 2 * I) \
+                     + ln(tt.batched_dot(h_dbi, U_digi[:, :, : 2 * I]),
+                          1, 2 * I)
+            r_dbi = tt.nnet.sigmoid(gate(preact, 0))
+            u_dbi = tt.nnet.sigmoid(gate(preact, 1))
+            c_dbi = tt.tanh(ln(gate(x_dbgi, 2), 4, I)
+                            + r_dbi * ln(tt.batched_dot(h_dbi,
+                                                        U_digi[:, :, 2 * I :]),
+                                         5, I))
+            new_h = (1. - u_dbi) * h_dbi + u_dbi * c_dbi
+        if mask_dbi is not None:
+            new_h = mask_dbi * new_h + (1. - mask_dbi) * h_dbi
+
+        if use_res:
+            below_dbi = prev_out_dbi[: -1] if D > 1 else None
+            first = in0_bi[None] if in0_bi is not None else new_h[: 1]
+            below_dbi = tt.concatenate([first, below_dbi], axis = 0) \
+                        if D > 1 else first
+            new_out = g_di[:, None, :] * new_h \
+                      + (1. - g_di[:, None, :]) * below_dbi
+        else:
+            new_out = new_h
+
+        # layers outside the wavefront keep their states
+        keep = valid_db[:, :, None] > 0.
+        states = [tt.switch(keep, new_h, prev_h_dbi)]
+        if lstm:
+            states.append(tt.switch(keep, new_c, prev_c_dbi))
+        states.append(tt.switch(keep, new_out, prev_out_dbi))
+        return states
+
+    B = s_time_tb.shape[1]
+    prev_states = [tt.stack([cut1(v, 0, I) for v in v_prev_states_bk])]
+    if lstm:
+        prev_states.append(tt.stack([cut1(v, 1, I) for v in v_prev_states_bk]))
+    prev_states.append(tt.zeros((D, B, I), dtype = 'float32'))
+
+    k = top.unroll_factor if S % top.unroll_factor == 0 else 1
+    outs = scan_steps(step,
+                      sequences     = sequences,
+                      prev_states   = prev_states,
+                      non_seqs      = non_seqs,
+                      n_steps       = S,
+                      name          = top.pfx('wavefront_scan'),
+                      unroll_scan   = top.unroll_scan,
+                      unroll_factor = k)
+
+    # layer l computed time index t in iteration t + l
+    unskew = lambda x_sdbi, l: x_sdbi[l : l + T, l]
+    updates = []
+    for l, layer in enumerate(layers):
+        h_tbi = unskew(outs[0], l)
+        state = [h_tbi[s_next_prev_idx]]
+        if lstm:
+            state.append(unskew(outs[1], l)[s_next_prev_idx])
+        updates.append((v_prev_states_bk[l],
+                        tt.concatenate(state, axis = 1) if lstm
+                        else state[0]))
+    return unskew(outs[-1], D - 1), updates
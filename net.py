@@ -21,10 +21,15 @@ from six import iterkeys, itervalues, iteritems
 
 import cPickle as pk
 from collections import OrderedDict
+from six.moves import queue
 import os
+import threading
+import time
 
-from layers import FCLayer, LSTMLayer, GRULayer
-from utils import l2_loss, l1_loss, huber_loss, clip_norm, get_random_string
+from layers import FCLayer, LSTMLayer, GRULayer, RecomputedOp, \
+                   setup_wavefront_graph
+from utils import l2_loss, l1_loss, huber_loss, clip_norm, \
+                  get_random_string, function_cache
 from optimizers import sgd_update, momentum_update, nesterov_update, \
                        vanilla_force, adadelta_force, rmsprop_force, adam_force
 
@@ -69,7 +74,8 @@ class Slice():
 
 class Net():
     def __init__(self, options,
-                       save_to = None, load_from = None, c_names = None):
+                       save_to = None, load_from = None, c_names = None,
+                       replicas = 1, workspace = True):
         """
         Mode is determined by whether save_to is None or not
 
@@ -82,6 +88,14 @@ class Net():
             <save_to>   str         'workspace_dir'
             [load_from] str         'workspace_dir' (if re-annealing)
                         NoneType    (if training fresh)
+            [replicas]  int         number of processes sharing batch_size
+                                    (data parallel; see parallel.py), each
+                                    holding batch_size / replicas columns
+            [workspace] bool        False for replicas in worker processes,
+                                    which only train: save_to is not touched
+                                    (no options.pkl, no writer thread) and
+                                    methods using the workspace are
+                                    unavailable
         (inference)
             (save_to)   NoneType    (leave as none)
             <load_from> str         'workspace_dir'
@@ -89,20 +103,23 @@ class Net():
         NOTE: For inference, options['step_size'] and options['batch_size']
               must be specified
         """
-        self._configure(options, save_to, load_from, c_names)
+        self._configure(options, save_to, load_from, c_names, replicas,
+                        workspace)
         self._init_params(load_from)
         self._init_shared_variables()
         if self._is_training:
             self._setup_training_graph()
+            self._init_writer()
         else:
             self._setup_inference_graph()
     
-    def _configure(self, options, save_to, load_from, c_names):
+    def _configure(self, options, save_to, load_from, c_names, replicas,
+                         workspace):
         if save_to is not None:
             self._is_training = True
 
             self._options = options
-            self._save_to = save_to
+            self._save_to = save_to if workspace else None
             self._pfx = ''
             
             if load_from is not None:
@@ -111,8 +128,9 @@ class Net():
                     assert self._options == loaded_options, \
                            'Mismatching options in loaded model'
             
-            with open(save_to + '/options.pkl', 'wb') as f:
-                pk.dump(self._options, f)
+            if workspace:
+                with open(save_to + '/options.pkl', 'wb') as f:
+                    pk.dump(self._options, f)
         else:
             self._is_training = False
             
@@ -129,7 +147,11 @@ class Net():
             self._options['step_size']   = options['step_size']
             self._options['batch_size']  = options['batch_size']
         
-        if c_names is not None:
+        if replicas > 1:
+            assert self._is_training and c_names is None and \
+                   self._options['batch_size'] % replicas == 0
+            self._slices = [Slice(0, self._options['batch_size'] // replicas)]
+        elif c_names is not None:
             n = self._options['batch_size']
             m = len(c_names)
 
@@ -142,6 +164,20 @@ class Net():
         
         # this is where gradients and optimizer states are stored
         self._device = self._slices[0].device
+
+        # gradient accumulation over micro-batches (training, single device)
+        self._n_micro = self._options['micro_batches'] \
+                        if self._is_training and \
+                           'micro_batches' in self._options else 1
+        if self._n_micro > 1:
+            assert len(self._slices) == 1 and \
+                   self._options['batch_size'] % self._n_micro == 0
+
+        # grad_norm_clip is applied to gradients summed over micro-batches or
+        # replicas, but to those of each slice otherwise (as for multi GPU
+        # mode before micro-batches & replicas, so that reruns of existing
+        # workspaces train the same)
+        self._clip_summed = self._n_micro > 1 or replicas > 1
  
     def _init_params(self, load_from):
         """
@@ -228,22 +264,34 @@ class Net():
             self._v_grads = \
                 [th.shared(v * 0., name = k + '_grad', **self._device) \
                  for k, v in iteritems(self._params)]
+            self._grads_released = False
+
+            # accumulators for f_train_step (see pull_accumulators)
+            self._v_loss_sum = th.shared(np.float64(0.), name = 'loss_sum',
+                                         **self._device)
+            self._v_frames   = th.shared(np.float64(0.), name = 'frames',
+                                         **self._device)
+
+            # prev_states of evaluation graphs (see compile_f_eval)
+            self._v_eval_prev_states = OrderedDict()
 
     def _setup_forward_graph(self, s_input_tbi, s_time_tb, s_id_idx_tb,
-                                   s_next_prev_idx, v_params, v_prev_states):
+                                   s_next_prev_idx, v_params, v_prev_states,
+                                   recompute = False):
         """
         Specify layer connections
         Layers return their internal states for next time step as
             prev_state_update = (v_prev_state, state[s_next_prev_idx])
         which are collected as a list and returned along with the last
         layer's output
+        If recompute, recurrent layers are connected in groups of
+        options['checkpoint_layers'], each wrapped in a RecomputedOp, so
+        that only outputs at group boundaries are kept for backprop and
+        everything inside a group (states of all time steps, outputs of
+        inner layers) is recomputed from them once during backprop
+        If options['wavefront'], recurrent layers are connected with a single
+        scan over the (time, layer) wavefront (see setup_wavefront_graph)
         """
-        def get_v_prev_state(layer):
-            if layer.pfx('prev') in v_prev_states:
-                return v_prev_states[layer.pfx('prev')]
-            else:
-                return None
-        
         def get_v_init_state(layer):
             if layer.pfx('prev') in v_prev_states \
                     and self._options['learn_init_states']:
@@ -259,7 +307,7 @@ class Net():
             return tt.reshape(y, (x_tb.shape[0], x_tb.shape[1], n_class))
 
         if not self._options['learn_id_embedding']:
-            cat = lambda s_below_tbj: s_below_tbj
+            s_id_emb_tbi = None
         else:
             s_id_emb_tbi, _ = self._id_embedder.setup_graph \
                 (s_below_tbj     = to_one_hot \
@@ -267,29 +315,95 @@ class Net():
                  s_time_tb       = s_time_tb,
                  s_next_prev_idx = s_next_prev_idx,
                  v_params        = v_params,
-                 v_prev_state_bk = get_v_prev_state(self._id_embedder),
+                 v_prev_state_bk = v_prev_states.get \
+                                       (self._id_embedder.pfx('prev')),
                  v_init_state_k  = get_v_init_state(self._id_embedder))
-            cat = lambda s_below_tbj: tt.concatenate([s_below_tbj,
-                                                      s_id_emb_tbi], axis = 2)
+
+        def connect(lo, hi, s_below_tbj, s_time_tb, s_id_emb_tbi,
+                    s_next_prev_idx, v_prev_states):
+            # vertical stack: s_below -> layer[lo] -> ... -> layer[hi - 1]
+            updates = []
+            for layer in self._layers[lo : hi]:
+                s_below_tbj, update = layer.setup_graph \
+                    (s_below_tbj     = s_below_tbj if s_id_emb_tbi is None
+                                       else tt.concatenate([s_below_tbj,
+                                                            s_id_emb_tbi],
+                                                           axis = 2),
+                     s_time_tb       = s_time_tb,
+                     s_next_prev_idx = s_next_prev_idx,
+                     v_params        = v_params,
+                     v_prev_state_bk = v_prev_states.get(layer.pfx('prev')),
+                     v_init_state_k  = get_v_init_state(layer))
+                if update is not None:
+                    updates.append(update)
+            return s_below_tbj, updates
+
+        def connect_recomputed(lo, hi, s_below_tbj):
+            # same as connect, with inputs, prev_states, and params of the
+            # group as explicit inputs of RecomputedOp (params are replaced
+            # by ports so that their gradients come from the same
+            # recomputation as the others)
+            keys = [l.pfx('prev') for l in self._layers[lo : hi]
+                    if l.pfx('prev') in v_prev_states]
+            i_nodes = [s_below_tbj, s_time_tb, s_next_prev_idx] \
+                      + ([s_id_emb_tbi] if s_id_emb_tbi is not None else []) \
+                      + [v_prev_states[k] for k in keys]
+            i_ports = [node.type() for node in i_nodes]
+            n = len(i_nodes) - len(keys)
+
+            s_out, updates = connect \
+                (lo, hi, i_ports[0], i_ports[1],
+                 i_ports[3] if s_id_emb_tbi is not None else None,
+                 i_ports[2], OrderedDict(zip(keys, i_ports[n :])))
+            assert len(updates) == len(keys)
+            o_ports = [s_out] + [u for _, u in updates]
+
+            v_shareds = [v for v in th.gof.graph.inputs(o_ports)
+                         if isinstance(v, th.compile.SharedVariable)]
+            p_shareds = [v.type() for v in v_shareds]
+            o_ports = th.clone(o_ports, replace = OrderedDict(zip(v_shareds,
+                                                                  p_shareds)))
+            outs = RecomputedOp(i_ports + p_shareds, o_ports) \
+                       (*(i_nodes + v_shareds))
+            outs = outs if isinstance(outs, list) else [outs]
+            return outs[0], [(v_prev_states[k], s_new)
+                             for k, s_new in zip(keys, outs[1 :])]
 
         D = self._options['net_depth']
-        s_outputs = [None] * (D + 1)  # (RNN) * D + FC
-        s_outputs.append(s_input_tbi) # put input at index -1
-        prev_state_updates = []
+        if 'wavefront' in self._options and self._options['wavefront']:
+            assert not recompute, \
+                   'wavefront cannot be combined with checkpoint_layers'
+            s_below_tbj, prev_state_updates = setup_wavefront_graph \
+                (layers           = self._layers[: D],
+                 s_below_tbj      = s_input_tbi,
+                 s_emb_tbk        = s_id_emb_tbi,
+                 s_time_tb        = s_time_tb,
+                 s_next_prev_idx  = s_next_prev_idx,
+                 v_params         = v_params,
+                 v_prev_states_bk = [v_prev_states[l.pfx('prev')]
+                                     for l in self._layers[: D]],
+                 v_init_states_k  = [get_v_init_state(l)
+                                     for l in self._layers[: D]])
+            s_output_tbi, updates = connect(D, D + 1, s_below_tbj, s_time_tb,
+                                            s_id_emb_tbi, s_next_prev_idx,
+                                            v_prev_states)
+            return s_output_tbi, prev_state_updates + updates
 
-        # vertical stack: input -> layer[0] -> ... -> layer[D - 1] -> output
-        for i in range(D + 1):
-            s_outputs[i], update = self._layers[i].setup_graph \
-                (s_below_tbj     = cat(s_outputs[i - 1]),
-                 s_time_tb       = s_time_tb,
-                 s_next_prev_idx = s_next_prev_idx,
-                 v_params        = v_params,
-                 v_prev_state_bk = get_v_prev_state(self._layers[i]),
-                 v_init_state_k  = get_v_init_state(self._layers[i]))
-            if update is not None:
-                prev_state_updates.append(update)
-        
-        return s_outputs[D], prev_state_updates
+        if not recompute:
+            return connect(0, D + 1, s_input_tbi, s_time_tb, s_id_emb_tbi,
+                           s_next_prev_idx, v_prev_states)
+
+        k = self._options['checkpoint_layers']
+        s_below_tbj = s_input_tbi
+        prev_state_updates = []
+        for lo in range(0, D, k):
+            s_below_tbj, updates = connect_recomputed(lo, min(lo + k, D),
+                                                      s_below_tbj)
+            prev_state_updates += updates
+        s_output_tbi, updates = connect(D, D + 1, s_below_tbj, s_time_tb,
+                                        s_id_emb_tbi, s_next_prev_idx,
+                                        v_prev_states)
+        return s_output_tbi, prev_state_updates + updates
 
     def _setup_inference_graph(self):
         """
@@ -325,33 +439,45 @@ class Net():
         self._prop_i_ports   = [p_input_tbi, p_time_tb, p_id_idx_tb]
         self._prop_o_ports   = [p_output_tbi]
 
-    def _setup_loss_graph(self, s_output_tbi, s_target_tbi, s_step_size):
+    def _setup_loss_graph(self, s_output_tbi, s_target_tbi, s_time_tb,
+                                s_step_size):
         """
-        Connect a loss function to the graph
+        Connect a loss function to the graph and return
+            s_loss_b    loss summed over time & hidden dims, per batch column
+        (sum over batch for the total loss)
         See data.py for explanation of the slicing part
+        Padding (time < 0.) is excluded by replacing output with target
         """
-        s_sliced_output_tbi = s_output_tbi[-s_step_size :]
         s_sliced_target_tbi = s_target_tbi[-s_step_size :]
+        s_sliced_output_tbi = tt.switch \
+                                  (s_time_tb[-s_step_size :, :, None] >= 0.,
+                                   s_output_tbi[-s_step_size :],
+                                   s_sliced_target_tbi)
 
         if self._options['loss_type'] == 'l2':
-            return l2_loss(s_sliced_output_tbi, s_sliced_target_tbi)
+            return l2_loss(s_sliced_output_tbi, s_sliced_target_tbi,
+                           axis = (0, 2))
         if self._options['loss_type'] == 'l1':
-            return l1_loss(s_sliced_output_tbi, s_sliced_target_tbi)
+            return l1_loss(s_sliced_output_tbi, s_sliced_target_tbi,
+                           axis = (0, 2))
         if self._options['loss_type'] == 'huber':
             delta = self._options['huber_delta']
-            return huber_loss(s_sliced_output_tbi, s_sliced_target_tbi, delta)
+            return huber_loss(s_sliced_output_tbi, s_sliced_target_tbi, delta,
+                              axis = (0, 2))
         
         assert False, 'Invalid loss_type option'
-        return tt.alloc(np.float32(0.))
+        return tt.zeros((s_output_tbi.shape[1],), dtype = 'float32')
 
     def _setup_grads_graph(self, s_loss, v_wrt):
         """
         Connect loss to new values of gradients
         - NOTE: v_wrt must be a list instead of OrderedDict
+        - options['grad_norm_clip'] is applied here to gradients of each
+          slice, unless clipping summed gradients (see _setup_optimizer_graph)
         """
         assert type(v_wrt) is list
         s_grads = tt.grad(s_loss, wrt = v_wrt)
-        if 'grad_norm_clip' in self._options:
+        if 'grad_norm_clip' in self._options and not self._clip_summed:
             s_grads = [clip_norm(s_grad, self._options['grad_norm_clip']) \
                            for s_grad in s_grads]
         return s_grads # list of nodes
@@ -367,8 +493,16 @@ class Net():
             s_increment    (to update s.v_param <- s.v_param + s_increment)
         - Assumes that v_grads has been updated prior to applying updates here
         - NOTE: v_grads must be a list instead of OrderedDict
+        - With micro-batches or data parallel replicas,
+          options['grad_norm_clip'] is applied here to v_grads, i.e., to
+          gradients of the whole minibatch (summed over micro-batches or
+          processes), so that they give the same update as one process with
+          the full batch
         """
         assert type(v_grads) is list
+        if 'grad_norm_clip' in self._options and self._clip_summed:
+            v_grads = [clip_norm(v_grad, self._options['grad_norm_clip'])
+                       for v_grad in v_grads]
 
         # same shapes and orders as v_grads
         ones = [np.ones_like(p).astype('float32') \
@@ -397,7 +531,7 @@ class Net():
         """
         Connect graphs together for training and store in/out ports & updates
         (propagation)  inputs  : input, target, time, id_idx, step_size
-                       outputs : loss
+                       outputs : loss, loss_b (per batch column)
                        updates : prev_states[, grads]
         (param update) inputs  : lr
                        outputs : None
@@ -405,6 +539,9 @@ class Net():
         (optim init)   inputs  : None
                        outputs : None
                        updates : optimizer states
+        (train step)   inputs  : input, target, time, id_idx, step_size, lr
+                       outputs : None
+                       updates : prev_states, params, accumulators
         """
         p_input_tbi  = tt.ftensor3(name = 'i_port_input')
         p_target_tbi = tt.ftensor3(name = 'i_port_target')
@@ -412,37 +549,63 @@ class Net():
         p_id_idx_tb  = tt.imatrix (name = 'i_port_id_idx')
         p_step_size  = tt.iscalar (name = 'i_port_step_size')
         p_lr         = tt.fscalar (name = 'i_port_lr')
+        p_micro_idx  = tt.iscalar (name = 'i_port_micro_idx')
 
         self._prev_state_updates = []
-        losses = [] # list of s_loss
+        losses = [] # list of s_loss_b
         gradss = [] # list of s_grads (i.e., list of list)
 
         for s in self._slices:
             s_step_size = s.transfer(p_step_size)
+
+            # with micro-batches, ports take micro_batch_size columns, which
+            # are columns [micro_idx * size, (micro_idx + 1) * size) of
+            # prev_states
+            if self._n_micro > 1:
+                size = self._options['batch_size'] // self._n_micro
+                s_start = p_micro_idx * size
+                v_prev_states = OrderedDict \
+                    ((k, v[s_start : s_start + size])
+                     for k, v in iteritems(s.v_prev_states))
+            else:
+                v_prev_states = s.v_prev_states
+
             s_output_tbi, prev_state_updates = self._setup_forward_graph \
                 (s_input_tbi     = s.apply(p_input_tbi),
                  s_time_tb       = s.apply(p_time_tb),
                  s_id_idx_tb     = s.apply(p_id_idx_tb),
                  s_next_prev_idx = s_step_size - 1,
                  v_params        = s.v_params,
-                 v_prev_states   = s.v_prev_states)
+                 v_prev_states   = v_prev_states,
+                 recompute       = 'checkpoint_layers' in self._options)
+            if self._n_micro > 1: # (sub, new) -> (v, v with sub <- new)
+                prev_state_updates = \
+                    [(s_sub.owner.inputs[0], tt.set_subtensor(s_sub, s_new))
+                     for s_sub, s_new in prev_state_updates]
             self._prev_state_updates += prev_state_updates
 
-            s_loss = self._setup_loss_graph \
+            s_loss_b = self._setup_loss_graph \
                 (s_output_tbi = s_output_tbi,
                  s_target_tbi = s.apply(p_target_tbi),
+                 s_time_tb    = s.apply(p_time_tb),
                  s_step_size  = s_step_size)
-            losses += [self.transfer(s_loss)]
+            losses += [self.transfer(s_loss_b)]
 
             s_grads = self._setup_grads_graph \
-                (s_loss = s_loss,
+                (s_loss = tt.sum(s_loss_b),
                  v_wrt  = list(itervalues(s.v_params)))
             gradss += [[self.transfer(s_grad) for s_grad in s_grads]]
         
         # sum losses and grads from all slices
-        p_loss = sum(losses)
+        p_loss_b = tt.concatenate(losses, axis = 0)
+        p_loss   = tt.sum(p_loss_b)
         s_new_grads = [sum(grad_tuple) for grad_tuple in zip(*gradss)]
-        self._grad_updates = [u for u in zip(self._v_grads, s_new_grads)]
+        if self._n_micro > 1: # accumulate except for 0-th micro-batch
+            self._grad_updates = \
+                [(v, tt.switch(tt.gt(p_micro_idx, 0), v + s_new, s_new))
+                 for v, s_new in zip(self._v_grads, s_new_grads)]
+        else:
+            self._grad_updates = [u for u in zip(self._v_grads, s_new_grads)]
 
         self._optim_inits, self._optim_param_updates, s_increments = \
             self._setup_optimizer_graph(s_lr    = self.transfer(p_lr),
@@ -454,46 +617,181 @@ class Net():
 
         self._prop_i_ports   = [p_input_tbi, p_target_tbi, p_time_tb,
                                 p_id_idx_tb, p_step_size]
-        self._prop_o_ports   = [p_loss]
+        self._prop_o_ports   = [p_loss, p_loss_b]
         self._update_i_ports = [p_lr]
 
+        if self._n_micro > 1:
+            self._prop_i_ports += [p_micro_idx]
+            self._fused_updates = None # (not applicable)
+            return
+
+        # fused step: optimizer & param updates take new gradients directly
+        # (instead of through v_grads), and loss & real frame count (time >=
+        # 0 within step) are summed into on-device accumulators
+        updates = self._optim_param_updates
+        s_fused = th.clone([u for _, u in updates],
+                           replace = dict(zip(self._v_grads, s_new_grads)))
+        self._fused_updates = [(v, s_u) for (v, _), s_u in
+                               zip(updates, s_fused)]
+        s_frames = tt.sum(tt.ge(self.transfer(p_time_tb)[-p_step_size :],
+                                0.), dtype = 'float64')
+        self._fused_updates += [(self._v_loss_sum, self._v_loss_sum
+                                                   + tt.cast(p_loss,
+                                                             'float64')),
+                                (self._v_frames  , self._v_frames
+                                                   + s_frames)]
+
+    def _shared_variables(self):
+        """
+        All shared variables of Net by names that identify their roles (with
+        name prefix removed; for function_cache)
+        """
+        unpfx = lambda k: k[len(self._pfx) :] # no pfx in keys
+        v_shareds = OrderedDict()
+        for i, s in enumerate(self._slices):
+            for k, v in iteritems(s.v_params):
+                v_shareds['param_%d_%s' % (i, unpfx(k))] = v
+            for k, v in iteritems(s.v_prev_states):
+                v_shareds['prev_%d_%s' % (i, unpfx(k))] = v
+        if self._is_training:
+            for k, v in zip(self._params, self._v_grads):
+                v_shareds['grad_' + unpfx(k)] = v
+            for i, (v, _) in enumerate(self._optim_inits):
+                v_shareds['optim_%d' % i] = v
+            v_shareds['loss_sum'] = self._v_loss_sum
+            v_shareds['frames'  ] = self._v_frames
+            v_shareds.update(self._v_eval_prev_states)
+        return v_shareds
+
+    def _compile(self, name, inputs, outputs, updates, **kwargs):
+        """
+        th.function through function_cache, keyed by options and graph
+        (with name prefix removed, so that nets in an Ensemble share keys)
+        """
+        graph = th.printing.debugprint(outputs + [u for _, u in updates],
+                                       file = 'str')
+        if self._pfx != '':
+            graph = graph.replace(self._pfx, '')
+        key = (name, list(iteritems(self._options)), graph)
+        return function_cache.compile(key, self._shared_variables(),
+                                      inputs = inputs, outputs = outputs,
+                                      updates = updates, **kwargs)
+
     def compile_f_fwd_propagate(self):
         """
         Compile a callable object of signature
             (training)  f(input_tbi, target_tbi, time_tb,
-                          id_idx_tb, step_size) -> [loss]
+                          id_idx_tb, step_size[, micro_idx]) -> [loss, loss_b]
             (inference) f(input_tbi, time_tb, id_idx_tb) -> [output_tbi]
         As a side effect, calling it updates
             v_prev_states
         
         - Output is a list of np.ndarray (i.e., 0-th element is np.ndarray)
           whether scalar (loss) or tensor3 (output_tbi)
+        - loss_b is loss per batch column (loss = sum of loss_b)
+        - With options['micro_batches'] = n, training mode takes batch_size
+          / n columns of a minibatch at a time, and micro_idx (0 ~ n - 1)
+          telling which (call for all n in order)
+        """
+        on_unused_input = 'raise' if self._options['learn_id_embedding'] \
+                                  else 'ignore'
+        return self._compile('fwd_propagate',
+                             inputs  = self._prop_i_ports,
+                             outputs = self._prop_o_ports,
+                             updates = self._prev_state_updates,
+                             on_unused_input = on_unused_input)
+
+    def compile_f_eval(self, window_size, batch_size):
         """
+        Compile a callable object of signature
+            f(input_tbi, target_tbi, time_tb, id_idx_tb) -> [loss, loss_b]
+        for forward-only evaluation with its own window_size & batch_size
+        (e.g., several times those of training; step_size = window_size),
+        sharing parameters with training
+        As a side effect, calling it updates
+            prev_states of its own (not those of training)
+
+        - Runs on the device of 0-th slice, always with th.scan (unrolling a
+          large window would take too long to compile; unroll_factor is kept
+          if it divides window_size)
+        """
+        assert self._is_training
+        s = self._slices[0]
+
+        p_input_tbi  = tt.ftensor3(name = 'e_port_input')
+        p_target_tbi = tt.ftensor3(name = 'e_port_target')
+        p_time_tb    = tt.fmatrix (name = 'e_port_time')
+        p_id_idx_tb  = tt.imatrix (name = 'e_port_id_idx')
+
+        v_prev_states = OrderedDict()
+        for k, d in iteritems(self._prev_dims):
+            v = np.zeros((batch_size, d)).astype('float32')
+            v_prev_states[k] = th.shared(v, name = 'eval_' + k, **s.device)
+        for k, v in iteritems(v_prev_states):
+            self._v_eval_prev_states['eval_%d_%d_%s'
+                                     % (window_size, batch_size, k)] = v
+
+        # layers are set up for options['window_size'] (& unroll_scan)
+        layers = [l for l in self._layers if hasattr(l, 'n_steps')]
+        saved = [(l.n_steps, l.unroll_scan, l.unroll_factor) for l in layers]
+        for l in layers:
+            l.n_steps, l.unroll_scan = window_size, False
+            if window_size % l.unroll_factor != 0:
+                l.unroll_factor = 1
+        try:
+            s_output_tbi, prev_state_updates = self._setup_forward_graph \
+                (s_input_tbi     = s.transfer(p_input_tbi),
+                 s_time_tb       = s.transfer(p_time_tb),
+                 s_id_idx_tb     = s.transfer(p_id_idx_tb),
+                 s_next_prev_idx = s.transfer(tt.alloc(np.int32(window_size
+                                                                - 1))),
+                 v_params        = s.v_params,
+                 v_prev_states   = v_prev_states)
+        finally:
+            for l, (n_steps, unroll_scan, unroll_factor) in zip(layers,
+                                                                saved):
+                l.n_steps, l.unroll_scan, l.unroll_factor = \
+                    n_steps, unroll_scan, unroll_factor
+
+        s_loss_b = self._setup_loss_graph \
+            (s_output_tbi = s_output_tbi,
+             s_target_tbi = s.transfer(p_target_tbi),
+             s_time_tb    = s.transfer(p_time_tb),
+             s_step_size  = window_size)
+        p_loss_b = self.transfer(s_loss_b)
+
         on_unused_input = 'raise' if self._options['learn_id_embedding'] \
                                   else 'ignore'
-        return th.function(inputs  = self._prop_i_ports,
-                           outputs = self._prop_o_ports,
-                           updates = self._prev_state_updates,
-                           on_unused_input = on_unused_input)
+        return self._compile('eval_%d_%d' % (window_size, batch_size),
+                             inputs  = [p_input_tbi, p_target_tbi,
+                                        p_time_tb, p_id_idx_tb],
+                             outputs = [tt.sum(p_loss_b), p_loss_b],
+                             updates = prev_state_updates,
+                             on_unused_input = on_unused_input)
 
     def compile_f_fwd_bwd_propagate(self):
         """
         Compile a callable object of signature
-            f(input_tbi, target_tbi, time_tb, id_idx_tb, step_size) -> [loss]
+            f(input_tbi, target_tbi, time_tb, id_idx_tb, step_size
+              [, micro_idx]) -> [loss, loss_b]
         As a side effect, calling it updates
             v_grads, v_prev_states
         
         - Output is a list of np.ndarray (i.e., loss = np.asscalar(output[0]))
         - For validation (obtain loss only), call f_fwd_propagate instead
+        - With micro-batches (see f_fwd_propagate), gradients of micro_idx > 0
+          are added to v_grads, so that after all n micro-batches v_grads
+          hold gradients of the whole minibatch for f_update_v_params
         """
-        assert self._is_training
+        assert self._is_training and not self._grads_released
         on_unused_input = 'raise' if self._options['learn_id_embedding'] \
                                   else 'ignore'
-        return th.function(inputs  = self._prop_i_ports,
-                           outputs = self._prop_o_ports,
-                           updates = (self._grad_updates
-                                      + self._prev_state_updates),
-                           on_unused_input = on_unused_input)
+        return self._compile('fwd_bwd_propagate',
+                             inputs  = self._prop_i_ports,
+                             outputs = self._prop_o_ports,
+                             updates = (self._grad_updates
+                                        + self._prev_state_updates),
+                             on_unused_input = on_unused_input)
     
     def compile_f_update_v_params(self):
         """
@@ -506,10 +804,125 @@ class Net():
           because it uses gradients stored in _v_grads
         - For validation, don't call f_update_v_params
         """
+        assert self._is_training and not self._grads_released
+        return self._compile('update_v_params',
+                             inputs  = self._update_i_ports,
+                             outputs = [],
+                             updates = self._optim_param_updates)
+
+    def compile_f_train_step(self, release_grads = True):
+        """
+        Compile a callable object of signature
+            f(input_tbi, target_tbi, time_tb, id_idx_tb, step_size, lr)
+                -> None
+        As a side effect, calling it updates
+            v_prev_states, v_optim_states, v_params, accumulators
+        
+        - Equivalent to f_fwd_bwd_propagate followed by f_update_v_params,
+          but in one call without storing gradients in _v_grads or
+          returning loss to host (use pull_accumulators once in a while)
+        - If release_grads, memory of _v_grads is released, after which
+          f_fwd_bwd_propagate/f_update_v_params cannot be compiled
+        - Not available with micro-batches
+        """
+        assert self._is_training and self._fused_updates is not None
+        on_unused_input = 'raise' if self._options['learn_id_embedding'] \
+                                  else 'ignore'
+        f = self._compile('train_step',
+                          inputs  = self._prop_i_ports + self._update_i_ports,
+                          outputs = [],
+                          updates = (self._fused_updates
+                                     + self._prev_state_updates),
+                          on_unused_input = on_unused_input)
+        if release_grads:
+            self._release_grads()
+        return f
+
+    def _release_grads(self):
+        for v_grad in self._v_grads: # keep ndim for type
+            v_grad.set_value(np.zeros((0,) * v_grad.ndim, 'float32'))
+        self._grads_released = True
+
+    def _setup_multi_step_graph(self):
+        """
+        Connect the fused train step into a scan over minibatches (leading k
+        dimension), carrying params, prev_states & optimizer states through
+        scan instead of shared variables
+            inputs  : input, target, time, id_idx (all _k), step_size, lr
+            outputs : loss_k
+            updates : prev_states, params, optimizer states
+        """
+        updates = [u for u in self._fused_updates + self._prev_state_updates
+                   if u[0] is not self._v_loss_sum
+                      and u[0] is not self._v_frames]
+        v_states = [v for v, _ in updates]
+        n_states = len(v_states)
+
+        p_input_ktbi  = tt.ftensor4(name = 'i_port_input_k')
+        p_target_ktbi = tt.ftensor4(name = 'i_port_target_k')
+        p_time_ktb    = tt.ftensor3(name = 'i_port_time_k')
+        p_id_idx_ktb  = tt.itensor3(name = 'i_port_id_idx_k')
+        p_step_size   = tt.iscalar (name = 'i_port_step_size')
+        p_lr          = tt.fscalar (name = 'i_port_lr')
+
+        def step(*args):
+            # sequences, states, non_sequences (in the order scan passes)
+            ports = list(args[: 4]) + list(args[4 + n_states :])
+            replace = dict(zip(self._prop_i_ports + self._update_i_ports,
+                               ports))
+            replace.update(zip(v_states, args[4 : 4 + n_states]))
+            return th.clone([s_new for _, s_new in updates]
+                            + [self._prop_o_ports[0]], replace = replace)
+
+        s_outs, _ = th.scan(fn            = step,
+                            sequences     = [p_input_ktbi, p_target_ktbi,
+                                             p_time_ktb, p_id_idx_ktb],
+                            outputs_info  = v_states + [None],
+                            non_sequences = [p_step_size, p_lr])
+
+        self._multi_i_ports  = [p_input_ktbi, p_target_ktbi, p_time_ktb,
+                                p_id_idx_ktb, p_step_size, p_lr]
+        self._multi_o_ports  = [s_outs[-1]]
+        self._multi_updates  = [(v, s_out[-1]) for v, s_out in
+                                zip(v_states, s_outs[: n_states])]
+
+    def compile_f_train_steps(self, release_grads = True):
+        """
+        Compile a callable object of signature
+            f(input_ktbi, target_ktbi, time_ktb, id_idx_ktb, step_size, lr)
+                -> [loss_k]
+        As a side effect, calling it updates
+            v_prev_states, v_optim_states, v_params
+        
+        - Equivalent to calling f_train_step for k consecutive minibatches
+          (k may vary between calls), in one call with one loop on GPU
+        - release_grads as in compile_f_train_step
+        - Not available with micro-batches
+        """
+        assert self._is_training and self._fused_updates is not None
+        self._setup_multi_step_graph()
+        on_unused_input = 'raise' if self._options['learn_id_embedding'] \
+                                  else 'ignore'
+        f = self._compile('train_steps',
+                          inputs  = self._multi_i_ports,
+                          outputs = self._multi_o_ports,
+                          updates = self._multi_updates,
+                          on_unused_input = on_unused_input)
+        if release_grads:
+            self._release_grads()
+        return f
+
+    def pull_accumulators(self):
+        """
+        Return (loss, frames) summed by f_train_step since last call
+        (one transfer from GPU), and reset them to 0
+        """
         assert self._is_training
-        return th.function(inputs  = self._update_i_ports,
-                           outputs = [],
-                           updates = self._optim_param_updates)
+        loss_sum = float(self._v_loss_sum.get_value())
+        frames   = int  (self._v_frames  .get_value())
+        self._v_loss_sum.set_value(np.float64(0.))
+        self._v_frames  .set_value(np.float64(0.))
+        return loss_sum, frames
 
     def compile_f_initialize_optimizer(self):
         """
@@ -520,31 +933,162 @@ class Net():
         Call f_initialize_optimizer when learning rate has changed
         """
         assert self._is_training
-        return th.function(inputs  = [],
-                           outputs = [],
-                           updates = self._optim_inits)
+        return self._compile('initialize_optimizer',
+                             inputs  = [],
+                             outputs = [],
+                             updates = self._optim_inits)
 
-    def save_to_workspace(self, name = None):
+    def _init_writer(self):
         """
-        Transfer parameters from GPU to file
+        Background thread that writes parameter snapshots to file
         """
-        assert self._is_training
-        sfx = name if name is not None else ''
+        self._writes = queue.Queue() # (file name, f(file)) or None to stop
+        self._write_error = None     # re-raised in wait_for_workspace
+
+        self.snapshot_time = 0. # seconds spent pulling params (blocking)
+        self.write_time    = 0. # seconds spent writing files (background)
+
+        self._snapshots = {} # name -> OrderedDict of host copies of params
+
+        if self._save_to is None: # (replica without workspace)
+            return
+        self._writer = threading.Thread(target = self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _write(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                self._writes.task_done()
+                return
+            file_name, write = item
+            start = time.time()
+            try:
+                # write to temporary file and rename, such that file_name
+                # is always complete
+                tmp_name = file_name + '.tmp'
+                with open(tmp_name, 'wb') as f:
+                    write(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_name, file_name) # atomic on POSIX
+            except Exception as e:
+                self._write_error = e
+            self.write_time += time.time() - start
+            self._writes.task_done()
 
+    def wait_for_workspace(self):
+        """
+        Block until all pending writes from save_to_workspace are finished
+        """
+        assert self._is_training and self._save_to is not None
+        self._writes.join()
+        if self._write_error is not None:
+            e, self._write_error = self._write_error, None
+            raise e
+
+    def _pull_params(self):
+        start = time.time()
         # v_params in all slices are in sync, so we just use 0-th
+        # (get_value returns a copy, so a pulled snapshot is never modified)
         for k, v_param in iteritems(self._slices[0].v_params):
             self._params[k] = v_param.get_value() # pull from GPU
+        self.snapshot_time += time.time() - start
+        return self._params.copy()
+
+    def snapshot(self, name):
+        """
+        Keep a copy of current parameters in host memory under given name
+        """
+        assert self._is_training
+        self._snapshots[name] = self._pull_params()
+
+    def restore(self, name):
+        """
+        Transfer parameters from snapshot of given name to GPU
+        """
+        assert self._is_training
+        self.set_params(self._snapshots[name])
+
+    def get_params(self):
+        """
+        Return host copies of parameters (OrderedDict)
+        """
+        return self._pull_params()
+
+    def set_params(self, params):
+        """
+        Transfer parameters (dict of np.ndarray) to GPU
+        """
+        for s in self._slices:
+            for k, v_param in iteritems(s.v_params):
+                v_param.set_value(params[k]) # push to GPU
+
+    def get_grads(self):
+        """
+        Return gradients last computed by f_fwd_bwd_propagate (list in the
+        same order as parameters; may alias internal buffers, do not modify)
+        """
+        assert self._is_training and not self._grads_released
+        return [v.get_value(borrow = True) for v in self._v_grads]
+
+    def set_grads(self, grads):
+        """
+        Replace gradients to be used by f_update_v_params (e.g., summed
+        over data parallel processes)
+        """
+        assert self._is_training and not self._grads_released
+        for v, grad in zip(self._v_grads, grads):
+            v.set_value(grad)
+
+    def copy_snapshot(self, name_from, name_to):
+        """
+        Keep snapshot name_from also under name_to (without copying, as
+        snapshots are never modified)
+        """
+        self._snapshots[name_to] = self._snapshots[name_from]
+
+    def get_snapshot(self, name):
+        """
+        Return snapshot of given name (OrderedDict; do not modify)
+        """
+        return self._snapshots[name]
 
+    def swap_snapshots(self, name_a, name_b):
+        """
+        Exchange snapshots of given names (either may be missing)
+        """
+        a = self._snapshots.pop(name_a, None)
+        b = self._snapshots.pop(name_b, None)
+        if b is not None:
+            self._snapshots[name_a] = b
+        if a is not None:
+            self._snapshots[name_b] = a
+
+    def save_to_workspace(self, name = None, from_snapshot = None):
+        """
+        Transfer parameters from GPU (or snapshot of given name) to file
+        Returns after copying parameters to host; file is written in the
+        background (see wait_for_workspace)
+        """
+        assert self._is_training and self._save_to is not None
+        sfx = name if name is not None else ''
+
+        params = self._snapshots[from_snapshot] \
+                 if from_snapshot is not None else self._pull_params()
         # There is also savez_compressed, but parameter data
         # doesn't offer much opportunities for compression
-        np.savez(self._save_to + '/params' + sfx + '.npz', **self._params)
+        self._writes.put((self._save_to + '/params' + sfx + '.npz',
+                          lambda f: np.savez(f, **params)))
 
     def load_from_workspace(self, name = None):
         """
         Transfer parameters from file to GPU
         """
-        assert self._is_training
+        assert self._is_training and self._save_to is not None
         sfx = name if name is not None else ''
+        self.wait_for_workspace()
         
         # ret = NpzFile object
         params = np.load(self._save_to + '/params' + sfx + '.npz')
@@ -556,11 +1100,81 @@ class Net():
         """
         Remove temporary file from the workspace
         """
-        assert self._is_training
+        assert self._is_training and self._save_to is not None
         sfx = name if name is not None else ''
+        self.wait_for_workspace()
 
         os.remove(self._save_to + '/params' + sfx + '.npz')
     
+    def save_training_state(self, extra):
+        """
+        Write everything needed to resume training to the workspace (in the
+        background): parameters, optimizer states, prev_states, snapshots,
+        and extra (any picklable object, e.g., scheduler & DataIter states)
+        """
+        assert self._is_training and self._save_to is not None
+        state = dict(options     = self._options,
+                     params      = self._pull_params(),
+                     optim       = self.get_optim_state(),
+                     prev_states = self.get_prev_states(),
+                     snapshots   = dict(self._snapshots),
+                     extra       = extra)
+        self._writes.put((self._save_to + '/state.pkl',
+                          lambda f: pk.dump(state, f, pk.HIGHEST_PROTOCOL)))
+
+    def load_training_state(self):
+        """
+        Restore state written by save_training_state and return its extra
+        (None if the workspace has no state)
+        """
+        assert self._is_training and self._save_to is not None
+        self.wait_for_workspace()
+        file_name = self._save_to + '/state.pkl'
+        if not os.path.isfile(file_name):
+            return None
+        with open(file_name, 'rb') as f:
+            state = pk.load(f)
+        assert state['options'] == self._options, \
+               'Mismatching options in training state'
+
+        for s in self._slices:
+            for k, v_param in iteritems(s.v_params):
+                v_param.set_value(state['params'][k]) # push to GPU
+        self.set_optim_state(state['optim'])
+        self.set_prev_states(state['prev_states'])
+        self._snapshots = state['snapshots']
+        return state['extra']
+
+    def get_optim_state(self):
+        """
+        Return copies of optimizer states (list, from GPU)
+        """
+        assert self._is_training
+        return [v.get_value() for v, _ in self._optim_inits]
+
+    def set_optim_state(self, optim_state):
+        """
+        Restore optimizer states returned by get_optim_state (to GPU)
+        """
+        assert self._is_training
+        for (v, _), value in zip(self._optim_inits, optim_state):
+            v.set_value(value)
+
+    def get_prev_states(self):
+        """
+        Return copies of prev_states of all slices (from GPU)
+        """
+        return [[v.get_value() for v in itervalues(s.v_prev_states)]
+                for s in self._slices]
+
+    def set_prev_states(self, prev_states):
+        """
+        Restore prev_states returned by get_prev_states (to GPU)
+        """
+        for s, values in zip(self._slices, prev_states):
+            for v, value in zip(itervalues(s.v_prev_states), values):
+                v.set_value(value)
+
     def transfer(self, s_in):
         """
         Return given node transferred to Net's device (same as 0-th Slice)
@@ -0,0 +1,482 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Data parallel training over multiple processes on one machine (CPU)
+
+- Each of n_procs processes (rank 0 is the calling process) holds a Net
+  replica with batch_size / n_procs batch columns and a DataIter over its own
+  shard of the sequences
+- Every step, gradients (with loss and frame count) of all processes are
+  summed through shared memory (each process sums one chunk of the vector
+  over all processes, then all read the whole sum) and every replica applies
+  the same update, so replicas stay in sync without exchanging parameters
+- Gradients are summed unclipped; options['grad_norm_clip'] is applied to
+  the sum by f_update_v_params, as for one process with the full batch
+- Use with THEANO_FLAGS=device=cpu; it is recommended to limit BLAS threads
+  per process (e.g., OMP_NUM_THREADS=1) when n_procs ~ number of cores
+
+Asynchronous training with a parameter server over ZeroMQ (multiple nodes)
+
+- ParamServer owns the master parameters & optimizer state (a Net with its
+  f_update_v_params); each worker (ps_work, any process on any node) pulls
+  parameters, computes gradients on a full minibatch of its own shard, and
+  pushes them back, receiving new parameters in the reply
+- Gradients computed on parameters more than max_staleness updates behind
+  the server are dropped (bounded staleness), so fast workers never move the
+  parameters far away from what slow workers are computing on
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import multiprocessing as mp
+import time
+import traceback
+import numpy as np
+from collections import OrderedDict
+
+# fork (instead of spawn/forkserver) lets workers inherit constructors given
+# as closures; workers are started before any Theano function is compiled
+_mp = mp.get_context('fork') if hasattr(mp, 'get_context') else mp
+
+class Barrier():
+    def __init__(self, n_procs):
+        """
+        Reusable barrier for n_procs processes (multiprocessing.Barrier is
+        not available in Python 2)
+        """
+        self._n_procs    = n_procs
+        self._count      = _mp.RawValue('i', 0)
+        self._generation = _mp.RawValue('i', 0)
+        self._cond       = _mp.Condition()
+
+    def wait(self):
+        with self._cond:
+            generation = self._generation.value
+            self._count.value += 1
+            if self._count.value == self._n_procs:
+                self._count.value = 0
+                self._generation.value += 1
+                self._cond.notify_all()
+            else:
+                while generation == self._generation.value:
+                    self._cond.wait()
+
+class AllReduce():
+    def __init__(self, n_procs, size):
+        """
+        Sum of float32 vectors of given size over n_procs processes
+        """
+        self._n_procs = n_procs
+        self._size    = size
+        self._bufs    = _mp.RawArray('f', n_procs * size) # one per process
+        self._sum     = _mp.RawArray('f', size)
+        self._barrier = Barrier(n_procs)
+        self._bounds  = np.linspace(0, size, n_procs + 1).astype('int64')
+
+    def __call__(self, rank, arrays):
+        """
+        Return list of sums of given arrays over all processes (views of
+        shared memory valid until the next call; all processes must call)
+        """
+        bufs = np.ctypeslib.as_array(self._bufs) \
+                 .reshape((self._n_procs, self._size))
+        tot  = np.ctypeslib.as_array(self._sum)
+
+        i = 0
+        for arr in arrays:
+            bufs[rank, i : i + arr.size] = arr.ravel()
+            i += arr.size
+        assert i == self._size
+        self._barrier.wait()
+
+        # fixed summation order, so that all processes get identical sums
+        lo, hi = self._bounds[rank], self._bounds[rank + 1]
+        np.sum(bufs[:, lo : hi], axis = 0, out = tot[lo : hi])
+        self._barrier.wait()
+
+        sums = []
+        i = 0
+        for arr in arrays:
+            sums.append(tot[i : i + arr.size].reshape(arr.shape))
+            i += arr.size
+        return sums
+
+def _run_forked(conn, f, item):
+    try:
+        result = (True, f(item))
+    except Exception:
+        result = (False, traceback.format_exc())
+    conn.send(result)
+    conn.close()
+
+def fork_map(f, items):
+    """
+    Return [f(item) for item in items], evaluated concurrently in processes
+    forked from the caller (each starts with a copy of the caller's state,
+    including compiled functions & data iterators, and changes to it are
+    lost; results must be picklable)
+    - Threads of the caller (e.g., of Prefetcher) do not exist in children
+    """
+    conns = []
+    procs = []
+    for item in items:
+        conn, child_conn = _mp.Pipe(False)
+        proc = _mp.Process(target = _run_forked, args = (child_conn, f, item))
+        proc.start()
+        conns.append(conn)
+        procs.append(proc)
+
+    results = []
+    for conn, proc in zip(conns, procs):
+        ok, result = conn.recv() # before join (large results fill the pipe)
+        proc.join()
+        assert ok, 'Error in forked process\n' + result
+        results.append(result)
+    return results
+
+def _serve_forked(conn, f):
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        try:
+            result = (True, f(item))
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send(result)
+    conn.close()
+
+class Worker():
+    def __init__(self, f):
+        """
+        Process forked from the caller (see fork_map) that computes f(item)
+        for each submitted item in the background, one at a time
+        """
+        self._conn, child_conn = _mp.Pipe()
+        self._proc = _mp.Process(target = _serve_forked,
+                                 args = (child_conn, f))
+        self._proc.daemon = True
+        self._proc.start()
+        self._n_pending = 0
+
+    def submit(self, item):
+        self._conn.send(item)
+        self._n_pending += 1
+
+    def result(self):
+        """
+        Block until the earliest pending f(item) is done and return it
+        """
+        assert self._n_pending > 0
+        ok, result = self._conn.recv()
+        self._n_pending -= 1
+        assert ok, 'Error in forked process\n' + result
+        return result
+
+    def close(self):
+        while self._n_pending > 0:
+            self._conn.recv()
+            self._n_pending -= 1
+        self._conn.send(None)
+        self._proc.join()
+
+def train_steps(rank, net, data_iter, f_fwd_bwd_propagate, f_update_v_params,
+                all_reduce, lr, n_steps, step_size, discard):
+    """
+    Run n_steps synchronized training steps (all processes must call;
+    all_reduce = None for a single process)
+    Returns loss and number of frames of data (excluding padding) summed over
+    all processes
+    """
+    if discard:
+        data_iter.discard_unfinished()
+    data_iter.set_step_size(step_size)
+
+    loss_sum = 0.
+    frames   = 0
+    for _ in range(n_steps):
+        input_tbi, target_tbi, time_tb, id_idx_tb = next(data_iter)
+        loss = f_fwd_bwd_propagate(input_tbi, target_tbi,
+                                   time_tb, id_idx_tb, step_size)
+        n = np.count_nonzero(time_tb[-step_size :] >= 0.)
+
+        if all_reduce is None: # single process
+            sums = [np.float32(loss[0]), np.float32(n)]
+        else:
+            sums = all_reduce(rank, net.get_grads()
+                                    + [np.float32(loss[0]), np.float32(n)])
+            net.set_grads(sums[: -2])
+        f_update_v_params(lr)
+
+        loss_sum += float(sums[-2])
+        frames   += int  (sums[-1])
+    return loss_sum, frames
+
+def _work(rank, conn, make_net, make_data_iter, all_reduce, params):
+    params_buf = np.ctypeslib.as_array(params)
+    net = make_net(rank)
+    data_iter = make_data_iter(rank)
+    f_fwd_bwd_propagate = net.compile_f_fwd_bwd_propagate()
+    f_update_v_params = net.compile_f_update_v_params()
+    f_initialize_optimizer = net.compile_f_initialize_optimizer()
+    conn.send('ready')
+
+    while True:
+        cmd = conn.recv()
+        if cmd[0] == 'train':
+            train_steps(rank, net, data_iter, f_fwd_bwd_propagate,
+                        f_update_v_params, all_reduce, *cmd[1 :])
+        elif cmd[0] == 'set_params':
+            params = net.get_params()
+            i = 0
+            for k, v in params.items():
+                params[k] = params_buf[i : i + v.size].reshape(v.shape)
+                i += v.size
+            net.set_params(params)
+            conn.send('done')
+        elif cmd[0] == 'initialize_optimizer':
+            f_initialize_optimizer()
+        elif cmd[0] == 'stop':
+            return
+
+class DataParallel():
+    def __init__(self, n_procs, make_net, make_data_iter, n_params):
+        """
+        Start n_procs - 1 worker processes (ranks 1 ~ n_procs - 1), each
+        calling make_net(rank) & make_data_iter(rank) to make its replica
+            n_params    int     total number of parameter elements
+        - Call before compiling any function in this process
+        """
+        assert n_procs > 1
+        self._n_procs = n_procs
+        self._n_params = n_params
+        self.all_reduce = AllReduce(n_procs, n_params + 2) # + loss, frames
+        self._params = _mp.RawArray('f', n_params)
+
+        self._conns = []
+        self._procs = []
+        for rank in range(1, n_procs):
+            conn, worker_conn = _mp.Pipe()
+            proc = _mp.Process(target = _work,
+                               args = (rank, worker_conn, make_net,
+                                       make_data_iter, self.all_reduce,
+                                       self._params))
+            proc.daemon = True
+            proc.start()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+    def wait_ready(self):
+        """
+        Block until all workers have compiled their functions
+        """
+        for conn in self._conns:
+            assert conn.recv() == 'ready'
+
+    def train(self, net, data_iter, f_fwd_bwd_propagate, f_update_v_params,
+              lr, n_steps, step_size, discard):
+        """
+        Run n_steps training steps in all processes, with given objects of
+        rank 0 (this process); returns (loss, frames) summed over all
+        """
+        for conn in self._conns:
+            conn.send(('train', lr, n_steps, step_size, discard))
+        return train_steps(0, net, data_iter, f_fwd_bwd_propagate,
+                           f_update_v_params, self.all_reduce,
+                           lr, n_steps, step_size, discard)
+
+    def set_params(self, params):
+        """
+        Set parameters (OrderedDict in Net's order) of all worker replicas
+        """
+        buf = np.ctypeslib.as_array(self._params)
+        i = 0
+        for v in params.values():
+            buf[i : i + v.size] = v.ravel()
+            i += v.size
+        assert i == self._n_params
+        for conn in self._conns:
+            conn.send(('set_params',))
+        for conn in self._conns:
+            assert conn.recv() == 'done'
+
+    def initialize_optimizer(self):
+        for conn in self._conns:
+            conn.send(('initialize_optimizer',))
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(('stop',))
+        for proc in self._procs:
+            proc.join()
+
+
+def _flatten(arrays):
+    return np.concatenate([arr.ravel() for arr in arrays]).astype('float32')
+
+def _unflatten(buf, like):
+    """
+    Split flat float32 buffer into a list of arrays of shapes in like
+    """
+    arrays = []
+    i = 0
+    for arr in like:
+        arrays.append(buf[i : i + arr.size].reshape(arr.shape))
+        i += arr.size
+    assert i == buf.size
+    return arrays
+
+class ParamServer():
+    def __init__(self, address, net, f_update_v_params, n_workers,
+                 max_staleness = 4):
+        """
+        Serve parameters of net (training Net) to n_workers workers at given
+        ZeroMQ address (e.g., 'tcp://*:5555'); apply their gradients with
+        f_update_v_params (compiled from net)
+        """
+        import zmq # (only needed for parameter server)
+
+        self._net               = net
+        self._f_update_v_params = f_update_v_params
+        self._n_workers         = n_workers
+        self._max_staleness     = max_staleness
+
+        self._context = zmq.Context()
+        self._socket  = self._context.socket(zmq.REP)
+        self._socket.bind(address)
+
+        self._like    = list(net.get_params().values())
+        self._version = 0 # number of updates applied
+        self._epoch   = 0
+        self._discard = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        # staleness[s] counts applied gradients computed s updates behind
+        self.staleness = np.zeros(self._max_staleness + 1, dtype = 'int64')
+        self.dropped   = 0
+        self.frames    = 0
+        self.seconds   = 0.
+
+    def invalidate(self):
+        """
+        Drop gradients in flight (call after parameters are replaced, e.g.,
+        by Net.restore)
+        """
+        self._version += self._max_staleness + 1
+
+    def _reply(self):
+        meta = np.array([self._version, self._epoch, self._discard],
+                        dtype = 'int64')
+        self._socket.send_multipart \
+            ([b'params', meta.tobytes(),
+              _flatten(self._net.get_params().values()).tobytes()])
+
+    def serve(self, lr, n_steps, discard = True):
+        """
+        Apply n_steps gradients pushed by workers with learning rate lr
+        (workers discard unfinished sequences once, if discard)
+        Returns loss and number of frames of data (excluding padding) summed
+        over the applied gradients
+        """
+        self._epoch  += 1
+        self._discard = discard
+
+        loss_sum = 0.
+        frames   = 0
+        n_applied = 0
+        start = time.time()
+        while n_applied < n_steps:
+            msg = self._socket.recv_multipart()
+            if msg[0] == b'push':
+                version, loss, n = np.frombuffer(msg[1], dtype = 'float64')
+                staleness = self._version - int(version)
+                if staleness <= self._max_staleness:
+                    grads = np.frombuffer(msg[2], dtype = 'float32')
+                    self._net.set_grads(_unflatten(grads, self._like))
+                    self._f_update_v_params(lr)
+                    self._version += 1
+                    self.staleness[staleness] += 1
+                    loss_sum += loss
+                    frames   += int(n)
+                    n_applied += 1
+                else:
+                    self.dropped += 1
+            self._reply()
+        self.frames  += frames
+        self.seconds += time.time() - start
+        return loss_sum, frames
+
+    def summary(self):
+        """
+        Throughput and staleness histogram since last reset_stats
+        """
+        return ('%.3g frames/s, staleness ' % (self.frames
+                                               / max(self.seconds, 1e-9))
+                + ' '.join('%d:%d' % (s, c) for s, c
+                           in enumerate(self.staleness))
+                + ', %d dropped' % self.dropped)
+
+    def stop(self):
+        """
+        Tell all workers to stop (at their next request) and close
+        """
+        for _ in range(self._n_workers):
+            self._socket.recv_multipart()
+            self._socket.send_multipart([b'stop'])
+        self._socket.close()
+        self._context.term()
+
+def ps_work(address, net, data_iter, f_fwd_bwd_propagate, step_size):
+    """
+    Train as a worker of the ParamServer at given address (e.g.,
+    'tcp://host:5555') until told to stop
+    """
+    import zmq
+
+    context = zmq.Context()
+    socket  = context.socket(zmq.REQ)
+    socket.connect(address)
+
+    template = net.get_params()
+    like  = list(template.values())
+    epoch = 0
+    data_iter.set_step_size(step_size)
+
+    socket.send_multipart([b'pull'])
+    while True:
+        msg = socket.recv_multipart()
+        if msg[0] == b'stop':
+            break
+        version, new_epoch, discard = np.frombuffer(msg[1], dtype = 'int64')
+        params = np.frombuffer(msg[2], dtype = 'float32')
+        net.set_params(OrderedDict(zip(template.keys(),
+                                       _unflatten(params, like))))
+        if new_epoch != epoch:
+            epoch = new_epoch
+            if discard:
+                data_iter.discard_unfinished()
+
+        input_tbi, target_tbi, time_tb, id_idx_tb = next(data_iter)
+        loss = f_fwd_bwd_propagate(input_tbi, target_tbi,
+                                   time_tb, id_idx_tb, step_size)
+        n = np.count_nonzero(time_tb[-step_size :] >= 0.)
+
+        meta = np.array([version, loss[0], n], dtype = 'float64')
+        socket.send_multipart([b'push', meta.tobytes(),
+                               _flatten(net.get_grads()).tobytes()])
+
+    socket.close()
+    context.term()
@@ -0,0 +1,102 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Program for offline preparation of datasets (run once per dataset)
+
+Use as (for example):
+    python prepare.py index --data_dir=$DATA_DIR --input_dim=44 --target_dim=1
+    python prepare.py pack --data_dir=$DATA_DIR --input_dim=44 --target_dim=1
+    python prepare.py convert --data_dir=$DATA_DIR --input_dim=44 \
+        --target_dim=1 --seq_format=int16
+    python prepare.py whiten --data_dir=$DATA_DIR --input_dim=44 --target_dim=1
+
+- index   : index sequence lengths & IDs of train.list/dev.list into
+            $DATA_DIR/{train,dev}.index.npz (in parallel over --n_procs),
+            which DataIter, build_id_idx, and train.py load instead
+- pack    : pack train.list/dev.list into $DATA_DIR/{train,dev}.pack(.npz)
+            for use with DataIter(..., packed = True)
+- convert : write sequences in a compact on-disk format (float16/int16/int8)
+            for use with DataIter(..., seq_format = ...) and report accuracy
+- whiten  : compute mean & ZCA whitening matrices of train.list inputs into
+            $DATA_DIR/{mean,whitening}.matrix (in parallel over --n_procs)
+            for use with train.py --whiten on raw (not whitened) data
+- Run convert before pack if packing a format other than float32
+- Re-run whenever the .list files or the sequences change
+  (an outdated index is ignored)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+from data import index_list, pack_list, convert_list, FORMATS, \
+                 whitening_matrices, write_matrix
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type = str,
+                        choices = ['index', 'pack', 'convert', 'whiten'])
+    parser.add_argument('--data_dir'  , type = str, required = True)
+    parser.add_argument('--input_dim' , type = int, required = True)
+    parser.add_argument('--target_dim', type = int, required = True)
+    parser.add_argument('--lists'     , type = str, default = 'train,dev')
+    parser.add_argument('--seq_format', type = str, default = 'float32',
+                        choices = list(FORMATS))
+    parser.add_argument('--n_procs'   , type = int) # default: all cores
+    args = parser.parse_args()
+
+    if args.command == 'whiten':
+        list_file = args.data_dir + '/train.list'
+        print('Whitening ' + list_file + '... ', end = '')
+        start = time.time()
+        mean, whitening = whitening_matrices(list_file, args.input_dim,
+                                             args.n_procs)
+        write_matrix(args.data_dir + '/mean.matrix'     , mean     )
+        write_matrix(args.data_dir + '/whitening.matrix', whitening)
+        print('(%.1f sec)' % (time.time() - start))
+        return
+
+    for name in args.lists.split(','):
+        list_file = args.data_dir + '/' + name + '.list'
+
+        if args.command == 'index':
+            print('Indexing ' + list_file + '... ', end = '')
+            start = time.time()
+            index = index_list(list_file, args.input_dim, args.target_dim,
+                               args.n_procs)
+            print('%d seqs, %d frames, %d IDs (%.1f sec)'
+                  % (len(index['seqs']), index['lengths'].sum(),
+                     len(index['ids']), time.time() - start))
+
+        if args.command == 'pack':
+            print('Packing ' + list_file + '... ', end = '')
+            start = time.time()
+            n_frames = pack_list(list_file, args.input_dim, args.target_dim,
+                                 args.seq_format)
+            print(str(n_frames) + ' frames (%.1f sec)' % (time.time() - start))
+
+        if args.command == 'convert':
+            print('Converting ' + list_file + ' to ' + args.seq_format
+                  + '... ', end = '')
+            start = time.time()
+            stats = convert_list(list_file, args.input_dim, args.target_dim,
+                                 args.seq_format)
+            print('(%.1f sec)' % (time.time() - start))
+            maxlen = max(len(k) for k in stats.keys())
+            for k, v in stats.items():
+                print('    ' + k.ljust(maxlen) + ' : %.6g' % v)
+
+if __name__ == '__main__':
+    main()
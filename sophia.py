@@ -18,15 +18,27 @@ Program for real-time inference via ZeroMQ IPC/TCP with an external process
 - Use the same THEANO_FLAGS as in train.py
 - If unneeded, suppress device info output with an additional
   'print_active_device=False' flag
+- Compiled propagators are cached (see FunctionCache in utils.py), so nets
+  with the same options share one compiled function and later launches
+  skip compilation
+- With --engine=numpy, nets run on the pure NumPy engine (engine.py), which
+  starts without importing Theano or compiling and has less per-step
+  overhead at small batch sizes
 """
 
 from __future__ import absolute_import, division, print_function
 
+import argparse
 import zmq
 import numpy as np
 from ensemble import Ensemble
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', type = str, default = 'theano',
+                        choices = ['theano', 'numpy'])
+    args = parser.parse_args()
+
     context = zmq.Context()
     socket = context.socket(zmq.REP)
     
@@ -56,7 +68,11 @@ def main():
         assert len(indice) == batch_size
         indices.append(indice)
     
-    ensemble = Ensemble(workspaces, batch_size, indices) # time consuming
+    ensemble = Ensemble(workspaces, batch_size, indices,
+                        engine = args.engine) # time consuming (theano)
+    if args.engine == 'theano':
+        from utils import function_cache
+        print('Compiled function cache : ' + function_cache.summary())
     socket.send('ready') # to fulfill REQ/REP pattern
 
     while True:
@@ -22,6 +22,13 @@ Use as (for example):
     THEANO_FLAGS=$FLAGS python -u train.py --data_dir=$DATA_DIR \
         --save_to=$WORKSPACE_DIR/workspace_$NAME \
         [--load_from=$WORKSPACE_DIR/workspace_$LOADNAME] [--seed=some_number] \
+        [--packed] [--prefetch=n_ahead] [--cache_mb=size] [--pin_dev] \
+        [--seq_format=float32/float16/int16/int8] [--whiten] [--exact_epoch] \
+        [--sample_temp=temperature] [--sample_floor=ratio] [--resume] \
+        [--fused] [--multi_step=k] [--workers=n] \
+        [--ps_bind=tcp://*:port / --ps_connect=tcp://host:port --ps_rank=i] \
+        [--ps_workers=n] [--max_staleness=s] [--branches=n] [--async_eval] \
+        [--eval_window=size --eval_batch=size] \
         | tee -a $WORKSPACE_DIR/$NAME".log"
 
 - Device "cuda$" means $-th GPU
@@ -32,6 +39,57 @@ Use as (for example):
 - Flag base_compiledir directs intermediate files to pwd/theano to avoid
   lock conflicts between multiple training instances (by default ~/.theano)
 - $NAME == $LOADNAME is permitted
+- Flag packed reads data from files made with 'python prepare.py pack'
+- Flag prefetch assembles next n_ahead minibatches in a background thread
+- Flag cache_mb keeps train sequences in an LRU cache of given size (MB)
+- Flag pin_dev keeps all dev sequences in memory
+- Flag seq_format reads files made with 'python prepare.py convert'
+- Flag whiten applies mean/whitening.matrix in $DATA_DIR while loading data
+  (for raw data; see 'python prepare.py whiten')
+- Flag exact_epoch evaluates dev loss on exactly one pass over all dev
+  sequences (in list order) and lets training resume unfinished sequences
+  across epochs instead of discarding them (except after a rollback); train
+  epochs still run for frames_per_epoch, which keeps the annealing schedule
+  in frames, so a sequence may span epochs
+- Flag sample_temp draws train sequences with probability increasing with
+  their running loss (sharper for lower temperature), mixed with uniform
+  sampling at ratio sample_floor (default 0.1)
+- Flag resume saves the full training state (optimizer, scheduler, data
+  iterators, RNG) to $save_to/state.pkl every epoch, and continues from it
+  if present (re-launch with the same flags after an interruption)
+- Flag fused trains with one compiled call per minibatch (fwd/bwd, optimizer,
+  and param update) and reads loss from GPU once per epoch (not usable with
+  sample_temp, which needs loss per minibatch)
+- Flag multi_step uploads k consecutive minibatches at once and trains on
+  them in one compiled call that loops over them on GPU (same as fused, but
+  with one call per k minibatches; returns k losses)
+- Flag workers trains with n processes (data parallel, for CPU; see
+  parallel.py), each with batch_size / n columns and 1 / n of train.list,
+  summing gradients through shared memory every step (dev set is evaluated
+  by the main process only)
+- Flag ps_bind makes this instance an asynchronous parameter server for
+  ps_workers worker instances, each launched with the same arguments but
+  ps_connect (to the server's address) & ps_rank (0 ~ ps_workers - 1)
+  instead of ps_bind; workers train on 1 / ps_workers of train.list with the
+  full batch_size and push gradients to the server, which applies those
+  computed at most max_staleness (default 4) updates ago, runs the schedule,
+  evaluates dev loss, and prints throughput & staleness histogram every
+  epoch (see parallel.py; e.g., ps_bind=tcp://*:5555 and
+  ps_connect=tcp://localhost:5555 on one node)
+- Flag branches makes each rollback of the annealing schedule (after
+  max_retry) try n learning rates (lr * lr_decay_rate^1 ~ ^n) at once, each
+  training for an epoch from the pivot in a forked process, and continue
+  from the one with the lowest dev loss (for CPU with device=cpu, as GPU
+  contexts do not survive fork; not usable with prefetch)
+- Flag async_eval evaluates dev loss of each epoch in a forked evaluator
+  process while the next epoch is trained; the schedule judges each epoch
+  when its dev loss arrives and discards the epoch trained meanwhile if it
+  rolls back (CPU only & not usable with prefetch, as for branches)
+- Flag eval_window evaluates dev loss with a separate forward-only graph of
+  that window_size (= step_size) & eval_batch (default batch_size) columns,
+  sharing parameters with training, over the whole dev set held in memory as
+  minibatches (assembled once; several times larger windows & batches than
+  for training make dev epochs several times faster)
 """
 
 from __future__ import absolute_import, division, print_function
@@ -40,7 +98,10 @@ from six import iterkeys, itervalues, iteritems
 from collections import OrderedDict
 import argparse
 from net import Net
-from data import build_id_idx, DataIter
+from data import build_id_idx, load_index, read_matrix, materialize, \
+                 DataIter, Prefetcher
+from parallel import DataParallel, ParamServer, ps_work, fork_map, Worker
+from utils import function_cache
 import time
 import numpy as np
 import theano as th
@@ -59,6 +120,8 @@ def main():
     options['net_width']          = 512
     options['net_depth']          = 12
     options['batch_size']         = 128
+    # options['micro_batches']      = 4          # fwd/bwd batch_size / 4 at
+                                                 # a time (less memory)
     options['window_size']        = 128
     options['step_size']          = 64
     options['init_scale']         = 0.02
@@ -87,6 +150,9 @@ def main():
     options['lr_decay_rate']      = 0.5
     options['max_retry']          = 10
     options['unroll_scan']        = False      # faster training/slower compile
+    # options['unroll_factor']      = 8          # steps per scan iteration
+    # options['checkpoint_layers']  = 1          # recompute k layers in bwd
+    # options['wavefront']          = True       # one scan over all layers
 
     if options['unroll_scan']:
         sys.setrecursionlimit(32 * options['window_size']) # 32 is empirical
@@ -101,11 +167,64 @@ def main():
     parser.add_argument('--save_to'  , type = str, required = True)
     parser.add_argument('--load_from', type = str)
     parser.add_argument('--seed'     , type = int)
+    parser.add_argument('--packed'   , action = 'store_true')
+    parser.add_argument('--prefetch' , type = int, default = 0)
+    parser.add_argument('--cache_mb' , type = int, default = 0)
+    parser.add_argument('--pin_dev'  , action = 'store_true')
+    parser.add_argument('--seq_format', type = str, default = 'float32')
+    parser.add_argument('--whiten'   , action = 'store_true')
+    parser.add_argument('--exact_epoch', action = 'store_true')
+    parser.add_argument('--sample_temp', type = float)
+    parser.add_argument('--sample_floor', type = float, default = 0.1)
+    parser.add_argument('--resume'   , action = 'store_true')
+    parser.add_argument('--fused'    , action = 'store_true')
+    parser.add_argument('--multi_step', type = int, default = 1)
+    parser.add_argument('--workers'  , type = int, default = 1)
+    parser.add_argument('--ps_bind'  , type = str)
+    parser.add_argument('--ps_connect', type = str)
+    parser.add_argument('--ps_rank'  , type = int, default = 0)
+    parser.add_argument('--ps_workers', type = int, default = 1)
+    parser.add_argument('--max_staleness', type = int, default = 4)
+    parser.add_argument('--branches' , type = int, default = 1)
+    parser.add_argument('--async_eval', action = 'store_true')
+    parser.add_argument('--eval_window', type = int)
+    parser.add_argument('--eval_batch', type = int)
     args = parser.parse_args()
 
+    # list of context_name's (THEANO_FLAGS=contexts=... for multi GPU mode)
+    c_names = [m.split('->')[0] for m in th.config.contexts.split(';')] \
+              if th.config.contexts != "" else None
+
+    assert args.multi_step > 0
+    multi = args.multi_step > 1
+    assert not ((args.fused or multi) and args.sample_temp is not None)
+    n_micro = options['micro_batches'] if 'micro_batches' in options else 1
+    assert not ((args.fused or multi) and n_micro > 1)
+    assert args.workers > 0
+    assert args.workers == 1 or not (args.fused or multi or n_micro > 1 or
+                                     args.sample_temp is not None or
+                                     args.resume or c_names is not None)
+    ps_mode = args.ps_bind is not None or args.ps_connect is not None
+    assert not (args.ps_bind is not None and args.ps_connect is not None)
+    assert not ps_mode or not (args.fused or multi or n_micro > 1 or
+                               args.sample_temp is not None or args.resume or
+                               args.workers > 1)
+    assert 0 <= args.ps_rank < args.ps_workers
+    assert args.branches > 0
+    assert args.branches == 1 or (th.config.device == 'cpu' and
+                                  args.prefetch == 0 and args.workers == 1
+                                  and not ps_mode)
+    assert not args.async_eval or (th.config.device == 'cpu' and
+                                   args.prefetch == 0 and not ps_mode and
+                                   args.branches == 1 and not args.resume)
+
+    if args.eval_batch is None:
+        args.eval_batch = options['batch_size']
+
     assert 0 == call(str('mkdir -p ' + args.save_to).split())
     
     # store mean/whitening matrices from Reshaper (remove if inapplicable)
+    # or from prepare.py (if applied while loading data with --whiten)
     assert 0 == call(str('cp ' + args.data_dir + '/mean.matrix '
                          + args.save_to).split())
     assert 0 == call(str('cp ' + args.data_dir + '/whitening.matrix '
@@ -117,16 +236,16 @@ def main():
     with open(args.save_to + '/ids.order', 'w') as f:
         f.write(';'.join(iterkeys(id_idx))) # code_0;...;code_N-1
 
-    def n_seqs(list_file):
+    def n_seqs_frames(list_file):
+        # number of frames is only known if indexed (see prepare.py)
+        index = load_index(list_file)
+        if index is not None:
+            return len(index['seqs']), int(index['lengths'].sum())
         with open(list_file) as f:
-            return sum(1 for line in f)
+            return sum(1 for line in f), None
     
-    n_seqs_train = n_seqs(args.data_dir + '/train.list')
-    n_seqs_dev   = n_seqs(args.data_dir + '/dev.list')
-
-    # list of context_name's (THEANO_FLAGS=contexts=... for multi GPU mode)
-    c_names = [m.split('->')[0] for m in th.config.contexts.split(';')] \
-              if th.config.contexts != "" else None
+    n_seqs_train, n_frames_train = n_seqs_frames(args.data_dir + '/train.list')
+    n_seqs_dev  , n_frames_dev   = n_seqs_frames(args.data_dir + '/dev.list')
 
     # for replicating previous experiments
     seed = np.random.randint(np.iinfo(np.int32).max) \
@@ -159,10 +278,59 @@ def main():
     print('    np.random.seed  : ' + str(seed).rjust(10))
     print('    # of train seqs : ' + str(n_seqs_train).rjust(10))
     print('    # of dev seqs   : ' + str(n_seqs_dev  ).rjust(10))
+    if n_frames_train is not None and n_frames_dev is not None:
+        print('    # of train frms : ' + str(n_frames_train).rjust(10))
+        print('    # of dev frms   : ' + str(n_frames_dev  ).rjust(10))
+        print('    epochs per pass : %10.2f'
+              % (n_frames_train / options['frames_per_epoch']))
     print('    # of unique IDs : ' + str(options['id_count']).rjust(10))
     print('    # of weights    : ', end = '')
-    net = Net(options, args.save_to, args.load_from, c_names) # takes few secs
+    net = Net(options, args.save_to, args.load_from, c_names, # takes few secs
+              args.workers)
     print(str(net.n_weights()).rjust(10))
+    if args.workers > 1:
+        print('    # of processes  : ' + str(args.workers).rjust(10))
+
+    whiten = (read_matrix(args.data_dir + '/mean.matrix'     ,
+                          (options['input_dim'],)),
+              read_matrix(args.data_dir + '/whitening.matrix',
+                          (options['input_dim'], options['input_dim']))) \
+             if args.whiten else None
+
+    # NOTE: window_size must be the same as that given to Net
+    def make_train_data(rank):
+        return DataIter(list_file   = args.data_dir + '/train.list',
+                        window_size = options['window_size'],
+                        step_size   = options['step_size'],
+                        batch_size  = options['batch_size'] // args.workers,
+                        input_dim   = options['input_dim'],
+                        target_dim  = options['target_dim'],
+                        id_idx      = id_idx,
+                        packed      = args.packed,
+                        cache_bytes = args.cache_mb * 1024 * 1024,
+                        seq_format  = args.seq_format,
+                        whiten      = whiten,
+                        sample_temp = args.sample_temp,
+                        sample_floor = args.sample_floor,
+                        shard       = (rank, args.workers)
+                                      if args.workers > 1 else
+                                      (args.ps_rank, args.ps_workers)
+                                      if args.ps_connect is not None
+                                      and args.ps_workers > 1 else None)
+    
+    def prefetched(data_iter):
+        return Prefetcher(data_iter, args.prefetch) if args.prefetch > 0 \
+               else data_iter
+
+    def make_worker_net(rank):
+        np.random.seed(seed + rank) # shuffle shards independently
+        return Net(options, args.save_to, None, None, args.workers,
+                   workspace = False) # (only rank 0 writes to save_to)
+
+    # worker processes are forked before compiling (they compile their own)
+    dp = DataParallel(args.workers, make_worker_net,
+                      lambda rank: prefetched(make_train_data(rank)),
+                      net.n_weights()) if args.workers > 1 else None
 
 
     """
@@ -172,41 +340,117 @@ def main():
     print_hline() # -----------------------------------------------------------
     print('Compiling fwd/bwd propagators... ', end = '') # takes minutes ~ 
     start = time.time()                                  # hours (unroll_scan)
-    f_fwd_bwd_propagate = net.compile_f_fwd_bwd_propagate()
-    f_fwd_propagate     = net.compile_f_fwd_propagate()
+    if multi:
+        f_train_steps = net.compile_f_train_steps()
+    elif args.fused:
+        f_train_step = net.compile_f_train_step()
+    else:
+        f_fwd_bwd_propagate = net.compile_f_fwd_bwd_propagate()
+    f_fwd_propagate = net.compile_f_fwd_propagate()
+    if args.eval_window is not None:
+        f_eval = net.compile_f_eval(args.eval_window, args.eval_batch)
     print(lapse_from(start))
 
     print('Compiling updater/initializer... ', end = '')
     start = time.time()
-    f_update_v_params = net.compile_f_update_v_params()
+    if not (args.fused or multi):
+        f_update_v_params = net.compile_f_update_v_params()
     f_initialize_optimizer = net.compile_f_initialize_optimizer()
     print(lapse_from(start))
+    print('Compiled function cache  : ' + function_cache.summary())
 
-    # NOTE: window_size must be the same as that given to Net
-    train_data = DataIter(list_file   = args.data_dir + '/train.list',
-                          window_size = options['window_size'],
-                          step_size   = options['step_size'],
-                          batch_size  = options['batch_size'],
-                          input_dim   = options['input_dim'],
-                          target_dim  = options['target_dim'],
-                          id_idx      = id_idx)
+    if dp is not None:
+        print('Waiting for worker processes... ', end = '')
+        start = time.time()
+        dp.wait_ready()
+        dp.set_params(net.get_params())
+        print(lapse_from(start))
+
+    if args.ps_connect is not None: # train as worker until server stops
+        print_hline() # -------------------------------------------------------
+        print('Training as worker ' + str(args.ps_rank) + ' of '
+              + args.ps_connect + '... ', end = '')
+        start = time.time()
+        np.random.seed(seed + args.ps_rank) # shuffle shards independently
+        ps_work(args.ps_connect, net, prefetched(make_train_data(0)),
+                f_fwd_bwd_propagate, options['step_size'])
+        print(lapse_from(start))
+        return
+
+    ps = ParamServer(args.ps_bind, net, f_update_v_params, args.ps_workers,
+                     args.max_staleness) if args.ps_bind is not None else None
+
+    train_data = make_train_data(0)
     dev_data   = DataIter(list_file  = args.data_dir + '/dev.list',
                           window_size = options['window_size'],
-                          step_size   = options['step_size'],
-                          batch_size  = options['batch_size'],
+                          step_size   = options['window_size'], # for eval
+                          batch_size  = options['batch_size'] // args.workers,
                           input_dim   = options['input_dim'],
                           target_dim  = options['target_dim'],
-                          id_idx      = id_idx)
+                          id_idx      = id_idx,
+                          packed      = args.packed,
+                          pin_all     = args.pin_dev,
+                          seq_format  = args.seq_format,
+                          whiten      = whiten,
+                          exact_pass  = args.exact_epoch)
+    caches = [('train', train_data.cache), ('dev', dev_data.cache)]
+
+    dev_batches = None
+    if args.eval_window is not None:
+        print('Loading dev set into memory... ', end = '')
+        start = time.time()
+        dev_batches = materialize \
+            (DataIter(list_file   = args.data_dir + '/dev.list',
+                      window_size = args.eval_window,
+                      step_size   = args.eval_window,
+                      batch_size  = args.eval_batch,
+                      input_dim   = options['input_dim'],
+                      target_dim  = options['target_dim'],
+                      id_idx      = id_idx,
+                      packed      = args.packed,
+                      seq_format  = args.seq_format,
+                      whiten      = whiten,
+                      exact_pass  = True))
+        print(lapse_from(start) + ' (%.1f MB)'
+              % (sum(arr.nbytes for arrs in dev_batches for arr in arrs)
+                 / (1024 * 1024)))
+    train_data = prefetched(train_data)
+    dev_data   = prefetched(dev_data  )
     
     chunk_size = options['step_size'] * options['batch_size']
     trained_frames_per_epoch = \
         (options['frames_per_epoch'] // chunk_size) * chunk_size
 
-    def run_epoch(data_iter, lr_cur):
+    train_states = [] # recurrent states left by last training epoch
+    discard_train = [False] # set at rollback (with exact_epoch)
+
+    # staging buffers for multi_step (k minibatches of DataIter outputs)
+    if multi:
+        stage = [np.zeros((args.multi_step, options['window_size'],
+                           options['batch_size']) + shape, dtype)
+                 for shape, dtype in [((options['input_dim'] ,), 'float32'),
+                                      ((options['target_dim'],), 'float32'),
+                                      ((), 'float32'), ((), 'int32')]]
+
+    def run_staged(n_staged, step_size, lr_cur):
+        """
+        Train on first n_staged minibatches in stage; return loss and number
+        of frames of data (excluding padding)
+        """
+        loss_k = f_train_steps(*([arr[: n_staged] for arr in stage]
+                                 + [step_size, lr_cur]))[0]
+        return float(np.sum(loss_k)), \
+               np.count_nonzero(stage[2][: n_staged, -step_size :] >= 0.)
+
+    def run_epoch(data_iter, lr_cur, full_pass = False):
         """
         lr_cur sets the running mode
             float   training
             None    inference
+        full_pass (for DataIter with exact_pass) runs to the end of the pass
+        instead of for trained_frames_per_epoch
+        Returns loss per frame of data (excluding padding) and seconds spent
+        waiting for data
         """
         is_training = lr_cur is not None
         if is_training:
@@ -217,29 +461,144 @@ def main():
             step_size = options['window_size']
         frames_per_step = step_size * options['batch_size']
 
-        data_iter.discard_unfinished()
+        # with exact_epoch, training resumes unfinished sequences (except
+        # after a rollback, as they were trained with discarded params)
+        keep   = is_training and args.exact_epoch
+        resume = keep and not discard_train[0]
+        if is_training:
+            discard_train[0] = False
+        if resume:
+            if len(train_states) > 0:
+                net.set_prev_states(train_states.pop())
+        elif not full_pass:
+            data_iter.discard_unfinished()
         data_iter.set_step_size(step_size)
 
         loss_sum = 0.
         frames_seen = 0
-
-        for input_tbi, target_tbi, time_tb, id_idx_tb in data_iter:
-            if is_training:
-                loss = f_fwd_bwd_propagate(input_tbi, target_tbi, 
-                                           time_tb, id_idx_tb, step_size)
+        frames_real = 0
+        data_wait = 0.
+        n_staged = 0
+
+        if is_training and dp is not None: # all processes step together
+            loss_sum, frames_real = dp.train \
+                (net, data_iter, f_fwd_bwd_propagate, f_update_v_params,
+                 lr_cur, trained_frames_per_epoch // frames_per_step,
+                 step_size, not resume)
+            frames_seen = trained_frames_per_epoch # (skip loop below)
+        elif is_training and ps is not None: # pushed by workers
+            ps.reset_stats()
+            loss_sum, frames_real = ps.serve \
+                (lr_cur, trained_frames_per_epoch // frames_per_step,
+                 not resume)
+            frames_seen = trained_frames_per_epoch
+
+        while full_pass or frames_seen < trained_frames_per_epoch:
+            start = time.time()
+            try:
+                input_tbi, target_tbi, time_tb, id_idx_tb = next(data_iter)
+            except StopIteration: # end of pass
+                break
+            data_wait += time.time() - start
+
+            if is_training and multi: # train once k minibatches are staged
+                for dst, src in zip(stage, (input_tbi, target_tbi,
+                                            time_tb, id_idx_tb)):
+                    dst[n_staged] = src
+                n_staged += 1
+                if n_staged == args.multi_step:
+                    loss, frames = run_staged(n_staged, step_size, lr_cur)
+                    loss_sum    += loss
+                    frames_real += frames
+                    n_staged = 0
+            elif is_training and args.fused: # loss & frames summed on GPU
+                f_train_step(input_tbi, target_tbi, time_tb, id_idx_tb,
+                             step_size, lr_cur)
             else:
-                loss = f_fwd_propagate(input_tbi, target_tbi, 
-                                       time_tb, id_idx_tb, step_size)
-            
-            loss_sum    += np.asscalar(loss[0])
+                f = f_fwd_bwd_propagate if is_training else f_fwd_propagate
+                if n_micro == 1:
+                    loss = f(input_tbi, target_tbi, 
+                             time_tb, id_idx_tb, step_size)
+                else: # columns of micro-batch j
+                    m = options['batch_size'] // n_micro
+                    losses = [f(input_tbi [:, j * m : (j + 1) * m],
+                                target_tbi[:, j * m : (j + 1) * m],
+                                time_tb   [:, j * m : (j + 1) * m],
+                                id_idx_tb [:, j * m : (j + 1) * m],
+                                step_size, j) for j in range(n_micro)]
+                    loss = [sum(l[0] for l in losses),
+                            np.concatenate([l[1] for l in losses])]
+                
+                loss_sum    += np.asscalar(loss[0])
+                frames_real += np.count_nonzero(time_tb[-step_size :] >= 0.)
+                
+                if is_training:
+                    f_update_v_params(lr_cur)
+                    if args.sample_temp is not None:
+                        data_iter.record_loss(loss[1])
             frames_seen += frames_per_step
-            
-            if is_training:
-                f_update_v_params(lr_cur)
-            
-            if frames_seen >= trained_frames_per_epoch:
-                break
-        return np.float32(loss_sum / frames_seen)
+        
+        if n_staged > 0: # remainder
+            loss, frames = run_staged(n_staged, step_size, lr_cur)
+            loss_sum    += loss
+            frames_real += frames
+        if is_training and args.fused and not multi:
+            loss_sum, frames_real = net.pull_accumulators()
+        if keep:
+            train_states.append(net.get_prev_states())
+        return np.float32(loss_sum / max(frames_real, 1)), data_wait
+
+    def run_dev():
+        """
+        Returns dev loss per frame of data (excluding padding) and seconds
+        spent waiting for data (with eval_window, over the whole dev set in
+        memory)
+        """
+        if dev_batches is None:
+            return run_epoch(dev_data, None, args.exact_epoch)
+
+        loss_sum = 0.
+        frames_real = 0
+        for input_tbi, target_tbi, time_tb, id_idx_tb in dev_batches:
+            loss_sum    += np.asscalar(f_eval(input_tbi, target_tbi,
+                                              time_tb, id_idx_tb)[0])
+            frames_real += np.count_nonzero(time_tb >= 0.)
+        return np.float32(loss_sum / max(frames_real, 1)), 0.
+
+    def run_branches(lrs):
+        """
+        Train for an epoch with each lr in lrs & evaluate, concurrently in
+        forked processes (all starting from the current state), and continue
+        from the branch with the lowest dev loss
+        Returns its lr, train loss, and dev loss
+        """
+        net.wait_for_workspace() # (writer thread does not survive fork)
+
+        def branch(lr_cur):
+            loss_train = run_epoch(train_data, lr_cur)[0]
+            loss_dev   = run_dev()[0]
+            return (loss_train, loss_dev, net.get_params(),
+                    net.get_optim_state(), net.get_prev_states(),
+                    list(train_states), train_data.get_state(),
+                    dev_data.get_state())
+
+        results = fork_map(branch, lrs)
+        losses = [r[1] if not np.isnan(r[1]) else np.float32('inf')
+                  for r in results]
+        for lr_cur, r in zip(lrs, results):
+            print('    lr %-12s : train %.6f, eval %.6f'
+                  % (str(lr_cur), r[0], r[1]))
+
+        j = int(np.argmin(losses))
+        loss_train, loss_dev, params, optim_state, prev_states, \
+            train_states[:], train_state, dev_state = results[j]
+        net.set_params(params)
+        net.set_optim_state(optim_state)
+        net.set_prev_states(prev_states)
+        train_data.set_state(train_state)
+        dev_data  .set_state(dev_state  )
+        discard_train[0] = False # (done in branches)
+        return lrs[j], loss_train, loss_dev
     
 
     """
@@ -247,10 +606,8 @@ def main():
     Adapted from https://github.com/KyuyeonHwang/Fractal
     """
 
-    # Names for saving/loading
-    name_pivot = '0'
-    name_prev  = '1'
-    name_best  = None # auto
+    # Parameters at pivot/prev/best are kept as snapshots in host memory
+    # (only best is written to file, as params.npz, whenever it changes)
 
     trained_frames = 0
     trained_frames_at_pivot = 0
@@ -265,26 +622,96 @@ def main():
 
     lr = options['lr_init_val']
     f_initialize_optimizer()
-
-    net.save_to_workspace(name_prev)
-    net.save_to_workspace(name_best)
+    if dp is not None:
+        dp.initialize_optimizer()
+
+    branch_lrs = None # set at rollback (with branches)
+
+    state = net.load_training_state() if args.resume else None
+    if state is not None:
+        lr, cur_retry, trained_frames, trained_frames_at_pivot, \
+            trained_frames_at_best, discarded_frames, \
+            loss_pivot, loss_prev, loss_best, train_states[:], branch_lrs = \
+            state['scheduler']
+        dev_data  .set_state(state['dev_data'  ])
+        train_data.set_state(state['train_data']) # sets np.random last
+        print_hline() # -------------------------------------------------------
+        print('Resumed after ' + str(trained_frames) + ' trained frames')
+    else:
+        net.snapshot('prev')
+        net.snapshot('best')
+        net.save_to_workspace(from_snapshot = 'best')
+
+    # with async_eval, dev loss of the last trained epoch ('cur') is computed
+    # in evaluator while the next epoch is trained speculatively (its frames
+    # are in spec_frames until 'cur' is judged; discarded if rolled back)
+    def evaluate(params): # (in evaluator)
+        net.set_params(params)
+        return run_dev()[0]
+
+    if args.async_eval:
+        net.wait_for_workspace() # (writer thread does not survive fork)
+        evaluator = Worker(evaluate)
+    else:
+        evaluator = None
+    pending = False
+    spec_frames = 0
 
     while True:
         print_hline() # -------------------------------------------------------
-        print('Training...   ', end = '')
-        start = time.time()
-        loss_train = run_epoch(train_data, lr)
-        print(lapse_from(start))
-
-        trained_frames += trained_frames_per_epoch
+        if branch_lrs is not None:
+            print('Training/evaluating ' + str(len(branch_lrs))
+                  + ' branches... ', end = '')
+            start = time.time()
+            lr, loss_train, loss_cur = run_branches(branch_lrs)
+            print(lapse_from(start))
+            print('Continue with learning rate : ' + str(lr))
+            branch_lrs = None
+
+            trained_frames += trained_frames_per_epoch
+            net.snapshot('cur')
+        else:
+            print('Training...   ', end = '')
+            start = time.time()
+            loss_train_new, wait_train = run_epoch(train_data, lr)
+            print(lapse_from(start) + ' (data wait %.1f sec)' % wait_train)
+
+            if evaluator is None:
+                loss_train = loss_train_new
+                trained_frames += trained_frames_per_epoch
+                net.snapshot('cur')
+
+                print('Evaluating... ', end = '')
+                start = time.time()
+                loss_cur, wait_dev = run_dev()
+                print(lapse_from(start) + ' (data wait %.1f sec)' % wait_dev)
+            elif not pending: # nothing to judge yet
+                loss_train = loss_train_new
+                trained_frames += trained_frames_per_epoch
+                net.snapshot('cur')
+                evaluator.submit(net.get_snapshot('cur'))
+                pending = True
+                print('Evaluating in background...')
+                continue
+            else:
+                spec_frames = trained_frames_per_epoch
+                net.snapshot('next')
 
-        print('Evaluating... ', end = '')
-        start = time.time()
-        loss_cur = run_epoch(dev_data, None)
-        print(lapse_from(start))
+                print('Evaluating... ', end = '')
+                start = time.time()
+                loss_cur = evaluator.result()
+                print(lapse_from(start) + ' (waited after training)')
 
         print('Total trained frames   : ' + str(trained_frames  ).rjust(12))
         print('Total discarded frames : ' + str(discarded_frames).rjust(12))
+        for name, cache in caches:
+            if cache is not None:
+                print(('Cache (' + name + ')').ljust(12) + ' : '
+                      + cache.summary())
+        print('Checkpoint   : %.1f sec snapshot, %.1f sec write (total)'
+              % (net.snapshot_time, net.write_time))
+        if ps is not None:
+            print('Param server : ' + ps.summary())
         print('Train loss : %.6f' % loss_train)
         print('Eval loss  : %.6f' % loss_cur, end = '')
 
@@ -296,7 +723,8 @@ def main():
 
             trained_frames_at_best = trained_frames
             loss_best = loss_cur
-            net.save_to_workspace(name_best)
+            net.copy_snapshot('cur', 'best')
+            net.save_to_workspace(from_snapshot = 'best')
         print('')
 
         if loss_cur > loss_prev and trained_frames > trained_frames_per_epoch:
@@ -312,18 +740,38 @@ def main():
                     break
 
                 # cur <- pivot & prev <- cur
-                discard = trained_frames - trained_frames_at_pivot
+                discard = trained_frames - trained_frames_at_pivot \
+                          + spec_frames
                 discarded_frames += discard
                 trained_frames = trained_frames_at_pivot
-                net.load_from_workspace(name_pivot)
+                net.restore('pivot')
+                pending = False
+                spec_frames = 0
+                if args.exact_epoch: # states & positions of discarded epochs
+                    del train_states[:]
+                    train_data.discard_unfinished()
+                    discard_train[0] = True # (also for other processes)
                 
                 f_initialize_optimizer()
+                if dp is not None:
+                    dp.set_params(net.get_params())
+                    dp.initialize_optimizer()
+                if ps is not None:
+                    ps.invalidate()
 
                 loss_prev = loss_pivot
-                net.save_to_workspace(name_prev)
+                net.snapshot('prev')
 
                 print('Discard recently trained ' + str(discard) + ' frames')
-                print('New learning rate : ' + str(lr))
+                if args.branches > 1:
+                    branch_lrs = [lr * options['lr_decay_rate'] ** j
+                                  for j in range(args.branches)]
+                    branch_lrs = [l for l in branch_lrs
+                                  if l >= options['lr_lower_bound']]
+                    print('New learning rates : '
+                          + ', '.join(str(l) for l in branch_lrs))
+                else:
+                    print('New learning rate : ' + str(lr))
 
             else:
                 print('Retry count : ' + str(cur_retry) 
@@ -335,25 +783,48 @@ def main():
             trained_frames_at_pivot = trained_frames - trained_frames_per_epoch
 
             loss_pivot, loss_prev = loss_prev, loss_cur
-            name_pivot, name_prev = name_prev, name_pivot
-
-            net.save_to_workspace(name_prev)
+            net.swap_snapshots('pivot', 'prev')
+
+            net.copy_snapshot('cur', 'prev')
+
+        if pending: # speculative epoch was kept; evaluate it next
+            loss_train = loss_train_new
+            trained_frames += spec_frames
+            spec_frames = 0
+            net.swap_snapshots('cur', 'next')
+            evaluator.submit(net.get_snapshot('cur'))
+
+        if args.resume:
+            net.save_training_state(dict(
+                scheduler  = (lr, cur_retry, trained_frames,
+                              trained_frames_at_pivot, trained_frames_at_best,
+                              discarded_frames, loss_pivot, loss_prev,
+                              loss_best, list(train_states), branch_lrs),
+                train_data = train_data.get_state(),
+                dev_data   = dev_data  .get_state()))
     
 
-    discarded_frames += trained_frames - trained_frames_at_best
-    trained_frames = trained_frames_at_best
-    net.load_from_workspace(name_best)
+    if ps is not None:
+        ps.stop()
+    if evaluator is not None:
+        evaluator.close()
 
-    net.remove_from_workspace(name_pivot)
-    net.remove_from_workspace(name_prev)
+    discarded_frames += trained_frames - trained_frames_at_best + spec_frames
+    trained_frames = trained_frames_at_best
+    net.restore('best')
+    net.wait_for_workspace()
 
     print('')
     print('Best network')
     print('Total trained frames   : ' + str(trained_frames  ).rjust(12))
     print('Total discarded frames : ' + str(discarded_frames).rjust(12))
-    print('[Train set] Loss : %.6f' % run_epoch(train_data, None))
-    print('[ Dev set ] Loss : %.6f' % run_epoch(dev_data  , None))
+    print('[Train set] Loss : %.6f' % run_epoch(train_data, None)[0])
+    print('[ Dev set ] Loss : %.6f'
+          % run_dev()[0])
     print('')
 
+    if dp is not None:
+        dp.close()
+
 if __name__ == '__main__':
     main()
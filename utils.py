@@ -17,30 +17,38 @@ Small helper functions
 """
 
 from __future__ import absolute_import, division, print_function
+from six import iteritems
 
 import numpy as np
 import theano as th
 import theano.tensor as tt
 import string
 import random
+import six.moves.cPickle as pk
+import hashlib
+import os
+import sys
+import threading
 
 # Loss functions
 # For display, average in tb dimensions (but not in i dimension)
+# Summed over all dimensions, or only over given axis (e.g., (0, 2) for _b)
 
-def l2_loss(s_output_tbi, s_target_tbi):
+def l2_loss(s_output_tbi, s_target_tbi, axis = None):
     # D_err[loss] = err
-    return tt.sum(tt.sqr(s_output_tbi - s_target_tbi) / 2.)
+    return tt.sum(tt.sqr(s_output_tbi - s_target_tbi) / 2., axis = axis)
 
-def l1_loss(s_output_tbi, s_target_tbi):
+def l1_loss(s_output_tbi, s_target_tbi, axis = None):
     # D_err[loss] = sgn(err)
-    return tt.sum(tt.abs_(s_output_tbi - s_target_tbi))
+    return tt.sum(tt.abs_(s_output_tbi - s_target_tbi), axis = axis)
 
-def huber_loss(s_output_tbi, s_target_tbi, delta):
+def huber_loss(s_output_tbi, s_target_tbi, delta, axis = None):
     # D_err[loss] = clip_elem(err, delta)
     assert delta > 0.
     a = tt.abs_(s_output_tbi - s_target_tbi)
     return tt.sum(tt.switch(a <= delta, tt.sqr(a) / 2.,
-                                        delta * (a - delta / 2.)))
+                                        delta * (a - delta / 2.)),
+                  axis = axis)
 
 
 # Weight initializations
@@ -118,3 +126,147 @@ def get_random_string(length = 8):
                                                 + string.ascii_lowercase
                                                 + string.digits) \
                    for _ in range(length))
+
+
+# Compiled function cache
+
+def _deep_call(f):
+    """
+    Return f(), retried in a thread with a large stack & recursion limit if it
+    exceeds the recursion limit, for pickling deep graphs (e.g., unroll_scan,
+    whose depth grows with window_size)
+    - The limits are process-wide while raised, so they are raised only when
+      needed (not for the usual shallow graphs)
+    """
+    try:
+        return f()
+    except RuntimeError as e: # RecursionError on Python 3
+        if 'recursion' not in str(e):
+            raise
+
+    result = []
+    def run():
+        try:
+            result.append((True, f()))
+        except Exception as e:
+            result.append((False, e))
+
+    size  = threading.stack_size(512 * 1024 * 1024)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 500000))
+    try:
+        thread = threading.Thread(target = run)
+        thread.start()
+        thread.join()
+    finally:
+        threading.stack_size(size)
+        sys.setrecursionlimit(limit)
+
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+class FunctionCache():
+    def __init__(self, cache_dir = None):
+        """
+        Cache of compiled th.function's, in memory and in files under
+        cache_dir (default: $compiledir/sophia_functions)
+        - A function is identified by a key given by the caller (e.g.,
+          options & graph structure) and relevant THEANO_FLAGS
+        - Cached functions are rebound to the caller's shared variables with
+          Function.copy(swap = ...), which skips graph optimization; shared
+          variables are matched by their positions in a list the caller
+          enumerates in a fixed order
+        - Functions are kept in memory as pickled bytes (not as functions
+          holding the storage of the first caller's shared variables)
+        - Pickling that exceeds the recursion limit is retried with a large
+          stack & recursion limit, so that deep (unrolled) graphs are cached
+          too
+        - Any failure to pickle/unpickle/rebind falls back to compiling; such
+          failures are counted in summary() and the exception type of each
+          kind of failure is printed once
+        """
+        self._dir = cache_dir if cache_dir is not None \
+                    else th.config.compiledir + '/sophia_functions'
+        self._mem = {} # key -> pickled (names, function)
+
+        self.hits   = 0
+        self.misses = 0
+        self.persist_failures = 0 # compiled but not cached
+        self.load_failures    = 0 # cached but not usable (recompiled)
+        self._reported = set()    # (what, exception type) printed
+
+    def _hash(self, key):
+        flags = [th.__version__, th.config.floatX, th.config.device,
+                 th.config.contexts, th.config.mode, th.config.optimizer,
+                 th.config.optimizer_excluding, th.config.optimizer_including]
+        return hashlib.sha1(repr((key, flags)).encode('utf-8')).hexdigest()
+
+    def _report(self, what, e):
+        if (what, type(e)) not in self._reported:
+            self._reported.add((what, type(e)))
+            print('FunctionCache: failed to %s a function (%s: %s)'
+                  % (what, type(e).__name__, str(e)[: 100]),
+                  file = sys.stderr)
+
+    def _rebind(self, data, v_shareds):
+        names, f = _deep_call(lambda: pk.loads(data))
+        swap = dict((v, v_shareds[k]) for v, k in zip(f.get_shared(), names))
+        return f.copy(swap = swap)
+
+    def compile(self, key, v_shareds, **kwargs):
+        """
+        Return th.function(**kwargs) for given key, whose shared variables
+        are all in v_shareds (dict of name -> th.SharedVariable, where a name
+        identifies the role of a variable across processes)
+        """
+        h = self._hash(key)
+        file_name = self._dir + '/' + h + '.pkl'
+        tmp_name  = None
+        if h not in self._mem and os.path.isfile(file_name):
+            try:
+                with open(file_name, 'rb') as f:
+                    self._mem[h] = f.read()
+            except Exception as e:
+                self.load_failures += 1
+                self._report('read', e)
+        if h in self._mem:
+            try:
+                f = self._rebind(self._mem[h], v_shareds)
+                self.hits += 1
+                return f
+            except Exception as e:
+                self.load_failures += 1
+                self._report('load', e)
+                del self._mem[h]
+
+        self.misses += 1
+        f = th.function(**kwargs)
+        try:
+            names = dict((id(v), k) for k, v in iteritems(v_shareds))
+            entry = ([names[id(v)] for v in f.get_shared()], f)
+            data = _deep_call(lambda: pk.dumps(entry, pk.HIGHEST_PROTOCOL))
+            self._mem[h] = data
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
+            tmp_name = file_name + '.' + get_random_string() + '.tmp'
+            with open(tmp_name, 'wb') as f_out:
+                f_out.write(data)
+            os.rename(tmp_name, file_name) # atomic on POSIX
+        except Exception as e:
+            self.persist_failures += 1
+            self._report('persist', e)
+            if tmp_name is not None and os.path.isfile(tmp_name):
+                os.remove(tmp_name)
+        return f
+
+    def summary(self):
+        s = '%d hits, %d misses' % (self.hits, self.misses)
+        if self.persist_failures > 0:
+            s += ', %d not cached' % self.persist_failures
+        if self.load_failures > 0:
+            s += ', %d failed to load' % self.load_failures
+        return s
+
+function_cache = FunctionCache() # shared by all Net's in a process